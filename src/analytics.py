@@ -0,0 +1,277 @@
+import ipaddress
+import json
+from collections import defaultdict
+from itertools import combinations
+
+import networkx as nx
+
+import src.connection as connection
+from src.graph import bump_graph_generation
+from src.instrumentation import stage
+
+DEFAULT_MTU = 1500
+INTERFACE_SECTIONS = ("ethernets", "bonds", "vlans", "bridges")
+SEVERITY = {"SPOF": 3, "BRIDGE": 2, "MTU_MISMATCH": 2, "ISOLATED": 2, "FAILOVER_ROUTE": 1, "ECMP": 1, "SUMMARY": 0}
+
+
+def load_devices():
+    """
+    Cấu hình netplan gốc của từng device (property infor, chỉ ingest rule-based lưu).
+    Trả về (devices, total): devices chỉ gồm device có cấu hình đọc được, total = tổng số device.
+    """
+    rows = connection.graph.query("MATCH (e:Entity {type: 'DEVICE'}) RETURN e.id as id, e.infor as infor")
+    devices = {}
+    for r in rows:
+        try:
+            network = json.loads(r['infor']) if r['infor'] else None
+        except (TypeError, ValueError):
+            network = None
+        if isinstance(network, dict) and network:
+            devices[r['id']] = network
+    return devices, len(rows)
+
+
+def device_interfaces(network):
+    for section in INTERFACE_SECTIONS:
+        for name, conf in (network.get(section) or {}).items():
+            if isinstance(conf, dict):
+                yield section, name, conf
+
+
+def effective_mtu(network, conf):
+    # VLAN không khai báo MTU thì lấy theo interface/bond bên dưới
+    if conf.get("mtu"):
+        return int(conf["mtu"])
+    link = conf.get("link")
+    for section in ("ethernets", "bonds"):
+        parent = (network.get(section) or {}).get(link) if link else None
+        if isinstance(parent, dict) and parent.get("mtu"):
+            return int(parent["mtu"])
+    return DEFAULT_MTU
+
+
+def device_routes(network):
+    routes = [r for r in (network.get("routes") or []) if isinstance(r, dict)]
+    for _, name, conf in device_interfaces(network):
+        routes.extend(r for r in (conf.get("routes") or []) if isinstance(r, dict))
+        if conf.get("gateway4"):
+            routes.append({"to": "0.0.0.0/0", "via": conf["gateway4"], "interface": name})
+    return [r for r in routes if r.get("to") and r.get("via")]
+
+
+def build_link_graph(devices):
+    """
+    Graph mức device: 2 device nối nhau nếu có interface cùng subnet.
+    Trả về (G, segments) với segments = {subnet: [{device, interface, address, mtu}]}.
+    """
+    segments = defaultdict(list)
+    for dev, network in devices.items():
+        for _, name, conf in device_interfaces(network):
+            for addr in conf.get("addresses") or []:
+                try:
+                    iface = ipaddress.ip_interface(str(addr))
+                except ValueError:
+                    continue
+                segments[str(iface.network)].append({
+                    "device": dev, "interface": name,
+                    "address": str(iface), "mtu": effective_mtu(network, conf)
+                })
+
+    G = nx.Graph()
+    G.add_nodes_from(devices)
+    for subnet, members in segments.items():
+        for a, b in combinations(members, 2):
+            if a["device"] == b["device"]:
+                continue
+            link = {"subnet": subnet, "a": a, "b": b}
+            if G.has_edge(a["device"], b["device"]):
+                G[a["device"]][b["device"]]["links"].append(link)
+            else:
+                G.add_edge(a["device"], b["device"], links=[link])
+    return G, segments
+
+
+def owner_of(segments, ip):
+    try:
+        ip = ipaddress.ip_address(str(ip))
+    except ValueError:
+        return None
+    for members in segments.values():
+        for m in members:
+            if ipaddress.ip_interface(m["address"]).ip == ip:
+                return m["device"]
+    return None
+
+
+def cut_off_by(G, node):
+    # Các device mất kết nối với phần lớn nhất của mạng khi node hỏng
+    component = nx.node_connected_component(G, node) - {node}
+    parts = sorted(nx.connected_components(G.subgraph(component)), key=len, reverse=True)
+    return sorted(set().union(*parts[1:])) if len(parts) > 1 else []
+
+
+def compute_topology_facts(devices, total_devices=None):
+    """
+    Articulation point, bridge, degree/độ dự phòng theo device, nhóm ECMP và MTU lệch trên link.
+    Trả về (facts, device_stats).
+    """
+    total_devices = len(devices) if total_devices is None else total_devices
+    G, segments = build_link_graph(devices)
+    facts = []
+
+    def add_fact(kind, text, devs, **extra):
+        facts.append({
+            "id": f"{kind}:{len(facts)}",
+            "kind": kind,
+            "severity": SEVERITY.get(kind, 0),
+            "text": text,
+            "devices": sorted(set(devs)),
+            "data": json.dumps(extra, ensure_ascii=False, default=str)
+        })
+
+    articulation = set(nx.articulation_points(G))
+    bridges = list(nx.bridges(G))
+    bridge_count = defaultdict(int)
+
+    for ap in sorted(articulation):
+        lost = cut_off_by(G, ap)
+        add_fact("SPOF", f"{ap} is a single point of failure (articulation point): if it fails, "
+                         f"{', '.join(lost)} lose connectivity to the rest of the network.",
+                 [ap] + lost, cut_off=lost)
+
+    for u, v in bridges:
+        bridge_count[u] += 1
+        bridge_count[v] += 1
+        links = G[u][v]["links"]
+        H = G.copy()
+        H.remove_edge(u, v)
+        side_u, side_v = nx.node_connected_component(H, u), nx.node_connected_component(H, v)
+        detail = "; ".join(f"{l['a']['device']}/{l['a']['interface']} ({l['a']['address']}) <-> "
+                           f"{l['b']['device']}/{l['b']['interface']} ({l['b']['address']})" for l in links)
+        parallel = f" It has {len(links)} parallel links, but all go to the same neighbor." if len(links) > 1 else ""
+        add_fact("BRIDGE", f"The connection {u} <-> {v} is a bridge: it is the only path between "
+                           f"{len(side_u)} device(s) on {u}'s side and {len(side_v)} on {v}'s side. Links: {detail}.{parallel}",
+                 [u, v], links=len(links))
+
+    for subnet, members in segments.items():
+        mtus = {m["mtu"] for m in members}
+        if len({m["device"] for m in members}) > 1 and len(mtus) > 1:
+            detail = ", ".join(f"{m['device']}/{m['interface']} MTU {m['mtu']}" for m in members)
+            add_fact("MTU_MISMATCH", f"MTU mismatch on subnet {subnet}: {detail}.",
+                     [m["device"] for m in members], subnet=subnet)
+
+    for dev, network in devices.items():
+        groups = defaultdict(list)
+        for r in device_routes(network):
+            groups[str(r["to"])].append(r)
+        for dst, routes in groups.items():
+            next_hops = sorted({str(r["via"]) for r in routes})
+            if len(next_hops) < 2:
+                continue
+            metrics = {r.get("metric", 0) for r in routes}
+            via_devices = [owner_of(segments, nh) for nh in next_hops]
+            detail = ", ".join(f"{nh} ({d or 'external'})" for nh, d in zip(next_hops, via_devices))
+            if len(metrics) == 1:
+                add_fact("ECMP", f"{dev} load-balances traffic to {dst} over {len(next_hops)} equal-cost next-hops: {detail}.",
+                         [dev] + [d for d in via_devices if d], destination=dst)
+            else:
+                add_fact("FAILOVER_ROUTE", f"{dev} has primary/backup routes to {dst} with different metrics "
+                                           f"({', '.join(str(m) for m in sorted(metrics, key=str))}): {detail}.",
+                         [dev] + [d for d in via_devices if d], destination=dst)
+
+    for dev in sorted(devices):
+        if G.degree(dev) == 0:
+            add_fact("ISOLATED", f"{dev} shares no subnet with any other device in the configuration "
+                                 f"(only external or host-facing links).", [dev])
+
+    device_stats = []
+    for dev in sorted(devices):
+        degree = G.degree(dev)
+        device_stats.append({
+            "id": dev,
+            "degree": degree,
+            "link_count": sum(len(G[dev][n]["links"]) for n in G[dev]),
+            "is_articulation": dev in articulation,
+            "bridge_links": bridge_count[dev],
+            "redundant": degree >= 2 and bridge_count[dev] == 0
+        })
+
+    add_fact("SUMMARY",
+             f"Topology: {G.number_of_nodes()} devices, {G.number_of_edges()} device-to-device connections, "
+             f"{nx.number_connected_components(G)} connected component(s). "
+             f"Articulation points: {', '.join(sorted(articulation)) or 'none'}. Bridges: {len(bridges)}. "
+             f"Devices without redundancy: {', '.join(s['id'] for s in device_stats if not s['redundant']) or 'none'}. "
+             f"Computed from the configuration of {len(devices)} of {total_devices} device(s).",
+             [])
+    # Retrieval chỉ dùng facts khi biết chúng được tính từ cấu hình thật
+    facts[-1]["source_devices_with_config"] = len(devices)
+    return facts, device_stats
+
+
+def clear_topology_facts():
+    rows = connection.graph.query("MATCH (f:TopologyFact) DETACH DELETE f RETURN count(*) as n")
+    return rows[0]['n'] if rows else 0
+
+
+def write_topology_facts(facts, device_stats):
+    clear_topology_facts()
+    connection.graph.query("""
+        UNWIND $facts as f
+        CREATE (t:TopologyFact {id: f.id})
+        SET t.kind = f.kind, t.severity = f.severity, t.text = f.text,
+            t.devices = f.devices, t.data = f.data,
+            t.source_devices_with_config = f.source_devices_with_config
+        WITH t, f
+        UNWIND f.devices as dev_id
+        MATCH (e:Entity {id: dev_id})
+        MERGE (t)-[:ABOUT]->(e)
+    """, {"facts": facts})
+    connection.graph.query("""
+        UNWIND $rows as row
+        MATCH (e:Entity {id: row.id})
+        SET e.degree = row.degree,
+            e.link_count = row.link_count,
+            e.is_articulation = row.is_articulation,
+            e.bridge_links = row.bridge_links,
+            e.redundant = row.redundant
+    """, {"rows": device_stats})
+
+
+def run_topology_analytics():
+    print("[Analytics] Tính articulation point, bridge, ECMP, MTU...")
+    devices, total = load_devices()
+    if not devices:
+        # Ingest bằng LLM không lưu infor -> không có gì để tính; xoá facts cũ để retrieval không trả lời từ dữ liệu cũ
+        print(f"Không có device nào có cấu hình ({total} device), bỏ qua bước analytics.")
+        if clear_topology_facts():
+            bump_graph_generation()
+        return {}
+
+    with stage("topology_analytics"):
+        facts, device_stats = compute_topology_facts(devices, total)
+    with stage("neo4j_write"):
+        write_topology_facts(facts, device_stats)
+    bump_graph_generation()
+
+    counts = defaultdict(int)
+    for f in facts:
+        counts[f["kind"]] += 1
+    print(f"   -> {dict(counts)}")
+    return dict(counts)
+
+
+TOPOLOGY_FACTS_QUERY = """
+    MATCH (f:TopologyFact)
+    WHERE $kinds IS NULL OR f.kind IN $kinds
+    RETURN f.kind as kind, f.severity as severity, f.text as text, f.devices as devices,
+           f.source_devices_with_config as source_devices_with_config
+    ORDER BY f.severity DESC, f.id
+"""
+
+
+def fetch_topology_facts(kinds=None):
+    return connection.graph.query(TOPOLOGY_FACTS_QUERY, {"kinds": kinds})
+
+
+async def afetch_topology_facts(kinds=None):
+    return await connection.aquery(TOPOLOGY_FACTS_QUERY, {"kinds": kinds})
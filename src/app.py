@@ -1,5 +1,4 @@
 import streamlit as st
-import time
 import os
 import sys
 
@@ -8,9 +7,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import các module của bạn
 import src.connection as connection
-from src.graph import (run_ingestion, run_clustering_louvain, run_summarization)
-from src.retrieval import router_search, global_search, \
-    local_search  # Lưu ý: route_question hay router_search tuỳ tên hàm bạn đặt
+from src.graph import run_ingestion
+from src.pipeline import run_indexing_pipeline
+from src.retrieval import router_search_stream, global_search_stream, local_search_stream
 
 st.set_page_config(
     page_title="Network GraphRAG AI",
@@ -91,14 +90,14 @@ with st.sidebar:
         # Chỉ chạy tiếp nếu có nội dung
         if yaml_content:
             with st.status("Đang xây dựng Knowledge Graph...", expanded=True) as status:
-                st.write("1. Reading & Ingesting Data...")
-                run_ingestion(yaml_content)
-
-                st.write("2. Running Louvain Clustering...")
-                run_clustering_louvain()
-
-                status.update(label="Xây dựng Graph hoàn tất!", state="complete", expanded=False)
-            st.success("Hệ thống đã sẵn sàng!")
+                try:
+                    # Ingest -> Louvain -> Summarize -> Index (bỏ qua stage không đổi, resume nếu lỗi)
+                    run_indexing_pipeline(yaml_content, ingest_fn=run_ingestion, log=st.write)
+                    status.update(label="Xây dựng Graph hoàn tất!", state="complete", expanded=False)
+                    st.success("Hệ thống đã sẵn sàng!")
+                except Exception as e:
+                    status.update(label="Xây dựng Graph bị gián đoạn!", state="error")
+                    st.error(f"Chi tiết lỗi: {e}. Bấm lại để chạy tiếp từ checkpoint.")
 
     st.markdown("---")
     st.subheader("2. Chế độ Tìm kiếm")
@@ -142,6 +141,7 @@ if prompt := st.chat_input("VD: Hệ thống có điểm đơn thất bại (SPO
     with st.chat_message("assistant", avatar="🤖"):
         message_placeholder = st.empty()
         full_response = ""
+        result = None
 
         # Dùng st.status thay cho spinner
         with st.status("Đang phân tích hệ thống...", expanded=True) as status:
@@ -149,23 +149,29 @@ if prompt := st.chat_input("VD: Hệ thống có điểm đơn thất bại (SPO
                 # Logic chọn hàm search (Sử dụng biến search_mode từ sidebar)
                 if search_mode == "Auto (AI Router)":
                     st.write("Targeting: AI Router Decision...")
-                    # Lưu ý: Import đúng tên hàm router của bạn (route_question hoặc router_search)
-                    response_text = router_search(prompt)
+                    events = router_search_stream(prompt)
                 elif search_mode == "Global Search (Tổng quan)":
                     st.write("Targeting: Global Map-Reduce Analysis...")
-                    response_text = global_search(prompt)
+                    events = global_search_stream(prompt)
                 else:
                     st.write("Targeting: Local Entity Traversal...")
-                    response_text = local_search(prompt)
+                    events = local_search_stream(prompt)
+
+                # Hiển thị status của bước retrieval, sau đó stream từng token của câu trả lời
+                for event in events:
+                    if event["type"] == "status":
+                        st.write(event["message"])
+                    elif event["type"] == "route":
+                        st.write(f"Router: {event['destination']} STRATEGY")
+                    elif event["type"] == "token":
+                        if not full_response:
+                            status.update(label="Phân tích hoàn tất!", state="complete", expanded=False)
+                        full_response += event["content"]
+                        message_placeholder.markdown(full_response + "▌")
+                    elif event["type"] == "result":
+                        result = event["result"]
 
                 status.update(label="Phân tích hoàn tất!", state="complete", expanded=False)
-
-                # Hiệu ứng gõ chữ
-                for chunk in response_text.split(" "):
-                    full_response += chunk + " "
-                    time.sleep(0.01)
-                    message_placeholder.markdown(full_response + "▌")
-
                 message_placeholder.markdown(full_response)
 
             except Exception as e:
@@ -174,4 +180,15 @@ if prompt := st.chat_input("VD: Hệ thống có điểm đơn thất bại (SPO
                 full_response = "Xin lỗi, tôi gặp sự cố khi truy xuất dữ liệu."
                 message_placeholder.markdown(full_response)
 
+        # Context thực sự đã đưa vào LLM (từ RetrievalResult, không đọc file log)
+        if result is not None:
+            route = (result.route or {}).get("destination", result.strategy.upper())
+            st.caption(f"{route} | {result.latency:.2f}s | {result.llm_calls} LLM calls | "
+                       f"{result.input_tokens}/{result.output_tokens} tokens" + (" | cache" if result.cached else ""))
+            if result.context:
+                with st.expander(f"Context ({len(result.context)} mục)"):
+                    for item in result.context:
+                        score = f"{item.score:.3f} " if isinstance(item.score, float) else ""
+                        st.markdown(f"`{item.kind}` {score}{item.text}")
+
     st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
@@ -0,0 +1,214 @@
+"""
+Chạy hàng loạt câu hỏi (đánh giá / làm nóng cache) song song thay vì hỏi từng câu qua menu.
+
+    python -m src.main batch --input data/questions.jsonl --output log/batch/answers.jsonl \
+        --strategy router --concurrency 8
+
+Mỗi dòng input là JSON {"question": "...", "id"?: ..., "strategy"?: "router|global|local"}.
+Mỗi dòng output gồm câu trả lời, latency, thời gian từng stage, số lượt gọi LLM và token.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+
+from langchain_core.embeddings import Embeddings
+
+import src.connection as connection
+import src.metrics as metrics
+from src.cache import normalize_question
+from src.instrumentation import instrument_llm, track
+from src.profiling import profiled
+from src.retrieval import aglobal_search, alocal_search, arouter_search
+
+STRATEGIES = {
+    "router": arouter_search,
+    "global": aglobal_search,
+    "local": alocal_search,
+}
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    Embedding câu hỏi được tính trước theo batch (1 lượt gọi cho nhiều câu);
+    embed_query tra bảng trước, câu khác (report, point...) vẫn gọi model gốc.
+    """
+
+    def __init__(self, base, vectors=None):
+        self.base = base
+        self.vectors = vectors or {}
+
+    async def aprecompute(self, questions, batch_size):
+        pending = list(dict.fromkeys(q for q in questions if normalize_question(q) not in self.vectors))
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            for q, v in zip(batch, await self.base.aembed_documents(batch)):
+                self.vectors[normalize_question(q)] = v
+        return len(pending)
+
+    def embed_query(self, text):
+        v = self.vectors.get(normalize_question(text))
+        return v if v is not None else self.base.embed_query(text)
+
+    async def aembed_query(self, text):
+        v = self.vectors.get(normalize_question(text))
+        return v if v is not None else await self.base.aembed_query(text)
+
+    def embed_documents(self, texts):
+        return self.base.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.base.aembed_documents(texts)
+
+
+def load_questions(path, default_strategy):
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Bỏ qua dòng {n + 1}: {e}")
+                continue
+            if not row.get("question"):
+                continue
+            strategy = row.get("strategy", default_strategy)
+            if strategy not in STRATEGIES:
+                print(f"Bỏ qua dòng {n + 1}: strategy '{strategy}' không hợp lệ")
+                continue
+            items.append({"id": row.get("id", n), "question": row["question"], "strategy": strategy})
+    return items
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def summarize(results):
+    """Thống kê theo strategy (router tách thêm theo route đã chọn): p50/p95/p99, lượt gọi LLM, token."""
+    groups = defaultdict(list)
+    for r in results:
+        groups[r["strategy"]].append(r)
+        if r.get("route"):
+            groups[f"{r['strategy']}:{r['route']}"].append(r)
+
+    summary = {}
+    for name, rows in sorted(groups.items()):
+        ok = [r for r in rows if r["error"] is None]
+        latencies = [r["latency"] for r in ok]
+        stages = defaultdict(float)
+        for r in ok:
+            for k, v in r["stages"].items():
+                stages[k] += v
+        summary[name] = {
+            "count": len(rows),
+            "errors": len(rows) - len(ok),
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "llm_calls": sum(r["llm_calls"] for r in ok),
+            "input_tokens": sum(r["input_tokens"] for r in ok),
+            "output_tokens": sum(r["output_tokens"] for r in ok),
+            "avg_stage_seconds": {k: round(v / len(ok), 4) for k, v in sorted(stages.items())} if ok else {}
+        }
+    return summary
+
+
+async def run_batch(items, output_path, concurrency=4, embed_batch_size=100):
+    """Chạy các câu hỏi với tối đa `concurrency` câu cùng lúc, ghi từng kết quả ra JSONL ngay khi xong."""
+    base_llm, base_embeddings = connection.llm, connection.embeddings
+    embeddings = PrecomputedEmbeddings(base_embeddings)
+    connection.llm = instrument_llm(base_llm)
+    connection.embeddings = embeddings
+
+    try:
+        with profiled("batch"):
+            t1 = time.time()
+            try:
+                n = await embeddings.aprecompute([it["question"] for it in items], embed_batch_size)
+                print(f"Đã embed {n} câu hỏi theo batch ({time.time() - t1:.2f}s)")
+            except Exception as e:
+                print(f"Lỗi embed batch ({e}), embed từng câu.")
+
+            slots = asyncio.Semaphore(concurrency)
+            results = []
+            done = 0
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+            with open(output_path, "w", encoding="utf-8") as out:
+                async def run_one(item):
+                    nonlocal done
+                    async with slots:
+                        with track() as record:
+                            t_start = time.perf_counter()
+                            answer, error = None, None
+                            try:
+                                answer = await STRATEGIES[item["strategy"]](item["question"])
+                            except Exception as e:
+                                error = str(e)
+                            latency = time.perf_counter() - t_start
+
+                    row = {**item, "answer": answer, "error": error, "latency": round(latency, 4), **record.to_dict()}
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    out.flush()
+                    results.append(row)
+                    done += 1
+                    print(f"[{done}/{len(items)}] {item['strategy']} {latency:.2f}s {item['question'][:60]}")
+
+                await asyncio.gather(*(run_one(it) for it in items))
+
+            elapsed = time.time() - t1
+    finally:
+        connection.llm, connection.embeddings = base_llm, base_embeddings
+
+    return results, elapsed
+
+
+def print_summary(summary, elapsed, total):
+    print(f"\n===== BATCH: {total} câu hỏi trong {elapsed:.2f}s =====")
+    for name, s in summary.items():
+        print(f"{name:<16} n={s['count']:<5} err={s['errors']:<3} p50={s['p50']:.2f}s p95={s['p95']:.2f}s "
+              f"p99={s['p99']:.2f}s LLM calls={s['llm_calls']} tokens={s['input_tokens']}/{s['output_tokens']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Chạy hàng loạt câu hỏi từ file JSONL")
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", default="log/batch/answers.jsonl")
+    parser.add_argument("--strategy", default="router", choices=list(STRATEGIES))
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--summary", default=None, help="File JSON lưu bảng thống kê (mặc định <output>.summary.json)")
+    args = parser.parse_args(argv)
+
+    connection.init_connections()
+    items = load_questions(args.input, args.strategy)
+    if not items:
+        print("Không có câu hỏi nào để chạy.")
+        return
+
+    concurrency = args.concurrency or int(connection.cfg.get("BATCH_CONCURRENCY", 4))
+    embed_batch_size = int(connection.cfg.get("BATCH_EMBED_SIZE", 100))
+    mark = metrics.registry.mark()
+    results, elapsed = connection.run_sync(run_batch(items, args.output, concurrency, embed_batch_size))
+
+    summary = summarize(results)
+    print_summary(summary, elapsed, len(results))
+    metrics.write_run_summary("batch", since=mark, cfg=connection.cfg)
+    summary_path = args.summary or f"{os.path.splitext(args.output)[0]}.summary.json"
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump({"elapsed": round(elapsed, 3), "concurrency": concurrency, "strategies": summary},
+                  f, ensure_ascii=False, indent=2)
+    print(f"Kết quả: {args.output}\nThống kê: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
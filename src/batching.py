@@ -0,0 +1,84 @@
+import functools
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(name="cl100k_base"):
+    # Encoding chuẩn của GPT-4, chỉ load 1 lần cho cả process
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text):
+    try:
+        return len(get_encoding().encode(text))
+    except Exception:
+        # Fallback nếu chưa cài tiktoken: ước lượng 1 token ~ 4 ký tự
+        return len(text) // 4
+
+
+def truncate_to_tokens(text, budget):
+    if budget <= 0:
+        return ""
+    try:
+        tokens = get_encoding().encode(text)
+        return text if len(tokens) <= budget else get_encoding().decode(tokens[:budget])
+    except Exception:
+        return text[:budget * 4]
+
+
+def pack_by_token_budget(items, render, budget, trim=None, overhead=0, max_items=None):
+    """
+    Gom các item vào từng lượt gọi LLM sao cho tổng token (kể cả prompt overhead)
+    không vượt quá budget. Item quá lớn được cắt bớt bằng `trim(item, budget)`.
+    Trả về list các batch, mỗi batch là list item (đã cắt nếu cần).
+    """
+    item_budget = max(budget - overhead, 1)
+    batches = []
+    current = []
+    used = 0
+
+    for item in items:
+        n = count_tokens(render(item))
+        if n > item_budget and trim is not None:
+            # Đo lại sau khi cắt (header / ký tự nối cũng tốn token); còn vượt thì cắt lại với budget nhỏ hơn
+            original, target = item, item_budget
+            while n > item_budget and target > 0:
+                item = trim(original, target)
+                n = count_tokens(render(item))
+                target -= max(n - item_budget, 1)
+
+        full = max_items is not None and len(current) >= max_items
+        if current and (used + n > item_budget or full):
+            batches.append(current)
+            current = []
+            used = 0
+
+        current.append(item)
+        used += n
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def trim_members_by_rank(members, budget, render_member):
+    # Giữ các thành viên có rank (số kết nối) cao nhất cho tới khi hết budget
+    ranked = sorted(members, key=lambda m: len(m.get('neighbors') or []), reverse=True)
+    kept = []
+    used = 0
+    for m in ranked:
+        n = count_tokens(render_member(m))
+        if used + n > budget:
+            if kept:
+                continue
+            # Thành viên đầu tiên một mình đã vượt budget: cắt bớt mô tả thay vì giữ nguyên
+            fixed = count_tokens(render_member({**m, "desc": ""}))
+            m = {**m, "desc": truncate_to_tokens(m.get("desc") or "", budget - fixed)}
+            n = count_tokens(render_member(m))
+        kept.append(m)
+        used += n
+    return kept
@@ -0,0 +1,181 @@
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import src.connection as connection
+from src.graph import aget_graph_generation
+
+
+def normalize_question(question):
+    q = " ".join(str(question).lower().split())
+    return re.sub(r"[\s?.!]+$", "", q)
+
+
+def entity_tokens(question):
+    # Tên thiết bị / IP / interface / số (LEAF_SWITCH_01, 10.0.1.1/30, eth0, Router B):
+    # 2 câu hỏi chỉ khác các token này có cosine rất cao nhưng câu trả lời khác hẳn
+    tokens = re.findall(r"[\w./:-]+", str(question))
+    return frozenset(t.lower().strip("./:-") for t in tokens
+                     if any(c.isdigit() for c in t) or "_" in t or t.isupper())
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời 2 tầng đặt trước router/global/local search:
+      1. LRU theo câu hỏi đã chuẩn hoá (khớp chính xác).
+      2. Tra theo độ tương đồng embedding (cosine >= threshold), chỉ giữa các câu hỏi có cùng
+         entity token (entity_tokens) để không trả câu trả lời của thiết bị / IP khác.
+    Mỗi entry gắn với graph generation lúc sinh ra; generation đổi (ingest/phân cụm) thì
+    entry cũ không bao giờ được trả về.
+    """
+
+    def __init__(self, max_size=1000, threshold=0.95, generation_ttl=0.0):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.generation_ttl = generation_ttl
+        self.entries = OrderedDict()  # (strategy, normalized question) -> entry
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self._generation = None
+        self._generation_checked = 0.0
+
+    def generation_expired(self):
+        return self._generation is None or time.time() - self._generation_checked > self.generation_ttl
+
+    def set_generation(self, generation):
+        self._generation = generation
+        self._generation_checked = time.time()
+        return generation
+
+    async def acurrent_generation(self):
+        if self.generation_expired():
+            try:
+                self.set_generation(await aget_graph_generation())
+            except Exception as e:
+                print(f"Lỗi đọc graph generation: {e}")
+                self.set_generation(-1)
+        return self._generation
+
+    def lookup_exact(self, key, generation, entities=frozenset()):
+        """Trả về (entry | None, candidates cho tầng embedding)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry["generation"] == generation:
+                    self.entries.move_to_end(key)
+                    self.counters["hit_exact"] += 1
+                    return entry, []
+                del self.entries[key]
+                self.counters["stale"] += 1
+
+            if self.threshold >= 1.0:
+                return None, []
+            return None, [(k, e) for k, e in self.entries.items()
+                          if k[0] == key[0] and e["generation"] == generation and e["vector"] is not None
+                          and e["entities"] == entities]
+
+    def lookup_semantic(self, candidates, question_vector):
+        q = np.asarray(question_vector, dtype=float)
+        q /= max(np.linalg.norm(q), 1e-12)
+        sims = np.stack([e["vector"] for _, e in candidates]) @ q
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        k, e = candidates[best]
+        with self.lock:
+            if k in self.entries:
+                self.entries.move_to_end(k)
+            self.counters["hit_semantic"] += 1
+        return e["answer"]
+
+    def record_miss(self):
+        with self.lock:
+            self.counters["miss"] += 1
+
+    async def alookup(self, strategy, question, question_vector=None):
+        """
+        Trả về (answer | None, question_vector, generation). Generation đã kiểm tra phải được
+        truyền lại cho astore: câu trả lời sinh từ graph cũ không được lưu dưới generation mới.
+        """
+        key = (strategy, normalize_question(question))
+        generation = await self.acurrent_generation()
+        entry, candidates = self.lookup_exact(key, generation, entity_tokens(question))
+        if entry is not None:
+            return entry["answer"], entry["vector"], generation
+
+        if candidates:
+            try:
+                if question_vector is None:
+                    question_vector = await connection.embeddings.aembed_query(question)
+                answer = self.lookup_semantic(candidates, question_vector)
+                if answer is not None:
+                    return answer, question_vector, generation
+            except Exception as e:
+                print(f"Lỗi tra cache theo embedding: {e}")
+
+        self.record_miss()
+        return None, question_vector, generation
+
+    def insert(self, strategy, question, answer, question_vector, generation):
+        vector = None
+        if question_vector is not None:
+            vector = np.asarray(question_vector, dtype=float)
+            vector /= max(np.linalg.norm(vector), 1e-12)
+
+        key = (strategy, normalize_question(question))
+        with self.lock:
+            self.entries[key] = {
+                "answer": answer,
+                "vector": vector,
+                "entities": entity_tokens(question),
+                "generation": generation,
+                "created_at": time.time()
+            }
+            self.entries.move_to_end(key)
+            self.counters["store"] += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters["evict"] += 1
+
+    async def astore(self, strategy, question, answer, generation, question_vector=None):
+        # generation = giá trị alookup trả về lúc bắt đầu câu hỏi, không đọc lại lúc lưu
+        if self.threshold < 1.0 and question_vector is None:
+            try:
+                question_vector = await connection.embeddings.aembed_query(question)
+            except Exception as e:
+                print(f"Lỗi embed câu hỏi để cache: {e}")
+        self.insert(strategy, question, answer, question_vector, generation)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        with self.lock:
+            hits = self.counters["hit_exact"] + self.counters["hit_semantic"]
+            lookups = hits + self.counters["miss"]
+            return {
+                **self.counters,
+                "size": len(self.entries),
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
+
+
+_answer_cache = None
+
+
+def get_answer_cache():
+    # Khởi tạo lười để đọc config sau init_connections(); None nếu tắt cache
+    global _answer_cache
+    if not connection.cfg.get("ANSWER_CACHE_ENABLED", True):
+        return None
+    if _answer_cache is None:
+        _answer_cache = SemanticAnswerCache(
+            max_size=int(connection.cfg.get("ANSWER_CACHE_SIZE", 1000)),
+            threshold=float(connection.cfg.get("ANSWER_CACHE_SIMILARITY", 0.95)),
+            generation_ttl=float(connection.cfg.get("ANSWER_CACHE_GENERATION_TTL", 0))
+        )
+    return _answer_cache
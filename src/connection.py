@@ -1,8 +1,12 @@
+import asyncio
 import os
+import threading
+import weakref
 import yaml
 from langchain_community.graphs import Neo4jGraph
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase
+from src.instrumentation import instrument_llm
+from src.providers import create_embeddings, create_llm
 
 # --- 1. KHAI BÁO BIẾN GLOBAL (Mặc định là None) ---
 cfg = {}
@@ -11,6 +15,12 @@ llm = None
 embeddings = None
 driver = None
 
+# Async driver gắn với event loop tạo ra nó -> mỗi loop 1 driver
+_async_drivers = weakref.WeakKeyDictionary()
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
 
 def load_config():
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -34,26 +44,15 @@ def init_connections():
         print("Cảnh báo: Config rỗng!")
         return
 
-    #KẾT NỐI GEMINI
-    api_key = cfg.get("GOOGLE_API_KEY")
-    if api_key:
-        try:
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-2.5-flash",
-                google_api_key=api_key,
-                temperature=0
-
-            )
-            embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/text-embedding-004",
-                google_api_key=api_key
-            )
-            print("Gemini Connected (LLM Ready)")
-        except Exception as e:
-            print(f"Lỗi kết nối Gemini: {e}")
-            llm = None
-    else:
-        print("Lỗi: Thiếu GOOGLE_API_KEY trong file config.yml")
+    # KẾT NỐI LLM / EMBEDDING (LLM_PROVIDER, EMBEDDING_PROVIDER: gemini | fake)
+    try:
+        # TokenCallback: đếm lượt gọi / token vào RetrievalResult của câu hỏi đang chạy
+        llm = instrument_llm(create_llm(cfg))
+        embeddings = create_embeddings(cfg)
+        print(f"LLM Ready ({cfg.get('LLM_PROVIDER', 'gemini')} / embedding {cfg.get('EMBEDDING_PROVIDER', 'gemini')})")
+    except Exception as e:
+        print(f"Lỗi khởi tạo LLM / embedding: {e}")
+        llm = None
 
     # KẾT NỐI NEO4J
     uri = cfg.get("NEO4J_URI")
@@ -73,6 +72,55 @@ def init_connections():
         print("Cảnh báo: Thiếu thông tin kết nối Neo4j")
 
 
+def get_async_driver():
+    loop = asyncio.get_running_loop()
+    driver = _async_drivers.get(loop)
+    if driver is None:
+        driver = AsyncGraphDatabase.driver(cfg["NEO4J_URI"], auth=(cfg["NEO4J_USERNAME"], cfg["NEO4J_PASSWORD"]))
+        _async_drivers[loop] = driver
+    return driver
+
+
+async def aquery(cypher, params=None):
+    # Bản async của graph.query: trả về list dict giống Neo4jGraph.query
+    records, _, _ = await get_async_driver().execute_query(
+        cypher, params or {}, database_=cfg.get("NEO4J_DATABASE")
+    )
+    return [r.data() for r in records]
+
+
+def get_loop():
+    # Event loop chạy nền dùng chung cho các hàm sync (run_sync / iter_sync)
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="retrieval-loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coro):
+    """Chạy coroutine trên loop nền và chờ kết quả (gọi từ code sync: main, Streamlit, eval)."""
+    loop = get_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync() không được gọi từ bên trong loop nền, hãy await trực tiếp.")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def iter_sync(agen):
+    """Biến async generator thành generator sync, từng phần tử lấy qua loop nền."""
+    try:
+        while True:
+            try:
+                yield run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(agen.aclose())
+
+
 if __name__ == "__main__":
     init_connections()
     print(f"Kiểm tra biến LLM: {type(llm)}")
\ No newline at end of file
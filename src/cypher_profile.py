@@ -0,0 +1,243 @@
+"""
+Chạy các truy vấn Cypher chính với PROFILE và ghi db hits / rows / operator theo tên truy vấn.
+Mỗi truy vấn chạy trong transaction bị rollback nên MERGE / SET không làm đổi dữ liệu.
+
+    python main.py cypher-profile [--output log/cypher/profile.json] [--baseline log/cypher/old.json] [--only device_traversal,...]
+
+Report JSON được so với --baseline: db hits tăng quá ngưỡng, plan đổi, hoặc xuất hiện
+label scan / cartesian product mới đều bị báo là regression (exit code 1).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from neo4j import GraphDatabase
+
+import src.connection as connection
+from src.analytics import TOPOLOGY_FACTS_QUERY
+from src.devices import DEVICE_TRAVERSAL_QUERY
+from src.graph import (COMMUNITY_ASSIGN_QUERY, COMMUNITY_MEMBERS_QUERY, COMMUNITY_WRITE_QUERY, ENTITY_MERGE_QUERY,
+                       GENERATION_QUERY, RELATION_MERGE_QUERY)
+from src.retrieval import COMMUNITIES_QUERY, COMMUNITY_SEARCH_QUERY, ENTITY_SEARCH_QUERY
+from src.run_ingestion_rulebased import ENTITY_BATCH_MERGE_QUERY, RELATION_BATCH_MERGE_QUERY
+from src.scoring import EDGES_QUERY, NODES_QUERY, OUTER_EDGES_QUERY, SUBGRAPH_QUERY
+
+PROFILE_DIR = "log/cypher"
+
+# Operator bị gắn cờ: quét theo label / toàn bộ node thay vì dùng index, và tích Descartes
+FLAGGED_OPERATORS = {"AllNodesScan", "NodeByLabelScan", "CartesianProduct"}
+
+SAMPLE_QUERIES = {
+    "device": "MATCH (e:Entity) RETURN e.id as id ORDER BY e.type = 'DEVICE' DESC, e.id LIMIT 1",
+    "edge": "MATCH (a:Entity)-[:CONNECTED_TO]->(b:Entity) RETURN a.id as src, b.id as tgt ORDER BY a.id, b.id LIMIT 1",
+    "community": """
+        MATCH (e:Entity) WHERE e.communityId IS NOT NULL
+        WITH e.communityId as cid, e.id as id ORDER BY cid, id
+        RETURN cid, collect(id)[..20] as members LIMIT 1
+    """,
+    "entity_embedding": "MATCH (e:Entity) WHERE e.embedding IS NOT NULL RETURN e.embedding as embedding LIMIT 1",
+    "community_embedding": "MATCH (c:Community) WHERE c.embedding IS NOT NULL RETURN c.embedding as embedding LIMIT 1",
+}
+
+
+def sample_params(session):
+    """Lấy id / vector có thật trong DB làm tham số, để plan giống lúc chạy thật."""
+    rows = {name: session.run(q).data() for name, q in SAMPLE_QUERIES.items()}
+    device = rows["device"][0]["id"] if rows["device"] else "unknown"
+    edge = rows["edge"][0] if rows["edge"] else {"src": device, "tgt": device}
+    community = rows["community"][0] if rows["community"] else {"cid": "0", "members": [device]}
+    return {
+        "device": device,
+        "edge": edge,
+        "cid": community["cid"],
+        "members": community["members"],
+        "entity_embedding": rows["entity_embedding"][0]["embedding"] if rows["entity_embedding"] else None,
+        "community_embedding": rows["community_embedding"][0]["embedding"] if rows["community_embedding"] else None,
+    }
+
+
+# Tên -> (câu Cypher, hàm dựng tham số từ sample_params, nhóm). Hàm trả về None thì bỏ qua truy vấn.
+CATALOG = {
+    # Retrieval
+    "device_traversal": (DEVICE_TRAVERSAL_QUERY, lambda s: {"id": s["device"], "limit": 200}, "query"),
+    "entity_search": (ENTITY_SEARCH_QUERY,
+                      lambda s: s["entity_embedding"] and {"k": 5, "embedding": s["entity_embedding"]}, "query"),
+    "community_search": (COMMUNITY_SEARCH_QUERY,
+                         lambda s: s["community_embedding"] and {"k": 5, "embedding": s["community_embedding"]}, "query"),
+    "communities": (COMMUNITIES_QUERY, lambda s: {}, "query"),
+    "topology_facts": (TOPOLOGY_FACTS_QUERY, lambda s: {"kinds": None}, "query"),
+    "graph_generation": (GENERATION_QUERY, lambda s: {}, "query"),
+    "mirror_nodes": (NODES_QUERY, lambda s: {}, "query"),
+    "mirror_edges": (EDGES_QUERY, lambda s: {}, "query"),
+    "subgraph_2hop": (SUBGRAPH_QUERY % 1, lambda s: {"ids": [s["device"]]}, "query"),
+    "outer_edges": (OUTER_EDGES_QUERY, lambda s: {"ids": [s["device"]]}, "query"),
+    # Ingestion / clustering / summarization
+    "entity_merge": (ENTITY_MERGE_QUERY.format(label="DEVICE"),
+                     lambda s: {"name": s["device"], "type": "DEVICE", "desc": "profile"}, "ingest"),
+    "relation_merge": (RELATION_MERGE_QUERY,
+                       lambda s: {"src": s["edge"]["src"], "tgt": s["edge"]["tgt"], "desc": "profile", "strength": "1"},
+                       "ingest"),
+    "entity_batch_merge": (ENTITY_BATCH_MERGE_QUERY,
+                           lambda s: {"data": [{"name": s["device"], "type": "DEVICE", "desc": "profile", "infor": None}]},
+                           "ingest"),
+    "relation_batch_merge": (RELATION_BATCH_MERGE_QUERY,
+                             lambda s: {"data": [{"source": s["edge"]["src"], "target": s["edge"]["tgt"],
+                                                  "rel_type": "CONNECTED_TO", "strength": 1}]},
+                             "ingest"),
+    "community_assign": (COMMUNITY_ASSIGN_QUERY, lambda s: {"members": s["members"], "cid": s["cid"]}, "cluster"),
+    "community_members": (COMMUNITY_MEMBERS_QUERY, lambda s: {"cids": [s["cid"]]}, "summarize"),
+    "community_write": (COMMUNITY_WRITE_QUERY,
+                        lambda s: {"rows": [{"cid": s["cid"], "title": "profile", "summary": "", "rating": 0,
+                                             "explanation": "", "findings": "[]", "hash": ""}]},
+                        "summarize"),
+}
+
+
+def walk(plan, depth=0):
+    yield plan, depth
+    for child in plan.get("children") or []:
+        yield from walk(child, depth + 1)
+
+
+def operator_name(node):
+    # Neo4j 5 trả về "NodeIndexSeek@neo4j"
+    return (node.get("operatorType") or "").split("@")[0]
+
+
+def plan_args(node):
+    return node.get("args") or node.get("arguments") or {}
+
+
+def summarize_plan(plan):
+    operators = []
+    flags = []
+    for node, depth in walk(plan):
+        name = operator_name(node)
+        details = str(plan_args(node).get("Details", ""))
+        operators.append({"operator": name, "depth": depth, "details": details,
+                          "db_hits": node.get("dbHits", 0), "rows": node.get("rows", 0)})
+        if name in FLAGGED_OPERATORS:
+            flags.append(f"{name}: {details}" if details else name)
+    return {
+        "db_hits": sum(op["db_hits"] for op in operators),
+        "rows": plan.get("rows", 0),
+        "operators": operators,
+        "flags": flags,
+    }
+
+
+def profile_query(session, cypher, params):
+    # Rollback để các truy vấn ghi (MERGE / SET) không để lại dấu vết
+    tx = session.begin_transaction()
+    try:
+        t1 = time.perf_counter()
+        summary = tx.run("PROFILE " + cypher, params).consume()
+        elapsed = time.perf_counter() - t1
+    finally:
+        tx.rollback()
+    result = summarize_plan(summary.profile)
+    result["time_ms"] = round(elapsed * 1000, 2)
+    return result
+
+
+def run_profile(names=None):
+    cfg = connection.cfg
+    driver = GraphDatabase.driver(cfg["NEO4J_URI"], auth=(cfg["NEO4J_USERNAME"], cfg["NEO4J_PASSWORD"]))
+    report = {"generated_at": datetime.now().isoformat(timespec="seconds"), "queries": {}}
+    try:
+        report["server"] = driver.get_server_info().agent
+        with driver.session(database=cfg.get("NEO4J_DATABASE")) as session:
+            samples = sample_params(session)
+            for name, (cypher, build_params, group) in CATALOG.items():
+                if names and name not in names:
+                    continue
+                params = build_params(samples)
+                if params is None:
+                    print(f"   {name:<22} bỏ qua (thiếu dữ liệu mẫu, VD chưa có embedding)")
+                    continue
+                try:
+                    result = profile_query(session, cypher, params)
+                except Exception as e:
+                    print(f"   {name:<22} lỗi: {e}")
+                    report["queries"][name] = {"group": group, "error": str(e)}
+                    continue
+                report["queries"][name] = {"group": group, **result}
+                flags = f"  [!] {', '.join(result['flags'])}" if result["flags"] else ""
+                print(f"   {name:<22} db hits={result['db_hits']:<8} rows={result['rows']:<6} "
+                      f"{result['time_ms']:>8.1f}ms{flags}")
+    finally:
+        driver.close()
+    return report
+
+
+def plan_shape(query):
+    return [(op["operator"], op["depth"]) for op in query.get("operators", [])]
+
+
+def compare(baseline, report, tolerance=0.2, min_hits=100):
+    """
+    So report với baseline; trả về danh sách regression (chuỗi mô tả).
+    db hits chỉ tính là tăng khi vượt cả tolerance (tương đối) lẫn min_hits (tuyệt đối).
+    """
+    regressions = []
+    old_queries = baseline.get("queries", {})
+    for name, new in report["queries"].items():
+        old = old_queries.get(name)
+        if old is None or "error" in old:
+            continue
+        if "error" in new:
+            regressions.append(f"{name}: lỗi ({new['error']})")
+            continue
+        grew = new["db_hits"] - old["db_hits"]
+        if grew > min_hits and grew > tolerance * old["db_hits"]:
+            regressions.append(f"{name}: db hits {old['db_hits']} -> {new['db_hits']}")
+        added = sorted(set(new["flags"]) - set(old["flags"]))
+        if added:
+            regressions.append(f"{name}: operator mới bị gắn cờ {added}")
+        if plan_shape(old) != plan_shape(new):
+            regressions.append(f"{name}: plan đổi {[o for o, _ in plan_shape(old)]} -> {[o for o, _ in plan_shape(new)]}")
+    missing = sorted(set(old_queries) - set(report["queries"]))
+    if missing:
+        print(f"   Không có trong lần chạy này: {missing}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py cypher-profile",
+                                     description="PROFILE các truy vấn Cypher chính và so với report trước")
+    parser.add_argument("--output", default=None, help="Mặc định log/cypher/profile_<thời điểm>.json")
+    parser.add_argument("--baseline", default=None, help="Report JSON của lần chạy / phiên bản trước")
+    parser.add_argument("--only", default=None, help="Danh sách tên truy vấn, cách nhau bởi dấu phẩy")
+    parser.add_argument("--tolerance", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    connection.init_connections()
+    names = set(args.only.split(",")) if args.only else None
+    print("[Cypher PROFILE] Đang chạy (transaction rollback, không ghi dữ liệu)...")
+    report = run_profile(names)
+
+    output = args.output or os.path.join(PROFILE_DIR, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"Report: {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        tolerance = args.tolerance if args.tolerance is not None else \
+            float(connection.cfg.get("CYPHER_PROFILE_TOLERANCE", 0.2))
+        regressions = compare(baseline, report, tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression so với {args.baseline}:")
+            for r in regressions:
+                print(f"   - {r}")
+            sys.exit(1)
+        print(f"Không có regression so với {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
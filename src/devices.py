@@ -0,0 +1,143 @@
+import ipaddress
+import re
+from collections import defaultdict
+
+# Gom dữ liệu graph (Device -> Interface -> IP, Route) theo dạng cấu hình thiết bị.
+# Dùng chung cho local_search_semantic và fast path (src/fastpath.py).
+
+INTERFACE_TYPES = ['INTERFACE', 'BOND', 'VLAN', 'BRIDGE']
+ADDRESS_PATTERN = re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?:/\d{1,2})?\b")
+
+# Hop 1 + Hop 2 quanh 1 anchor, mỗi dòng là 1 cạnh (src, rel, tgt)
+DEVICE_TRAVERSAL_QUERY = """
+    MATCH (anchor:Entity {id: $id})-[r1]-(n1:Entity)
+    WHERE type(r1) <> 'IN_COMMUNITY'
+    RETURN
+        anchor.id as src_id, anchor.type as src_type, anchor.desc as src_desc,
+        type(r1) as rel_type, r1.desc as rel_desc,
+        n1.id as tgt_id, n1.type as tgt_type, n1.desc as tgt_desc
+
+    UNION
+
+    MATCH (anchor:Entity {id: $id})-[r1]-(n1:Entity)-[r2]-(n2:Entity)
+    WHERE type(r1) <> 'IN_COMMUNITY' AND type(r2) <> 'IN_COMMUNITY'
+    RETURN
+        n1.id as src_id, n1.type as src_type, n1.desc as src_desc,
+        type(r2) as rel_type, r2.desc as rel_desc,
+        n2.id as tgt_id, n2.type as tgt_type, n2.desc as tgt_desc
+    LIMIT $limit
+"""
+
+
+def clean_text(text):
+    if not text: return ""
+    return text.replace(")**", "").strip()
+
+
+def address_of(node_id, desc=None):
+    # ID đã bị clean_id (10_0_1_1_30) -> lấy lại địa chỉ gốc từ desc ("address 10.0.1.1/30.")
+    m = ADDRESS_PATTERN.search(desc or "")
+    return m.group(0) if m else clean_text(node_id)
+
+
+def parse_interface_address(address):
+    try:
+        return ipaddress.ip_interface(address)
+    except ValueError:
+        return None
+
+
+def group_device_rows(raw_rows):
+    """
+    Gom các dòng traversal thành {device_id: {"desc", "interfaces": {iface: {"ip", "desc"}}, "routes"}}.
+    Trả về (devices_map, interface_parent_map).
+    """
+    # Cấu trúc dữ liệu (Sử dụng Set cho IP để tự khử trùng lặp)
+    devices_map = defaultdict(lambda: {
+        "desc": "",
+        "interfaces": defaultdict(lambda: {"ip": set(), "desc": "", "type": ""}),
+        "routes": set()
+    })
+
+    # Map để trace ngược từ Interface về Device
+    interface_parent_map = {}
+
+    # PASS 1: Xây khung Device - Interface
+    for row in raw_rows:
+        src_id, src_type = row['src_id'], row['src_type']
+        tgt_id, tgt_type = row['tgt_id'], row['tgt_type']
+
+        # Logic: Chỉ map Interface vào Device nếu ID Interface chứa ID Device
+        # Hoặc chấp nhận map lỏng lẻo nhưng phải cẩn thận
+
+        if src_type == 'DEVICE' and tgt_type in INTERFACE_TYPES:
+            devices_map[src_id]['desc'] = clean_text(row['src_desc'])
+            devices_map[src_id]['interfaces'][tgt_id]['desc'] = clean_text(row['tgt_desc'])
+            devices_map[src_id]['interfaces'][tgt_id]['type'] = tgt_type
+            interface_parent_map[tgt_id] = src_id  # Mapping Interface -> Device
+
+        elif tgt_type == 'DEVICE' and src_type in INTERFACE_TYPES:
+            devices_map[tgt_id]['desc'] = clean_text(row['tgt_desc'])
+            devices_map[tgt_id]['interfaces'][src_id]['desc'] = clean_text(row['src_desc'])
+            devices_map[tgt_id]['interfaces'][src_id]['type'] = src_type
+            interface_parent_map[src_id] = tgt_id
+
+    # PASS 2: Gắn IP và Route
+    for row in raw_rows:
+        src_id, src_type = row['src_id'], row['src_type']
+        tgt_id, tgt_type = row['tgt_id'], row['tgt_type']
+        rel = row.get('rel_desc') if row.get('rel_desc') else row['rel_type']
+
+        # Gắn IP (Dùng Set để add, tự động loại trùng)
+        if src_type == 'IP_ADDRESS' and tgt_id in interface_parent_map:
+            devices_map[interface_parent_map[tgt_id]]['interfaces'][tgt_id]['ip'].add(address_of(src_id, row.get('src_desc')))
+        elif tgt_type == 'IP_ADDRESS' and src_id in interface_parent_map:
+            devices_map[interface_parent_map[src_id]]['interfaces'][src_id]['ip'].add(address_of(tgt_id, row.get('tgt_desc')))
+
+        # Gắn Routes
+        if src_type == 'DEVICE' and 'ROUTE' in rel.upper():
+            devices_map[src_id]['routes'].add(f"To {address_of(tgt_id, row.get('tgt_desc'))} via {rel}")
+        elif tgt_type == 'DEVICE' and 'ROUTE' in rel.upper():
+            devices_map[tgt_id]['routes'].add(f"To {address_of(src_id, row.get('src_desc'))} via {rel}")
+
+    return devices_map, interface_parent_map
+
+
+def interface_attrs(iface_data):
+    # Extract Attributes ngắn gọn
+    attrs = []
+    desc_lower = iface_data['desc'].lower()
+    mtu = re.search(r"mtu size (\d+)", desc_lower)
+    if mtu: attrs.append(f"MTU:{mtu.group(1)}")
+    elif 'mtu' in desc_lower: attrs.append("MTU:9000")
+    if iface_data.get('type') == 'BOND' or 'bond' in desc_lower: attrs.append("Type:Bond")
+    return attrs
+
+
+def render_device_block(dev_id, data):
+    block = [f"### DEVICE: {dev_id}"]
+
+    short_desc = data['desc'].split("Configuration includes")[0].strip()
+    block.append(f"  Role: {short_desc}")
+
+    if data['interfaces']:
+        block.append(f"  INTERFACES:")
+        for iface in sorted(data['interfaces'].keys()):
+            iface_data = data['interfaces'][iface]
+
+            # Convert set IP back to list & sort
+            ips = sorted(list(iface_data['ip']))
+            ip_str = f" [IPs: {', '.join(ips)}]" if ips else ""
+
+            attrs = interface_attrs(iface_data)
+            attr_str = f" ({', '.join(attrs)})" if attrs else ""
+
+            block.append(f"    - {iface}{ip_str}{attr_str}")
+
+    if data['routes']:
+        block.append(f"  ROUTING TABLE:")
+        for r in sorted(list(data['routes'])):
+            block.append(f"    - {r}")
+
+    block.append("")
+    return block
@@ -17,6 +17,7 @@ from ragas.metrics import (
 from ragas.llms import LangchainLLMWrapper
 from ragas.embeddings import LangchainEmbeddingsWrapper
 import src.connection as connection
+from src.results import RetrievalResult
 from langchain_google_genai import ChatGoogleGenerativeAI
 from typing import Any, List, Optional
 from langchain_core.callbacks import CallbackManagerForLLMRun
@@ -90,7 +91,7 @@ class NetworkRagasEvaluator:
 
         return Dataset.from_dict(data)
 
-    def evaluate_single_turn(self, question, answer, retrieved_context, ground_truth=None):
+    def evaluate_single_turn(self, question, answer, retrieved_context, ground_truth=None, retrieval=None):
         print(f"Evaluating: '{question}'...")
         start_time = time.time()
 
@@ -133,14 +134,14 @@ class NetworkRagasEvaluator:
             end_time = time.time()  # Kết thúc bấm giờ
             duration = end_time - start_time
 
-            self.save_results(results, duration)
+            self.save_results(results, duration, retrieval)
             return results
 
         except Exception as e:
             print(f"Ragas Error: {e}")
             return None
 
-    def save_results(self, results, duration):
+    def save_results(self, results, duration, retrieval=None):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{EVAL_LOG_DIR}/ragas_report_{timestamp}.json"
 
@@ -180,6 +181,8 @@ class NetworkRagasEvaluator:
         try:
             with open(filename, "w", encoding="utf-8") as f:
                 full_log = {**scores, **meta_info}
+                if retrieval:
+                    full_log["retrieval"] = retrieval
                 json.dump(full_log, f, ensure_ascii=False, indent=2 , cls=NumpyEncoder)
             print(f"Saved: {filename}")
         except Exception as e:
@@ -188,6 +191,17 @@ class NetworkRagasEvaluator:
         print("=" * 50 + "\n")
 
 
-def run_eval_pipeline(question, answer, context_list, ground_truth=None):
+def run_eval_pipeline(question, answer=None, context_list=None, ground_truth=None,
+                      result: RetrievalResult | None = None):
+    """
+    Chấm answer (str) với context_list, hoặc truyền result (search(..., return_result=True)):
+    khi đó answer / context lấy đúng từ kết quả đã đưa vào LLM, route / thời gian / token được ghi kèm report.
+    """
+    retrieval = None
+    if result is not None:
+        answer = result.answer
+        context_list = result.context_texts() or ["Context rỗng"]
+        retrieval = {k: v for k, v in result.to_dict().items() if k not in ("question", "answer", "context")}
+
     evaluator = NetworkRagasEvaluator()
-    return evaluator.evaluate_single_turn(question, answer, context_list, ground_truth)
\ No newline at end of file
+    return evaluator.evaluate_single_turn(question, answer, context_list, ground_truth, retrieval)
\ No newline at end of file
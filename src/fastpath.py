@@ -0,0 +1,239 @@
+import re
+import threading
+
+from src.devices import (INTERFACE_TYPES, address_of, group_device_rows, interface_attrs,
+                         parse_interface_address)
+from src.routing import IP_PATTERN
+from src.run_ingestion_rulebased import clean_id
+from src.scoring import get_graph_mirror
+
+# Câu hỏi có cấu trúc trả lời thẳng từ graph mirror, không cần vector search / LLM.
+# Thứ tự quan trọng: intent đầu tiên khớp sẽ được dùng.
+INTENT_PATTERNS = [
+    ("routes", re.compile(r"\b(routes?|routing|định tuyến|next[- ]?hops?|gateways?)\b", re.IGNORECASE)),
+    ("neighbors", re.compile(r"\b(neighbou?rs?|peers?|lân cận|hàng xóm|connected to|kết nối (?:với|tới|đến))\b", re.IGNORECASE)),
+    ("ips", re.compile(r"\b(ips?|ip address(?:es)?|addresses|địa chỉ)\b", re.IGNORECASE)),
+    ("interfaces", re.compile(r"\b(interfaces?|ports?|nics?|cổng|card mạng|giao diện)\b", re.IGNORECASE)),
+]
+
+# Câu hỏi cần suy luận (nguyên nhân, ảnh hưởng, đường đi...) -> để pipeline thường xử lý
+REASONING_PATTERN = re.compile(
+    r"\b(why|impact|fail\w*|if|path|compare|redundan\w*|tại sao|vì sao|nếu|ảnh hưởng|đường đi|so sánh|dự phòng|sự cố)\b",
+    re.IGNORECASE
+)
+
+ROUTE_PATTERN = re.compile(r"route to (\S+) via ([\d.]+)(?: \(metric (\d+)\))?")
+GATEWAY_PATTERN = re.compile(r"gateway (\d{1,3}(?:\.\d{1,3}){3})")
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def build_catalog(mirror):
+    """
+    Chỉ mục phụ trên mirror: danh sách device / interface để nhận diện thực thể trong câu hỏi,
+    interface -> device và các IP gắn trên interface (phục vụ tra owner / neighbor theo subnet).
+    """
+    devices = [nid for nid, t in zip(mirror.ids, mirror.types) if t == 'DEVICE']
+    interfaces = [nid for nid, t in zip(mirror.ids, mirror.types) if t in INTERFACE_TYPES]
+
+    parent = {}
+    bindings = []
+    for iface in interfaces:
+        i = mirror.index[iface]
+        nbrs, _ = mirror.neighbors(i)
+        for j in nbrs.tolist():
+            if mirror.types[j] == 'DEVICE':
+                parent[iface] = mirror.ids[j]
+        for j in nbrs.tolist():
+            if mirror.types[j] == 'IP_ADDRESS':
+                address = address_of(mirror.ids[j], mirror.descs[j])
+                parsed = parse_interface_address(address)
+                if parsed is not None:
+                    bindings.append({"address": parsed, "interface": iface, "device": parent.get(iface)})
+
+    return {
+        "mirror": mirror,
+        # Tên dài trước để "SPINE_ROUTER_01" không bị nhận nhầm thành "SPINE_ROUTER_0"
+        "devices": sorted(devices, key=len, reverse=True),
+        "interfaces": sorted(interfaces, key=len, reverse=True),
+        "parent": parent,
+        "bindings": bindings
+    }
+
+
+def get_catalog(mirror=None):
+    global _catalog
+    if mirror is None:
+        mirror = get_graph_mirror()
+    with _catalog_lock:
+        if _catalog is None or _catalog["mirror"] is not mirror:
+            _catalog = build_catalog(mirror)
+        return _catalog
+
+
+def find_entities(catalog, question):
+    q = f"_{clean_id(question)}_"
+    device = next((d for d in catalog["devices"] if f"_{d}_" in q), None)
+
+    interface = next((i for i in catalog["interfaces"] if f"_{i}_" in q), None)
+    if interface is None and device is not None:
+        # "eth0 của SPINE_ROUTER_01" -> ID interface là SPINE_ROUTER_01_ETH0
+        prefix = f"{device}_"
+        interface = next((i for i in catalog["interfaces"]
+                          if i.startswith(prefix) and f"_{i[len(prefix):]}_" in q), None)
+    if interface is not None and device is None:
+        device = catalog["parent"].get(interface)
+
+    addresses = [a for a in (parse_interface_address(x) for x in IP_PATTERN.findall(question)) if a is not None]
+    return device, interface, addresses
+
+
+def match_intent(question):
+    return next((name for name, pattern in INTENT_PATTERNS if pattern.search(question)), None)
+
+
+def is_candidate(question):
+    # Lọc rẻ (chỉ regex) trước khi cần tới graph mirror
+    if REASONING_PATTERN.search(question):
+        return False
+    return match_intent(question) is not None or bool(IP_PATTERN.search(question))
+
+
+def device_view(mirror, device):
+    devices_map, _ = group_device_rows(mirror.rows_around(device, depth=2))
+    return devices_map.get(device)
+
+
+def answer_ips(catalog, device, interface):
+    view = device_view(catalog["mirror"], device)
+    if view is None:
+        return None
+    facts = []
+    for iface in sorted(view['interfaces']):
+        if interface is not None and iface != interface:
+            continue
+        ips = sorted(view['interfaces'][iface]['ip'])
+        facts.append(f"- {iface}: {', '.join(ips) if ips else '(không có IP)'}")
+    return f"Địa chỉ IP của {interface or device}:", facts
+
+
+def answer_interfaces(catalog, device, interface):
+    view = device_view(catalog["mirror"], device)
+    if view is None:
+        return None
+    facts = []
+    for iface in sorted(view['interfaces']):
+        data = view['interfaces'][iface]
+        ips = sorted(data['ip'])
+        ip_str = f" [IPs: {', '.join(ips)}]" if ips else ""
+        attrs = interface_attrs(data)
+        attr_str = f" ({', '.join(attrs)})" if attrs else ""
+        facts.append(f"- {iface} [{data['type'] or 'INTERFACE'}]{ip_str}{attr_str}")
+    return f"{device} có {len(facts)} interface:", facts
+
+
+def answer_routes(catalog, device, interface):
+    mirror = catalog["mirror"]
+    desc = mirror.descs[mirror.index[device]] or ""
+
+    # Mô tả device chứa đủ bảng route (kể cả ECMP cùng đích, khác next-hop)
+    facts = []
+    for dst, via, metric in ROUTE_PATTERN.findall(desc):
+        metric_str = f" (metric {metric})" if metric else ""
+        facts.append(f"- {dst.rstrip(',;')} via {via}{metric_str}")
+
+    view = device_view(mirror, device)
+    for iface in sorted(view['interfaces']) if view else []:
+        for gw in GATEWAY_PATTERN.findall(view['interfaces'][iface]['desc']):
+            facts.append(f"- default via {gw} ({iface})")
+
+    if not facts and view is not None:
+        facts = [f"- {r}" for r in sorted(view['routes'])]
+    if not facts:
+        facts = ["- (không có route tĩnh)"]
+    return f"Bảng định tuyến của {device}:", facts
+
+
+def subnet_peers(catalog, interfaces):
+    # Neighbor L3: interface của device khác có IP cùng subnet
+    own = [b for b in catalog["bindings"] if b["interface"] in interfaces]
+    peers = []
+    for b in own:
+        for other in catalog["bindings"]:
+            if other["interface"] in interfaces or other["address"].network != b["address"].network:
+                continue
+            peers.append(f"- {b['interface']} ({b['address']}) <-> {other['device']} / {other['interface']} ({other['address']})")
+    return peers
+
+
+def answer_neighbors(catalog, device, interface):
+    mirror = catalog["mirror"]
+    if interface is not None:
+        interfaces = {interface}
+    else:
+        interfaces = {i for i, d in catalog["parent"].items() if d == device}
+
+    facts = sorted(set(subnet_peers(catalog, interfaces)))
+    if not facts:
+        # Không có IP chung subnet -> liệt kê các entity nối trực tiếp trong graph
+        target = interface or device
+        nbrs, _ = mirror.neighbors(mirror.index[target])
+        facts = sorted({f"- [{mirror.types[j]}] {mirror.ids[j]}" for j in nbrs.tolist()})
+    return f"Neighbor của {interface or device}:", facts or ["- (không có)"]
+
+
+def answer_owner(catalog, addresses):
+    facts = []
+    for a in addresses:
+        owners = [b for b in catalog["bindings"] if b["address"].ip == a.ip]
+        for b in owners:
+            facts.append(f"- {b['address']} nằm trên {b['device']} / {b['interface']}")
+        if not owners:
+            same_subnet = [b for b in catalog["bindings"] if a.ip in b["address"].network]
+            for b in same_subnet:
+                facts.append(f"- {a.ip} cùng subnet {b['address'].network} với {b['device']} / {b['interface']} ({b['address']})")
+    if not facts:
+        return None
+    return "Thiết bị sở hữu địa chỉ IP:", facts
+
+
+ANSWERS = {
+    "ips": answer_ips,
+    "interfaces": answer_interfaces,
+    "routes": answer_routes,
+    "neighbors": answer_neighbors,
+}
+
+
+def answer_structured(question, mirror=None):
+    """
+    Trả lời câu hỏi có cấu trúc (IP / interface / route / neighbor của 1 thiết bị, IP thuộc thiết bị nào)
+    trực tiếp từ graph (mirror truyền vào hoặc mirror dùng chung).
+    Trả về {"intent", "entity", "facts", "answer"} hoặc None nếu không khớp template.
+    """
+    if not is_candidate(question):
+        return None
+    intent = match_intent(question)
+
+    catalog = get_catalog(mirror)
+    device, interface, addresses = find_entities(catalog, question)
+
+    if device is None and interface is None:
+        if not addresses or intent not in (None, "ips", "interfaces"):
+            return None
+        # "IP 10.0.1.2 thuộc thiết bị nào?"
+        intent, entity, result = "owner", ", ".join(str(a) for a in addresses), answer_owner(catalog, addresses)
+    else:
+        entity = interface or device
+        result = ANSWERS[intent](catalog, device, interface) if device is not None and intent is not None else None
+
+    if result is None:
+        return None
+    header, facts = result
+    return {
+        "intent": intent,
+        "entity": entity,
+        "facts": facts,
+        "answer": "\n".join([header] + facts)
+    }
@@ -1,8 +1,15 @@
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_community.vectorstores import Neo4jVector
+import hashlib
 import json
+from collections import defaultdict
+
 import src.connection as connection
+from src.instrumentation import stage
+from src.profiling import profiled
+from src.batching import count_tokens, pack_by_token_budget, trim_members_by_rank
 from src.prompt.index.community_report_new import BATCH_COMMUNITY_REPORT_PROMPT
 from src.prompt.index.extract_graph import GRAPH_EXTRACTION_PROMPT
 from src.prompt.index.extract_graph_code_repo import GRAPH_EXTRACTION_REPO_PROMPT
@@ -16,10 +23,46 @@ import os
 
 
 
+GENERATION_QUERY = "MATCH (m:GraphMeta {id: 'graph'}) RETURN m.generation as generation"
+
+
+def get_graph_generation():
+    rows = connection.graph.query(GENERATION_QUERY)
+    return rows[0]['generation'] if rows and rows[0]['generation'] is not None else 0
+
+
+async def aget_graph_generation():
+    rows = await connection.aquery(GENERATION_QUERY)
+    return rows[0]['generation'] if rows and rows[0]['generation'] is not None else 0
+
+
+def bump_graph_generation():
+    # Mọi lần ingest / phân cụm / tóm tắt đều tăng generation -> cache câu trả lời cũ hết hiệu lực
+    rows = connection.graph.query("""
+        MERGE (m:GraphMeta {id: 'graph'})
+        SET m.generation = coalesce(m.generation, 0) + 1
+        RETURN m.generation as generation
+    """)
+    return rows[0]['generation']
+
+
+# Nhãn riêng của entity chỉ biết lúc chạy -> format(label=...) trước khi gửi
+ENTITY_MERGE_QUERY = """
+    MERGE (e:Entity {{id: $name}})
+    SET e:{label}, e.type = $type, e.desc = $desc
+"""
+
+RELATION_MERGE_QUERY = """
+    MATCH (a:Entity {id: $src}), (b:Entity {id: $tgt})
+    MERGE (a)-[r:CONNECTED_TO]->(b)
+    SET r.desc = $desc,
+        r.strength = toInteger($strength)
+"""
+
+
 #  1. INGESTION
+@profiled("run_ingestion")
 def run_ingestion(yaml_content):
-    import time
-    t1 = time.time()
     print("[1/3] Running Extraction...")
 
     prompt = PromptTemplate.from_template(GRAPH_EXTRACTION_PROMPT)
@@ -27,20 +70,22 @@ def run_ingestion(yaml_content):
 
 
     try:
-        result_text = chain.invoke({
-            "input_text": str(yaml_content),
-            "entity_types": "DEVICE,INTERFACE,IP_ADDRESS,PROTOCOL",
-            "tuple_delimiter": "|",
-            "record_delimiter": "\n",
-            "completion_delimiter": "<DONE>"
-        })
+        with stage("extraction"):
+            result_text = chain.invoke({
+                "input_text": str(yaml_content),
+                "entity_types": "DEVICE,INTERFACE,IP_ADDRESS,PROTOCOL",
+                "tuple_delimiter": "|",
+                "record_delimiter": "\n",
+                "completion_delimiter": "<DONE>"
+            })
 
         with open("log/index/resultindex.txt", "w", encoding="utf-8") as f:
             f.write(result_text)
 
     except Exception as e:
+        # Ném lại để pipeline không ghi nhận stage ingest là đã xong
         print(f"Extraction Failed: {e}")
-        return
+        raise
 
     entities = []
     relationships = []
@@ -91,66 +136,79 @@ def run_ingestion(yaml_content):
 
 
         # Gán nhãn chung :Entity và nhãn riêng
-        query = f"""
-            MERGE (e:Entity {{id: $name}})
-            SET e:{label}, e.type = $type, e.desc = $desc
-        """
-        connection.graph.query(query, {
-            "name": ent['name'],
-            "type": ent['type'],
-            "desc": ent['desc']
-        })
+        with stage("neo4j_write"):
+            connection.graph.query(ENTITY_MERGE_QUERY.format(label=label), {
+                "name": ent['name'],
+                "type": ent['type'],
+                "desc": ent['desc']
+            })
 
     # 2. Tạo Edges
     for rel in relationships:
-        connection.graph.query(
-            """
-            MATCH (a:Entity {id: $src}), (b:Entity {id: $tgt})
-            MERGE (a)-[r:CONNECTED_TO]->(b)
-            SET r.desc = $desc, 
-                r.strength = toInteger($strength)
-            """,
-            {
-                "src": rel['source'],
-                "tgt": rel['target'],
-                "desc": rel['desc'],
-                "strength": rel.get('strength', '1')
-            }
-        )
+        with stage("neo4j_write"):
+            connection.graph.query(
+                RELATION_MERGE_QUERY,
+                {
+                    "src": rel['source'],
+                    "tgt": rel['target'],
+                    "desc": rel['desc'],
+                    "strength": rel.get('strength', '1')
+                }
+            )
+
+    bump_graph_generation()
 
     #run_leiden()
     #run_clustering_louvain()
-    t2 = time.time()
-    print(f"Thời gian extract entities và realtionship: {t2-t1} (s)")
 
 
-def run_clustering_louvain():
-    import time
-    t1 = time.time()
-    print("[2/3] Running Louvain Algorithm (Client-side)...")
+LOUVAIN_RESOLUTION = 0
+LOUVAIN_SEED = 123
 
-    # 1. Tải Graph từ Neo4j về Python
+COMMUNITY_ASSIGN_QUERY = """
+    UNWIND $members as name
+    MATCH (e:Entity {id: name})
+    SET e.communityId = $cid
+"""
+
+
+def load_entity_graph():
     data = connection.graph.query("""
         MATCH (s:Entity)-[r:CONNECTED_TO]->(t:Entity)
         RETURN s.id as source, t.id as target
     """)
 
-    if not data:
-        print("Graph trống, bỏ qua bước phân cụm.")
-        return
-
-    # 2. Dựng đồ thị NetworkX
     G = nx.Graph()
     for row in data:
         G.add_edge(row['source'], row['target'])
+    return G
+
+
+@profiled("run_clustering_louvain")
+def run_clustering_louvain(incremental=False, changed_nodes=None, summarize=True):
+    """Trả về {"degraded": True} nếu Louvain lỗi và graph đang ở partition fallback, ngược lại None."""
+    if incremental:
+        return run_clustering_incremental(changed_nodes, summarize=summarize)
+
+    print("[2/3] Running Louvain Algorithm (Client-side)...")
+
+    # 1. Tải Graph từ Neo4j về Python
+    # 2. Dựng đồ thị NetworkX
+    G = load_entity_graph()
+
+    if G.number_of_nodes() == 0:
+        print("Graph trống, bỏ qua bước phân cụm.")
+        return
 
     print(f"   -> Loaded Graph: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges.")
 
     # 3. Chạy Louvain
+    degraded = False
     try:
         # Hàm này trả về list các set: [{node1, node2}, {node3, node4}...]
         # resolution=1.0 là mức độ tiêu chuẩn, tăng lên để cụm nhỏ hơn, giảm đi để cụm to hơn
-        communities = nx.community.louvain_communities(G, resolution=0, seed=123)
+        with stage("clustering"):
+            communities = nx.community.louvain_communities(G, resolution=LOUVAIN_RESOLUTION, seed=LOUVAIN_SEED)
 
         print(f"   -> Found {len(communities)} communities.")
         communities_list = [list(c) for c in communities]
@@ -161,127 +219,377 @@ def run_clustering_louvain():
         print("   -> Updating Neo4j...")
 
         # Reset communityId cũ
-        connection.graph.query("MATCH (e:Entity) REMOVE e.communityId")
+        connection.graph.query("MATCH (e:Entity) REMOVE e.communityId, e.dirty")
 
         # Duyệt và update
-        batch_queries = []
         for i, members in enumerate(communities):
             cid = str(i)
             # Chuyển set thành list để gửi vào query
             member_list = list(members)
 
             # Update batch cho nhanh
-            connection.graph.query("""
-                UNWIND $members as name
-                MATCH (e:Entity {id: name})
-                SET e.communityId = $cid
-            """, {"members": member_list, "cid": cid})
-
-        # Chuyển sang bước tóm tắt
-        run_summarization()
+            with stage("neo4j_write"):
+                connection.graph.query(COMMUNITY_ASSIGN_QUERY, {"members": member_list, "cid": cid})
 
     except Exception as e:
         print(f"Louvain Error: {e}")
         print("Fallback: Gán tất cả vào Community 0")
-        connection.graph.query("MATCH (e:Entity) SET e.communityId = '0'")
-        run_summarization()
+        connection.graph.query("MATCH (e:Entity) SET e.communityId = '0' REMOVE e.dirty")
+        degraded = True
+
+    bump_graph_generation()
+
+    # Chuyển sang bước tóm tắt (chỉ các cụm có hash thay đổi)
+    if summarize:
+        sync_community_reports()
+    return {"degraded": True} if degraded else None
+
+
+def run_clustering_incremental(changed_nodes=None, summarize=True):
+    """
+    Phân cụm lại cục bộ: giữ nguyên partition cũ, chỉ chạy Louvain trên các cụm
+    chứa node thay đổi (và hàng xóm của chúng).
+    """
+    print("[2/3] Running Incremental Louvain (warm-start)...")
+
+    G = load_entity_graph()
+    previous = {
+        r['id']: r['cid'] for r in connection.graph.query(
+            "MATCH (e:Entity) WHERE e.communityId IS NOT NULL RETURN e.id as id, e.communityId as cid")
+    }
+
+    if not previous:
+        print("   -> Chưa có partition cũ, chạy phân cụm đầy đủ.")
+        return run_clustering_louvain(summarize=summarize)
+
+    # Node thay đổi = truyền vào + đánh dấu dirty lúc ingest + node mới chưa có cụm
+    dirty = {
+        r['id'] for r in connection.graph.query("MATCH (e:Entity) WHERE e.dirty = true RETURN e.id as id")
+    }
+    changed = set(changed_nodes or []) | dirty | {n for n in G if n not in previous}
+    # Node không còn cạnh nào (bị xoá hoặc bị cô lập) -> rời cụm
+    removed = {n for n in previous if n not in G}
+
+    affected = set()
+    for n in changed:
+        if n in G:
+            affected.add(n)
+            affected.update(G.neighbors(n))
+
+    affected_cids = {previous[n] for n in affected | removed if n in previous}
+    region = {n for n in G if previous.get(n) in affected_cids} | affected
+    print(f"   -> {len(changed)} node thay đổi, phân cụm lại {len(region)}/{G.number_of_nodes()} node "
+          f"({len(affected_cids)} cụm bị ảnh hưởng).")
+
+    assignments = {}
+    if region:
+        with stage("clustering"):
+            parts = nx.community.louvain_communities(G.subgraph(region), resolution=LOUVAIN_RESOLUTION,
+                                                     seed=LOUVAIN_SEED)
+
+        # Giữ lại id cũ cho cụm mới có độ chồng lấn lớn nhất, còn lại cấp id mới
+        used_ids = set(previous.values()) - affected_cids
+        next_id = max([int(c) for c in previous.values() if str(c).isdigit()] + [-1]) + 1
+        for part in sorted(parts, key=len, reverse=True):
+            overlap = defaultdict(int)
+            for n in part:
+                if previous.get(n) in affected_cids and previous[n] not in used_ids:
+                    overlap[previous[n]] += 1
+
+            if overlap:
+                cid = max(overlap, key=lambda c: (overlap[c], c))
+            else:
+                cid = str(next_id)
+                next_id += 1
+            used_ids.add(cid)
+
+            for n in part:
+                if previous.get(n) != cid:
+                    assignments[n] = cid
+
+    print(f"   -> Updating Neo4j ({len(assignments)} node đổi cụm)...")
+    with stage("neo4j_write"):
+        if assignments:
+            connection.graph.query("""
+                UNWIND $rows as row
+                MATCH (e:Entity {id: row.id})
+                SET e.communityId = row.cid
+            """, {"rows": [{"id": n, "cid": c} for n, c in assignments.items()]})
 
+        if removed:
+            connection.graph.query("""
+                UNWIND $ids as id
+                MATCH (e:Entity {id: id})
+                REMOVE e.communityId
+            """, {"ids": list(removed)})
+
+        connection.graph.query("MATCH (e:Entity) WHERE e.dirty = true REMOVE e.dirty")
+    bump_graph_generation()
+
+    if summarize:
+        sync_community_reports()
+
+
+COMMUNITY_MEMBERS_QUERY = """
+    MATCH (d:Entity)
+    WHERE d.communityId IS NOT NULL AND ($cids IS NULL OR d.communityId IN $cids)
+    OPTIONAL MATCH (d)-[:CONNECTED_TO]-(n:Entity)
+    WITH d, collect(DISTINCT n.id) as neighbors
+    RETURN d.communityId as cid,
+           collect({id: d.id, type: d.type, desc: d.desc, neighbors: neighbors}) as members
+"""
+
+
+def fetch_community_members(cids=None):
+    # Lấy toàn bộ thành viên (kèm hàng xóm) theo từng cụm trong 1 truy vấn
+    rows = connection.graph.query(COMMUNITY_MEMBERS_QUERY, {"cids": cids})
+
+    return {r['cid']: sorted(r['members'], key=lambda m: m['id']) for r in rows}
+
+
+def community_hash(members):
+    # Hash theo thành viên + nội dung + cạnh: đổi 1 trong 3 thì cụm cần tóm tắt lại
+    h = hashlib.sha1()
+    for m in sorted(members, key=lambda m: m['id']):
+        h.update(json.dumps(
+            [m['id'], m.get('type'), m.get('desc'), sorted(m.get('neighbors') or [])],
+            ensure_ascii=False
+        ).encode("utf-8"))
+    return h.hexdigest()
+
+
+def sync_community_reports(build_index=True, checkpoint=None):
+    # So hash hiện tại với hash đã lưu trên Community, chỉ tóm tắt lại cụm thay đổi
+    hashes = {cid: community_hash(m) for cid, m in fetch_community_members().items()}
+    stored = {
+        r['cid']: r['hash'] for r in connection.graph.query(
+            "MATCH (c:Community) RETURN c.id as cid, c.hash as hash")
+    }
+
+    stale = [cid for cid in stored if cid not in hashes]
+    if stale:
+        connection.graph.query("MATCH (c:Community) WHERE c.id IN $ids DETACH DELETE c", {"ids": stale})
+
+    # Cạnh IN_COMMUNITY cũ của node đã chuyển cụm
+    connection.graph.query("""
+        MATCH (d:Entity)-[r:IN_COMMUNITY]->(c:Community)
+        WHERE d.communityId IS NULL OR d.communityId <> c.id
+        DELETE r
+    """)
 
-    t2 = time.time()
-    print(f"Louvain + sumary time: {t2-t1} (s)")
+    dirty = sorted(cid for cid, h in hashes.items() if stored.get(cid) != h)
+    print(f"   -> {len(dirty)}/{len(hashes)} cụm thay đổi, xoá {len(stale)} cụm cũ.")
 
+    written = []
+    if dirty:
+        written = run_summarization(cids=dirty, build_index=build_index, checkpoint=checkpoint)
+    elif build_index:
+        create_indices()
+    return dirty, written
 
 
-def run_summarization():
-    print("[3/3] Generating Community Reports (Batch Mode)...")
+def render_member(m):
+    return f"- [{m.get('type') or 'Device'}] {m['id']}: {m.get('desc') or ''}"
+
+
+def render_community_context(cid, members):
+    member_text = "\n".join([render_member(m) for m in members])
+    return f"\n--- COMMUNITY ID: {cid} ---\n" + member_text + "\n"
 
-    cids_result = connection.graph.query(
-        "MATCH (d:Entity) WHERE d.communityId IS NOT NULL RETURN distinct d.communityId as cid")
 
-    # Chuyển kết quả thành list các ID thực tế
-    all_cids = [r['cid'] for r in cids_result if r['cid'] is not None]
+def pack_communities(members_by_cid, cids, token_budget, overhead=0, max_items=None):
+    # Gom cụm theo token budget; cụm quá lớn bị cắt bớt thành viên rank thấp
+    def render(item):
+        return render_community_context(*item)
+
+    def trim(item, budget):
+        cid, members = item
+        header = count_tokens(render_community_context(cid, []))
+        return cid, trim_members_by_rank(members, budget - header, render_member)
+
+    items = [(cid, members_by_cid[cid]) for cid in cids]
+    return pack_by_token_budget(items, render, token_budget, trim=trim, overhead=overhead, max_items=max_items)
+
+
+# Ghi report và nối thành viên (tra theo communityId) vào node Community
+COMMUNITY_WRITE_QUERY = """
+    UNWIND $rows AS row
+    MERGE (c:Community {id: row.cid})
+    SET c.title = row.title,
+        c.summary = row.summary,
+        c.rating = row.rating,
+        c.rating_explanation = row.explanation,
+        c.findings = row.findings,
+        c.hash = row.hash,
+        c.embedding = null
+    WITH c, row
+    MATCH (d:Entity {communityId: row.cid})
+    MERGE (d)-[:IN_COMMUNITY]->(c)
+"""
+
+
+def run_summarization(cids=None, build_index=True, checkpoint=None):
+    print("[3/3] Generating Community Reports (Batch Mode)...")
+
+    # Lấy thành viên của tất cả các cụm trong 1 truy vấn (collect theo communityId)
+    members_by_cid = fetch_community_members(list(cids) if cids is not None else None)
+    all_cids = sorted(members_by_cid, key=lambda c: (len(str(c)), str(c)))
     print(f"all_cid:\n {all_cids}")
 
     if not all_cids:
         print(" -> Không tìm thấy Community nào.")
-        return
-
-    BATCH_SIZE = 4
-    chunks = [all_cids[i:i + BATCH_SIZE] for i in range(0, len(all_cids), BATCH_SIZE)]
-    print(f"   -> Tổng {len(all_cids)} cụm. Chia thành {len(chunks)} đợt xử lý.")
+        return []
+
+    token_budget = int(connection.cfg.get("SUMMARY_TOKEN_BUDGET", 6000))
+    max_per_call = int(connection.cfg.get("SUMMARY_MAX_COMMUNITIES_PER_CALL", 20))
+    max_concurrency = int(connection.cfg.get("SUMMARY_MAX_CONCURRENCY", 4))
+    max_attempts = int(connection.cfg.get("SUMMARY_MAX_ATTEMPTS", 3))
+
+    # Chia batch theo token budget thay vì số lượng cố định
+    batches = pack_communities(
+        members_by_cid, all_cids, token_budget,
+        overhead=count_tokens(BATCH_COMMUNITY_REPORT_PROMPT),
+        max_items=max_per_call
+    )
+    chunks = [[cid for cid, _ in batch] for batch in batches]
+    print(f"   -> Tổng {len(all_cids)} cụm. Chia thành {len(chunks)} đợt xử lý "
+          f"(budget {token_budget} tokens, song song tối đa {max_concurrency}).")
 
     prompt = PromptTemplate.from_template(BATCH_COMMUNITY_REPORT_PROMPT)
-    chain = prompt | connection.llm | JsonOutputParser()
-    all_findings = []
+    # Retry từng batch với exponential backoff (có jitter) khi LLM lỗi / trả JSON hỏng
+    retrying_chain = (prompt | connection.llm | JsonOutputParser()).with_retry(
+        stop_after_attempt=max_attempts,
+        wait_exponential_jitter=True
+    )
+
+    def summarize_batch(x):
+        with stage("summarization_batch"):
+            return retrying_chain.invoke(x)
+
+    chain = RunnableLambda(summarize_batch)
+    hashes = {cid: community_hash(m) for cid, m in members_by_cid.items()}
     full_reports_data = []
-
-    for i, chunk in enumerate(chunks):
-        print(f"   -> Processing Batch {i + 1}/{len(chunks)} (IDs: {chunk})...")
-
-        batch_context_text = ""
-        for cid in chunk:
-            members = connection.graph.query(
-                "MATCH (d:Entity {communityId: $cid}) RETURN d.id, d.type, d.desc",
-                {"cid": cid}
-            )
-            batch_context_text += f"\n--- COMMUNITY ID: {cid} ---\n"
-            member_text = "\n".join(
-                [f"- [{m.get('d.type', 'Device')}] {m['d.id']}: {m.get('d.desc', '')}" for m in members]
-            )
-            batch_context_text += member_text + "\n"
-
-        try:
-            reports_list = chain.invoke({
-                "input_text": batch_context_text
+    rows = []
+
+    inputs = [
+        {"input_text": "".join(render_community_context(cid, members) for cid, members in batch)}
+        for batch in batches
+    ]
+
+    # Resume: batch đã có kết quả trong checkpoint thì không gọi lại LLM
+    batch_keys = [hashlib.sha1(x["input_text"].encode("utf-8")).hexdigest() for x in inputs]
+    results = []
+    pending = []
+    for i, key in enumerate(batch_keys):
+        cached = checkpoint.get_batch(key) if checkpoint is not None else None
+        if cached is not None:
+            results.append((i, cached))
+        else:
+            pending.append(i)
+    if len(pending) < len(inputs):
+        print(f"   -> Resume: bỏ qua {len(inputs) - len(pending)} batch đã hoàn thành.")
+
+    def completed_batches():
+        yield from results
+        for j, out in chain.batch_as_completed(
+                [inputs[i] for i in pending], config={"max_concurrency": max_concurrency}, return_exceptions=True):
+            i = pending[j]
+            if checkpoint is not None and not isinstance(out, Exception):
+                checkpoint.record_batch(batch_keys[i], out)
+            yield i, out
+
+    for i, reports_list in completed_batches():
+        chunk = chunks[i]
+        if isinstance(reports_list, Exception):
+            print(f" Batch Error ({i + 1}/{len(chunks)}, IDs: {chunk}): {reports_list}")
+            continue
+
+        # Kiểm tra xem kết quả có phải là list
+        if isinstance(reports_list, dict):
+            reports_list = [reports_list]
+        full_reports_data.extend(reports_list)
+
+        for report in reports_list:
+            r_id = str(report.get('id'))
+
+            if r_id not in chunk:
+                print(f"Warning: LLM returned unknown ID {r_id}")
+                continue
+
+            rows.append({
+                "cid": r_id,
+                "title": report.get('title', f"Cluster {r_id}"),
+                "summary": report.get('summary', ''),
+                "rating": report.get('rating', 0),
+                "explanation": report.get('rating_explanation', ''),
+                "findings": json.dumps(report.get('findings', [])),
+                "hash": hashes.get(r_id)
             })
-            full_reports_data.extend(reports_list)
-
-            # Kiểm tra xem kết quả có phải là list
-            if isinstance(reports_list, dict):
-                reports_list = [reports_list]
-
-            for report in reports_list:
-                r_id = str(report.get('id'))
-
-                if r_id not in chunk:
-                    print(f"Warning: LLM returned unknown ID {r_id}")
-                    continue
-
-                connection.graph.query("""
-                    MERGE (c:Community {id: $cid})
-                    SET c.title = $title, 
-                        c.summary = $summary, 
-                        c.rating = $rating,
-                        c.rating_explanation = $explanation,
-                        c.findings = $findings
-                    WITH c
-                    MATCH (d:Entity {communityId: $cid})
-                    MERGE (d)-[:IN_COMMUNITY]->(c)
-                """, {
-                    "cid": r_id,
-                    "title": report.get('title', f"Cluster {r_id}"),
-                    "summary": report.get('summary', ''),
-                    "rating": report.get('rating', 0),
-                    "explanation": report.get('rating_explanation', ''),
-                    "findings": json.dumps(report.get('findings', []))
-                })
-
-                print(f"      -> Done Cluster {r_id}: {report.get('title')}")
-
-                if report.get('findings'):
-                    all_findings.extend(report.get('findings'))
-
-        except Exception as e:
-            print(f" Batch Error: {e}")
+            print(f"      -> Done Cluster {r_id}: {report.get('title')}")
+
+    # Ghi toàn bộ Community trong 1 lần UNWIND
+    if rows:
+        with stage("neo4j_write"):
+            connection.graph.query(COMMUNITY_WRITE_QUERY, {"rows": rows})
+    print(f"   -> Ghi {len(rows)}/{len(all_cids)} Community reports.")
+    if rows:
+        bump_graph_generation()
 
     os.makedirs("log", exist_ok=True)
     with open("log/index/reportsummary.json", "w", encoding="utf-8") as f:
         json.dump(full_reports_data, f, ensure_ascii=False, indent=2)
-    # 4. Tạo Index
-    create_indices()
+    # 4. Embed các report vừa sinh (community_index); create_indices đã gồm bước này
+    if build_index:
+        create_indices()
+    else:
+        create_community_index()
+    return [row["cid"] for row in rows]
+
+
+# Tăng khi đổi community_embedding_text -> các vector cũ được embed lại
+COMMUNITY_EMBEDDING_FORMAT = 1
+
+COMMUNITY_INDEX_QUERY = """
+    CREATE VECTOR INDEX community_index IF NOT EXISTS
+    FOR (c:Community) ON (c.embedding)
+    OPTIONS {indexConfig: {`vector.dimensions`: %d, `vector.similarity_function`: 'cosine'}}
+"""
+
+
+def community_embedding_text(c):
+    # Text dùng để embed report; mọi vector trong community_index đều sinh từ hàm này
+    return (f"\ntitle: {c.get('title') or ''}\nsummary: {c.get('summary') or ''}"
+            f"\nfindings: {c.get('findings') or ''}")
+
+
+def create_community_index():
+    # Nơi duy nhất ghi c.embedding: chỉ embed Community chưa có embedding (report mới / vừa tóm tắt lại)
+    try:
+        rows = connection.graph.query("""
+            MATCH (c:Community)
+            WHERE c.embedding IS NULL OR coalesce(c.embedding_format, 0) <> $format
+            RETURN c.id as id, c.title as title, c.summary as summary, c.findings as findings
+        """, {"format": COMMUNITY_EMBEDDING_FORMAT})
+        if rows:
+            vectors = connection.embeddings.embed_documents([community_embedding_text(r) for r in rows])
+            connection.graph.query("""
+                UNWIND $rows AS row
+                MATCH (c:Community {id: row.id})
+                SET c.embedding = row.embedding, c.embedding_format = $format
+            """, {"rows": [{"id": r['id'], "embedding": v} for r, v in zip(rows, vectors)],
+                  "format": COMMUNITY_EMBEDDING_FORMAT})
+
+        dims = connection.graph.query(
+            "MATCH (c:Community) WHERE c.embedding IS NOT NULL RETURN size(c.embedding) as dims LIMIT 1")
+        if dims:
+            connection.graph.query(COMMUNITY_INDEX_QUERY % dims[0]['dims'])
+        print(f"   -> Community Index: embed {len(rows)} report.")
+    except Exception as e:
+        print(f"Community Index Error: {e}")
 
 
 def create_indices():
+    create_community_index()
     try:
         Neo4jVector.from_existing_graph(
             embedding=connection.embeddings,
@@ -297,6 +605,8 @@ def create_indices():
     except Exception as e:
         print(f"Index Error: {e}")
 
+    # Vector đổi -> câu trả lời đã cache trước khi dựng lại index hết hiệu lực
+    bump_graph_generation()
     print("Build Complete!")
 
 
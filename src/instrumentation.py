@@ -0,0 +1,158 @@
+import contextvars
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler, BaseCallbackManager
+
+import src.metrics as metrics
+
+# Bản ghi của câu hỏi đang xử lý. Task con (asyncio) kế thừa context nên cùng ghi vào 1 bản ghi.
+_current = contextvars.ContextVar("query_record", default=None)
+
+
+class QueryRecord:
+    """Thời gian theo stage, số lượt gọi LLM / token và các nhãn (route...) của 1 câu hỏi."""
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.llm_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.labels = {}
+        # query id trong trace (src/tracing.py); None nếu câu hỏi không được lấy mẫu
+        self.trace_id = None
+
+    def to_dict(self):
+        return {
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            "llm_calls": self.llm_calls,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "query_id": self.trace_id,
+            **self.labels
+        }
+
+
+@contextmanager
+def track():
+    # Mở bản ghi mới cho câu hỏi trong context hiện tại
+    record = QueryRecord()
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def tracked():
+    # Dùng bản ghi đang mở (VD: batch runner đã track) hoặc mở bản ghi mới
+    record = _current.get()
+    if record is not None:
+        yield record
+        return
+    with track() as record:
+        yield record
+
+
+def current_record():
+    return _current.get()
+
+
+async def run_with(record, awaitable):
+    # Chạy awaitable (thường trong task riêng) với bản ghi cho trước
+    token = _current.set(record)
+    try:
+        return await awaitable
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    # Ghi vào histogram graphrag_stage_seconds và cộng dồn vào bản ghi của câu hỏi (nếu có)
+    record = _current.get()
+    t1 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t1
+        metrics.observe("graphrag_stage_seconds", elapsed, stage=name)
+        if record is not None:
+            record.stages[name] += elapsed
+
+
+def label(key, value):
+    record = _current.get()
+    if record is not None:
+        record.labels[key] = value
+
+
+def token_usage(response):
+    # usage_metadata của chat model (input/output_tokens); fallback llm_output["token_usage"]
+    input_tokens = output_tokens = 0
+    for generations in response.generations:
+        for g in generations:
+            usage = getattr(getattr(g, "message", None), "usage_metadata", None) or {}
+            input_tokens += usage.get("input_tokens", 0)
+            output_tokens += usage.get("output_tokens", 0)
+    if not input_tokens and not output_tokens:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        input_tokens = usage.get("prompt_tokens", 0)
+        output_tokens = usage.get("completion_tokens", 0)
+    return input_tokens, output_tokens
+
+
+class TokenCallback(BaseCallbackHandler):
+    """
+    Đếm lượt gọi LLM, token và latency vào metrics; cộng thêm vào bản ghi cho trước
+    hoặc bản ghi của câu hỏi đang chạy.
+    """
+
+    # Chạy ngay trong task gọi LLM để đọc đúng contextvar
+    run_inline = True
+
+    def __init__(self, record=None, count_metrics=True):
+        self.record = record
+        self.count_metrics = count_metrics
+        self.started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.started[run_id] = time.perf_counter()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.started.pop(run_id, None)
+        if self.count_metrics:
+            metrics.inc("graphrag_llm_errors_total")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        input_tokens, output_tokens = token_usage(response)
+        t1 = self.started.pop(run_id, None)
+        if self.count_metrics:
+            metrics.inc("graphrag_llm_calls_total")
+            metrics.inc("graphrag_llm_tokens_total", input_tokens, direction="input")
+            metrics.inc("graphrag_llm_tokens_total", output_tokens, direction="output")
+            if t1 is not None:
+                metrics.observe("graphrag_llm_seconds", time.perf_counter() - t1)
+
+        record = self.record or _current.get()
+        if record is None:
+            return
+        record.llm_calls += 1
+        record.input_tokens += input_tokens
+        record.output_tokens += output_tokens
+
+
+def instrument_llm(llm):
+    # Gắn callback thẳng vào model (giữ nguyên kiểu model); Runnable khác thì bọc with_config
+    callbacks = getattr(llm, "callbacks", None)
+    if isinstance(callbacks, list) and any(isinstance(cb, TokenCallback) for cb in callbacks):
+        return llm
+    if hasattr(llm, "callbacks") and not isinstance(callbacks, BaseCallbackManager):
+        llm.callbacks = [*(callbacks or []), TokenCallback()]
+        return llm
+    return llm.with_config(callbacks=[TokenCallback()])
@@ -1,9 +1,9 @@
 import sys
 import os
 from src.connection import init_connections
-from src.run_ingestion_rulebased import run_ingestion_test
-from src.graph import run_ingestion, run_clustering_louvain, run_ingestion
-from src.retrieval import global_search, local_search, router_search,  local_search_semantic
+from src.pipeline import run_indexing_pipeline
+from src.profiling import parse_cli as parse_profile_cli
+from src.retrieval import local_search, global_search_stream, local_search_stream, router_search_stream
 from src.test.repo_struct import run_ingestion_for_repo_struct
 import yaml
 from src.eval.eval_ragas import run_eval_pipeline
@@ -70,6 +70,27 @@ def load_yaml_data_dict():
         return None
 
 
+def print_stream(events):
+    # In status của retrieval, sau đó in từng token ngay khi LLM sinh ra
+    started = False
+    for event in events:
+        if event["type"] == "status":
+            print(f"   ... {event['message']}")
+        elif event["type"] == "route":
+            print(f"   -> Decision: {event['destination']} STRATEGY")
+        elif event["type"] == "token":
+            if not started:
+                print("\nTRẢ LỜI:")
+                started = True
+            print(event["content"], end="", flush=True)
+        elif event["type"] == "result":
+            r = event["result"]
+            route = (r.route or {}).get("destination", r.strategy.upper())
+            print(f"\n   [{route}] {r.latency:.2f}s | {r.llm_calls} lượt gọi LLM | "
+                  f"{r.input_tokens}/{r.output_tokens} tokens" + (" | cache" if r.cached else ""), end="")
+    print()
+
+
 def main():
     print("GRAPH RAG NETWORK SYSTEM ")
     init_connections()
@@ -92,39 +113,48 @@ def main():
             # Đọc dữ liệu từ file
             import_analysis_data = load_json_data(IMPORT_ANALYSIS_DATA_FILE_PATH)
             repo_structure_data = load_json_data(STRUCTURED_DATA_FILE_PATH)
-            run_ingestion_for_repo_struct(repo_structure_data, import_analysis_data)
+
+            def ingest_repo_struct(source):
+                return run_ingestion_for_repo_struct(source["repo_structure"], source["import_analysis"])
+
+            try:
+                run_indexing_pipeline(
+                    {"repo_structure": repo_structure_data, "import_analysis": import_analysis_data},
+                    ingest_fn=ingest_repo_struct
+                )
+            except Exception as e:
+                print(f"Pipeline dừng: {e}")
             #yaml_content = load_yaml_data()
 
 
             #if yaml_content:
-                #run_ingestion_for_repo_struct(repo_structure_data,import_analysis_data)
-
-                #run_ingestion_test(yaml_content)
+                #run_indexing_pipeline(yaml_content, ingest_fn=run_ingestion_test, incremental=True)
 
         elif choice == "2":
-            run_clustering_louvain()
+            mode = input("Chỉ phân cụm lại phần thay đổi (incremental)? (y/N): ").strip().lower()
+            try:
+                run_indexing_pipeline(incremental=(mode == "y"))
+            except Exception as e:
+                print(f"Pipeline dừng: {e}")
 
         elif choice == "3":
             q = input("\nNhập câu hỏi tổng quan (VD: Hệ thống có bao nhiêu cụm? Tình trạng chung thế nào?): ")
             if q.strip():
                 print("\nBot đang suy nghĩ (Global Strategy)...")
-                response = global_search(q)
-                print(f"\nTRẢ LỜI:\n{response}")
+                print_stream(global_search_stream(q))
 
         elif choice == "4":
             q = input("\nNhập câu hỏi chi tiết (VD: Router A kết nối với ai? IP của Switch B?): ")
             if q.strip():
                 print("\nBot đang suy nghĩ (Local Strategy)...")
                 #response = local_search_semantic(q)
-                response = local_search(q)
-                print(f"\nTRẢ LỜI:\n{response}")
+                print_stream(local_search_stream(q))
 
         elif choice == "5":
             q = input("\nNhập câu hỏi : ")
             if q.strip():
                 print("\nBot đang suy nghĩ (Local Strategy)...")
-                response = router_search(q)
-                print(f"\nTRẢ LỜI:\n{response}")
+                print_stream(router_search_stream(q))
 
 
         elif choice == "6":
@@ -137,26 +167,14 @@ def main():
             ground_truth = ground_truth_input if ground_truth_input else None
 
             print("\nBot đang suy nghĩ (Local Strategy)...")
-            response = local_search(q)
-            print(f"\nTRẢ LỜI:\n{response}")
+            result = local_search(q, return_result=True)
+            print(f"\nTRẢ LỜI:\n{result.answer}")
+            print(f"   ({len(result.context)} mục context, {result.latency:.2f}s, "
+                  f"{result.llm_calls} lượt gọi LLM, {result.input_tokens}/{result.output_tokens} tokens)")
 
+            # Context lấy thẳng từ kết quả search, không đọc lại file log
             print("\n[Ragas] Đang chuẩn bị dữ liệu đánh giá...")
-            context_file_path = "log/query/final_context_local.json"
-
-            try:
-                with open(context_file_path, "r", encoding="utf-8") as f:
-                    full_text = f.read()
-
-                if full_text.strip():
-                    context_used = [full_text]
-                else:
-                    context_used = ["Context rỗng"]
-
-            except Exception as e:
-                print(f"Lỗi đọc file context json: {e}")
-                context_used = ["Không tìm thấy file log context"]
-
-            run_eval_pipeline(q, response, context_used, ground_truth)
+            run_eval_pipeline(q, ground_truth=ground_truth, result=result)
 
         elif choice == "7":
             print("Thoát!")
@@ -170,4 +188,15 @@ if __name__ == "__main__":
     if not os.path.exists("data"):
         os.makedirs("data")
 
-    main()
\ No newline at end of file
+    # --profile[=cpu|mem|all]: ghi profile CPU / bộ nhớ của từng lần ingest / truy vấn vào log/profile/
+    argv = parse_profile_cli(sys.argv[1:])
+    if argv and argv[0] == "batch":
+        # Chế độ batch: python main.py batch --input questions.jsonl [--strategy ...] [--concurrency N]
+        from src.batch_runner import main as run_batch_cli
+        run_batch_cli(argv[1:])
+    elif argv and argv[0] == "cypher-profile":
+        # PROFILE các truy vấn Cypher chính: python main.py cypher-profile [--baseline report_cũ.json]
+        from src.cypher_profile import main as run_cypher_profile_cli
+        run_cypher_profile_cli(argv[1:])
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+# Bucket (giây) cho histogram latency: từ truy vấn Neo4j vài ms tới lượt tóm tắt vài phút
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    "graphrag_stage_seconds": "Thời gian từng stage (vector search, traversal, map, reduce, router, summarization batch, Neo4j write...)",
+    "graphrag_llm_seconds": "Thời gian mỗi lượt gọi LLM",
+    "graphrag_llm_calls_total": "Số lượt gọi LLM",
+    "graphrag_llm_tokens_total": "Số token LLM theo chiều input / output",
+    "graphrag_llm_errors_total": "Số lượt gọi LLM bị lỗi",
+    "graphrag_search_seconds": "Thời gian trả lời 1 câu hỏi theo strategy",
+}
+
+METRICS_DIR = "log/metrics"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        h = Histogram(self.buckets)
+        h.counts, h.sum, h.count = list(self.counts), self.sum, self.count
+        return h
+
+    def minus(self, other):
+        h = self.copy()
+        if other is not None:
+            h.counts = [a - b for a, b in zip(self.counts, other.counts)]
+            h.sum -= other.sum
+            h.count -= other.count
+        return h
+
+    def quantile(self, q):
+        # Ước lượng nội suy tuyến tính trong bucket (như histogram_quantile của Prometheus)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """Counter và histogram theo (tên, labels), an toàn giữa các thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        k = self.key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def observe(self, name, value, **labels):
+        k = self.key(name, labels)
+        with self.lock:
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = Histogram()
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t1, **labels)
+
+    def mark(self):
+        # Chụp trạng thái hiện tại để tính riêng phần của 1 lần chạy (summary(since=mark))
+        with self.lock:
+            return dict(self.counters), {k: h.copy() for k, h in self.histograms.items()}
+
+    def summary(self, since=None):
+        base_counters, base_histograms = since or ({}, {})
+        with self.lock:
+            counters = {k: v - base_counters.get(k, 0) for k, v in self.counters.items()}
+            histograms = {k: h.minus(base_histograms.get(k)) for k, h in self.histograms.items()}
+
+        out = {"counters": {}, "histograms": {}}
+        for (name, labels), v in sorted(counters.items()):
+            if v:
+                out["counters"].setdefault(name, {})[render_labels(labels) or "total"] = v
+        for (name, labels), h in sorted(histograms.items()):
+            if h.count:
+                out["histograms"].setdefault(name, {})[render_labels(labels) or "all"] = {
+                    "count": h.count,
+                    "sum": round(h.sum, 4),
+                    "avg": round(h.sum / h.count, 4),
+                    "p50": round(h.quantile(0.5), 4),
+                    "p95": round(h.quantile(0.95), 4),
+                    "p99": round(h.quantile(0.99), 4),
+                }
+        return out
+
+    def render_prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, h.copy()) for k, h in self.histograms.items())
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in counters:
+            header(name, "counter")
+            lines.append(f"{name}{prom_labels(labels)} {v}")
+        for (name, labels), h in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for le, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{prom_labels(labels + (('le', str(le)),))} {cumulative}")
+            lines.append(f"{name}_sum{prom_labels(labels)} {h.sum}")
+            lines.append(f"{name}_count{prom_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def render_labels(labels):
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+
+def prom_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+registry = MetricsRegistry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+def llm_cost(summary, cfg):
+    # Chi phí ước tính theo giá / 1M token (LLM_PRICE_INPUT_PER_1M, LLM_PRICE_OUTPUT_PER_1M)
+    tokens = summary["counters"].get("graphrag_llm_tokens_total", {})
+    price_in = float(cfg.get("LLM_PRICE_INPUT_PER_1M", 0) or 0)
+    price_out = float(cfg.get("LLM_PRICE_OUTPUT_PER_1M", 0) or 0)
+    return round((tokens.get("direction=input", 0) * price_in + tokens.get("direction=output", 0) * price_out) / 1e6, 6)
+
+
+def write_run_summary(run_name, since=None, cfg=None, extra=None, log=print):
+    """Ghi thống kê của 1 lần chạy (ingest, batch...) ra log/metrics/<run>_<thời điểm>.json và in tóm tắt."""
+    summary = registry.summary(since)
+    summary["run"] = run_name
+    summary["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    if cfg is not None:
+        summary["llm_cost"] = llm_cost(summary, cfg)
+    if extra:
+        summary.update(extra)
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{run_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    stages = summary["histograms"].get("graphrag_stage_seconds", {})
+    for name, h in sorted(stages.items(), key=lambda x: -x[1]["sum"]):
+        log(f"   {name.removeprefix('stage='):<24} n={h['count']:<5} total={h['sum']:.2f}s p50={h['p50']:.3f}s p95={h['p95']:.3f}s")
+    calls = summary["counters"].get("graphrag_llm_calls_total", {})
+    tokens = summary["counters"].get("graphrag_llm_tokens_total", {})
+    if calls:
+        log(f"   LLM: {sum(calls.values())} lượt gọi, {tokens.get('direction=input', 0)} input / "
+            f"{tokens.get('direction=output', 0)} output tokens"
+            + (f", ~${summary['llm_cost']}" if summary.get("llm_cost") else ""))
+    log(f"   Metrics: {path}")
+    return summary
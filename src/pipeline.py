@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import time
+
+import src.connection as connection
+import src.metrics as metrics
+from src.instrumentation import stage
+from src.profiling import profiled
+from src.graph import (run_clustering_louvain, sync_community_reports, create_indices,
+                       fetch_community_members, community_hash)
+from src.analytics import run_topology_analytics
+
+STATE_PATH = "log/index/pipeline_state.json"
+
+
+def hash_of(data):
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class PipelineState:
+    """
+    Trạng thái pipeline lưu ra file JSON: kết quả từng stage (kèm hash đầu vào)
+    và kết quả từng batch tóm tắt để chạy tiếp khi bị crash giữa chừng.
+    """
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.data = {"stages": {}, "batches": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                print(f"Cảnh báo: Không đọc được checkpoint ({e}), chạy lại từ đầu.")
+        self.data.setdefault("stages", {})
+        self.data.setdefault("batches", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, stage, input_hash):
+        # Stage degraded (VD phân cụm fallback) luôn được chạy lại ở lần sau
+        record = self.data["stages"].get(stage)
+        return bool(record) and record.get("input_hash") == input_hash and not record.get("degraded")
+
+    def record_stage(self, stage, input_hash, output=None, duration=0.0, degraded=False):
+        self.data["stages"][stage] = {
+            "input_hash": input_hash,
+            "output": output,
+            "duration": round(duration, 3),
+            "degraded": degraded,
+            "completed_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        self.save()
+
+    # Checkpoint theo batch (dùng trong run_summarization)
+    def get_batch(self, key):
+        return self.data["batches"].get(key)
+
+    def record_batch(self, key, result):
+        self.data["batches"][key] = result
+        self.save()
+
+    def clear_batches(self):
+        self.data["batches"] = {}
+        self.save()
+
+
+def graph_fingerprint():
+    rows = connection.graph.query("""
+        MATCH (s:Entity)-[:CONNECTED_TO]->(t:Entity)
+        RETURN s.id as source, t.id as target
+    """)
+    return hash_of(sorted([r['source'], r['target']] for r in rows))
+
+
+def community_fingerprint():
+    return hash_of({cid: community_hash(m) for cid, m in fetch_community_members().items()})
+
+
+def device_fingerprint():
+    rows = connection.graph.query("MATCH (e:Entity {type: 'DEVICE'}) RETURN e.id as id, e.infor as infor")
+    return hash_of(sorted([r['id'], r['infor']] for r in rows))
+
+
+@profiled("index_pipeline")
+def run_indexing_pipeline(source=None, ingest_fn=None, incremental=False, force=False, log=print):
+    """
+    Ingest -> Louvain -> Topology analytics -> Summarization -> Index.
+    Stage nào có hash đầu vào không đổi so với lần chạy trước thì bỏ qua;
+    stage tóm tắt chạy tiếp từ batch cuối cùng đã hoàn thành.
+    """
+    t1 = time.time()
+    mark = metrics.registry.mark()
+    state = PipelineState()
+    if force:
+        state.data["stages"] = {}
+
+    def run_stage(name, input_hash, fn):
+        if state.is_done(name, input_hash):
+            log(f"[Pipeline] {name}: đầu vào không đổi, bỏ qua.")
+            return state.data["stages"][name].get("output"), False
+
+        log(f"[Pipeline] {name}: đang chạy...")
+        s1 = time.time()
+        with stage(f"pipeline_{name}"), profiled(f"pipeline_{name}"):
+            output = fn()
+        degraded = isinstance(output, dict) and bool(output.get("degraded"))
+        if degraded:
+            log(f"[Pipeline] {name}: hoàn tất ở chế độ degraded, lần chạy sau sẽ chạy lại.")
+        state.record_stage(name, input_hash, output, time.time() - s1, degraded=degraded)
+        return output, True
+
+    # 1. INGEST
+    if source is not None and ingest_fn is not None:
+        ingest_hash = hash_of({"fn": ingest_fn.__name__, "source": source})
+        run_stage("ingest", ingest_hash, lambda: ingest_fn(source))
+
+    # 2. CLUSTER (đầu vào = cấu trúc graph)
+    def cluster():
+        result = run_clustering_louvain(incremental=incremental, summarize=False) or {}
+        return {"communities": community_fingerprint(), "degraded": bool(result.get("degraded"))}
+
+    run_stage("cluster", graph_fingerprint(), cluster)
+
+    # 3. ANALYTICS (đầu vào = cấu hình các device)
+    run_stage("analytics", device_fingerprint(), run_topology_analytics)
+
+    # 4. SUMMARIZE (đầu vào = hash nội dung các cộng đồng)
+    def summarize():
+        dirty, written = sync_community_reports(build_index=False, checkpoint=state)
+        failed = sorted(set(dirty) - set(written))
+        if failed:
+            # Không ghi nhận stage -> lần chạy sau resume từ các batch đã xong
+            raise RuntimeError(f"{len(failed)} cụm tóm tắt lỗi ({failed}). Chạy lại pipeline để tiếp tục.")
+        state.clear_batches()
+        return {"summarized": written}
+
+    run_stage("summarize", community_fingerprint(), summarize)
+
+    # 5. INDEX (Neo4jVector chỉ embed các node chưa có embedding)
+    index_hash = hash_of([state.data["stages"].get(s, {}).get("input_hash") for s in ("ingest", "cluster", "summarize")])
+
+    def index():
+        create_indices()
+        return None
+
+    run_stage("index", index_hash, index)
+
+    t2 = time.time()
+    log(f"[Pipeline] Hoàn tất sau {t2 - t1:.2f}s")
+    metrics.write_run_summary("index", since=mark, cfg=connection.cfg, log=log)
@@ -0,0 +1,251 @@
+"""
+Profiling theo yêu cầu cho ingestion và truy vấn.
+
+Bật bằng biến môi trường hoặc CLI (python main.py --profile[=cpu|mem|all]):
+
+    GRAPHRAG_PROFILE=all python main.py
+    GRAPHRAG_PROFILER=pyinstrument   # auto (mặc định: pyinstrument nếu đã cài, không thì cProfile) | cprofile
+    GRAPHRAG_PROFILE_TOP=25          # số hotspot in ra
+
+Mỗi lần chạy ghi log/profile/<tên>_<thời điểm>.prof (cProfile, mở bằng snakeviz) hoặc .html (pyinstrument)
+kèm file .txt tóm tắt: top hotspot CPU, top dòng cấp phát bộ nhớ và peak memory của từng phần con
+(run_ingestion_test, run_clustering_louvain...). Tắt thì profiled() chỉ kiểm tra 1 biến.
+
+Phiên profile gắn với thread mở nó: profiled() ở thread khác (VD truy vấn trên loop nền trong lúc
+ingest) mở phiên riêng chứ không thành phần con. CPU profiler (cả cProfile lẫn pyinstrument) chỉ đo
+thread của phiên; việc chạy ở thread khác (worker tóm tắt, thread pool gọi LLM) chỉ hiện là thời gian chờ.
+"""
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_DIR = "log/profile"
+MODES = {"1": {"cpu", "mem"}, "all": {"cpu", "mem"}, "cpu": {"cpu"}, "mem": {"mem"}}
+
+_modes = MODES.get(os.environ.get("GRAPHRAG_PROFILE", "").strip().lower(), set())
+_lock = threading.Lock()
+_sessions = {}  # thread id -> ProfileSession ngoài cùng của thread đó
+
+
+def enable(mode="all"):
+    global _modes
+    _modes = MODES.get(str(mode).strip().lower(), set())
+
+
+def enabled():
+    return bool(_modes)
+
+
+def parse_cli(argv):
+    # Tách --profile / --profile=<mode> khỏi argv, trả về argv còn lại
+    rest = []
+    for arg in argv:
+        if arg == "--profile":
+            enable("all")
+        elif arg.startswith("--profile="):
+            enable(arg.split("=", 1)[1])
+        else:
+            rest.append(arg)
+    return rest
+
+
+def top_n():
+    return int(os.environ.get("GRAPHRAG_PROFILE_TOP", 25))
+
+
+class CpuProfiler:
+    """pyinstrument (sampling) nếu có, ngược lại cProfile."""
+
+    def __init__(self):
+        self.kind = "cprofile"
+        choice = os.environ.get("GRAPHRAG_PROFILER", "auto").lower()
+        if choice in ("auto", "pyinstrument"):
+            try:
+                from pyinstrument import Profiler
+                self.profiler = Profiler(async_mode="disabled")
+                self.kind = "pyinstrument"
+            except ImportError:
+                if choice == "pyinstrument":
+                    print("pyinstrument chưa được cài, dùng cProfile.")
+        if self.kind == "cprofile":
+            self.profiler = cProfile.Profile()
+
+    def start(self):
+        if self.kind == "pyinstrument":
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.kind == "pyinstrument":
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+
+    def save(self, base):
+        if self.kind == "pyinstrument":
+            path = f"{base}.html"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.profiler.output_html())
+            return path, self.profiler.output_text(unicode=True, color=False)
+
+        path = f"{base}.prof"
+        self.profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(top_n())
+        return path, out.getvalue()
+
+
+class ProfileSession:
+    """
+    1 lần profile ngoài cùng. Các profiled() lồng bên trong chỉ đo thời gian và peak memory,
+    gộp theo tên (chạy song song thì peak của phần con là gần đúng).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.cpu = CpuProfiler() if "cpu" in _modes else None
+        self.mem = "mem" in _modes
+        self.started_tracemalloc = False
+        self.sections = {}
+        self.stack = []
+        self.peak_floor = 0
+        self.t1 = None
+        self.thread = threading.current_thread().name
+
+    def start(self):
+        if self.mem and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.started_tracemalloc = True
+        self.t1 = time.perf_counter()
+        if self.cpu is not None:
+            try:
+                self.cpu.start()
+            except ValueError as e:
+                # Python 3.12+: cProfile không chạy được khi thread khác đang có phiên profile
+                print(f"Không bật được CPU profiler cho {self.name}: {e}")
+                self.cpu = None
+
+    def raise_floor(self, peak):
+        # Peak đã thấy trước khi reset_peak phải được tính cho mọi phần đang mở và cho cả phiên
+        self.peak_floor = max(self.peak_floor, peak)
+        for frame in self.stack:
+            frame["floor"] = max(frame["floor"], peak)
+
+    @contextmanager
+    def section(self, name):
+        tracing_mem = tracemalloc.is_tracing()
+        frame = {"name": name, "floor": 0, "depth": len(self.stack)}
+        if tracing_mem:
+            self.raise_floor(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.stack.append(frame)
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t1
+            self.stack.remove(frame)
+            peak = None
+            if tracing_mem and tracemalloc.is_tracing():
+                peak = max(tracemalloc.get_traced_memory()[1], frame["floor"])
+                self.raise_floor(peak)
+            s = self.sections.setdefault(name, {"depth": frame["depth"], "count": 0, "seconds": 0.0, "peak": None})
+            s["count"] += 1
+            s["seconds"] += elapsed
+            if peak is not None:
+                s["peak"] = max(s["peak"] or 0, peak)
+
+    def stop(self):
+        if self.cpu is not None:
+            self.cpu.stop()
+        elapsed = time.perf_counter() - self.t1
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{self.name.replace(':', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        lines = [f"PROFILE {self.name}: {elapsed:.2f}s (thread {self.thread})"]
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ])
+            lines.append(f"Memory: peak {max(peak, self.peak_floor) / 2**20:.1f} MiB, còn giữ {current / 2**20:.1f} MiB")
+            lines.append(f"\nTop {top_n()} dòng cấp phát (còn giữ lúc kết thúc):")
+            for stat in snapshot.statistics("lineno")[:top_n()]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size / 2**10:10.1f} KiB  {stat.count:7d} blocks  {frame.filename}:{frame.lineno}")
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+        if self.sections:
+            lines.append("\nPhần con:")
+            for name, sec in self.sections.items():
+                peak_str = f", peak {sec['peak'] / 2**20:.1f} MiB" if sec["peak"] is not None else ""
+                label = "  " * sec["depth"] + name
+                lines.append(f"  {label:<36} x{sec['count']:<4} {sec['seconds']:8.2f}s{peak_str}")
+
+        if self.cpu is not None:
+            path, hotspots = self.cpu.save(base)
+            lines.append(f"\nTop {top_n()} hotspot CPU ({self.cpu.kind}, đầy đủ: {path}):")
+            lines.append(f"(Chỉ đo thread {self.thread}; việc chạy ở thread khác như worker tóm tắt, "
+                         f"thread pool gọi LLM chỉ hiện là thời gian chờ.)")
+            lines.append(hotspots)
+
+        report = "\n".join(lines)
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write(report)
+        print(report if len(report) < 20000 else report[:20000] + "\n...")
+        print(f"Profile: {base}.txt")
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profile đoạn code nếu profiling đang bật. Lồng nhau (trong cùng thread) thì chỉ phiên ngoài cùng
+    chạy CPU profiler, phiên trong được ghi thành 1 phần con (thời gian + peak memory). Dùng được như decorator.
+    """
+    if not _modes:
+        yield
+        return
+
+    key = threading.get_ident()
+    with _lock:
+        session = _sessions.get(key)
+        outer = session is None
+        if outer:
+            session = _sessions[key] = ProfileSession(name)
+            session.start()
+
+    if not outer:
+        with session.section(name):
+            yield
+        return
+
+    try:
+        yield
+    finally:
+        with _lock:
+            _sessions.pop(key, None)
+        session.stop()
+
+
+async def _profiled_stream(name, agen):
+    with profiled(name):
+        async for event in agen:
+            yield event
+
+
+def profile_stream(name, agen):
+    """Bọc async generator (stream truy vấn) trong profiled(); tắt profiling thì trả nguyên agen."""
+    if not _modes:
+        return agen
+    return _profiled_stream(name, agen)
@@ -25,4 +25,35 @@ Example Output:
         {{"description": "The system uses OSPF for routing.", "score": 50}}
     ]
 }}
-"""
\ No newline at end of file
+"""
+
+MULTI_MAP_SYSTEM_PROMPT = """
+---Role---
+You are a helpful assistant answering several user questions about a network system based on the provided Community Reports.
+
+---Goal---
+For EACH question below, analyze the provided community reports (chunks) and identify any key points, findings, or specific details that are relevant to that question.
+Assign a relevance score (0-100) to each point based on how well it answers that question.
+Only include points that are relevant to the question they are listed under. A question may have an empty list of points.
+
+---Input Data---
+User Questions:
+{questions}
+
+Community Reports (Context):
+{context_data}
+
+---Output Format---
+Return a single JSON object with a list of "answers", one entry per question.
+Each entry should have:
+- "question_id": The ID of the question (e.g. "Q1").
+- "points": A list of points, each with "description" (a concise statement of the finding) and "score" (0-100).
+
+Example Output:
+{{
+    "answers": [
+        {{"question_id": "Q1", "points": [{{"description": "Spine Router 1 is the only uplink of Leaf 2.", "score": 90}}]}},
+        {{"question_id": "Q2", "points": []}}
+    ]
+}}
+"""
@@ -29,4 +29,49 @@ Example Output:
 {{
     "destination": "LOCAL"
 }}
-"""
\ No newline at end of file
+"""
+
+# Dữ liệu cho router cục bộ (không gọi LLM): keyword + câu hỏi mẫu đã gán nhãn
+ROUTER_KEYWORDS = {
+    "GLOBAL": [
+        "overview", "summary", "summarize", "architecture", "topology", "health", "cluster", "clusters",
+        "communities", "community", "general status", "risk", "risks", "single point of failure", "spof",
+        "redundancy", "overall", "whole network", "entire", "design",
+        "tổng quan", "tóm tắt", "kiến trúc", "cấu trúc", "sức khỏe", "tình trạng chung", "cụm", "cộng đồng",
+        "rủi ro", "điểm đơn thất bại", "dự phòng", "toàn bộ", "toàn hệ thống", "hệ thống có bao nhiêu",
+    ],
+    "LOCAL": [
+        "ip address", "ip of", "interface", "neighbors", "neighbor", "connected to", "connection between",
+        "path", "trace", "next-hop", "gateway", "route to", "mtu of", "vlan id", "impact of failure",
+        "địa chỉ ip", "ip của", "kết nối với", "đường đi", "hàng xóm", "gateway của",
+        "định tuyến tới", "bị hỏng",
+    ],
+}
+
+ROUTER_EXAMPLES = {
+    "GLOBAL": [
+        "How is the network designed?",
+        "What are the main communities in the network?",
+        "Are there any single points of failure in the architecture?",
+        "Summarize the role of the Spine routers.",
+        "Give me an overview of the network health.",
+        "What are the biggest risks in the current topology?",
+        "Is the MTU configuration consistent across the network?",
+        "Hệ thống có điểm đơn thất bại (SPOF) nào không?",
+        "Hệ thống có bao nhiêu cụm? Tình trạng chung thế nào?",
+        "Tóm tắt kiến trúc mạng hiện tại.",
+        "Mức độ dự phòng của hệ thống ra sao?",
+    ],
+    "LOCAL": [
+        "What is the IP address of Compute Leaf 1?",
+        "Who is connected to interface eth0 of Spine 1?",
+        "If Router A fails, which servers lose connectivity?",
+        "Trace the path from Server X to Internet.",
+        "Which interfaces does Storage Node 2 have?",
+        "What is the next-hop for 10.0.0.0/8 on Leaf 3?",
+        "Router A kết nối với ai?",
+        "IP của Switch B là gì?",
+        "Interface bond0 của Compute 1 có MTU bao nhiêu?",
+        "Nếu Spine 1 hỏng thì Leaf 2 còn đường đi ra Internet không?",
+    ],
+}
@@ -0,0 +1,38 @@
+"""
+Prompt trả lời câu hỏi về độ tin cậy topology (SPOF, bridge, ECMP, MTU) từ các TopologyFact
+đã tính sẵn lúc index (src/analytics.py).
+"""
+
+# Từ khoá -> loại fact cần lấy
+TOPOLOGY_KEYWORDS = {
+    "SPOF": ["spof", "single point", "điểm đơn", "articulation", "điểm chết"],
+    "BRIDGE": ["bridge", "single link", "only link", "link đơn", "cầu nối", "đường duy nhất"],
+    "ECMP": ["ecmp", "equal cost", "equal-cost", "multipath", "load balanc", "cân bằng tải"],
+    "FAILOVER_ROUTE": ["failover", "backup route", "route dự phòng"],
+    "MTU_MISMATCH": ["mtu mismatch", "lệch mtu", "mtu không khớp", "mtu khác nhau", "jumbo", "fragment"],
+    "ISOLATED": ["isolated", "cô lập", "unreachable", "không kết nối"],
+}
+
+# Câu hỏi chung về dự phòng -> lấy cả nhóm fact liên quan
+REDUNDANCY_KEYWORDS = ["redundan", "dự phòng", "resilien", "high availability", "độ sẵn sàng", "reliab", "tin cậy"]
+REDUNDANCY_KINDS = ["SPOF", "BRIDGE", "ECMP", "FAILOVER_ROUTE", "ISOLATED"]
+
+TOPOLOGY_FACTS_PROMPT = """
+---Role---
+You are a Network Infrastructure AI Assistant specializing in topology resilience analysis.
+
+---Goal---
+Answer the user's question using the topology facts below. They were computed exactly from the device
+configurations (graph algorithms over the device-to-device link graph), so treat them as ground truth.
+Explain the consequences briefly and suggest remediation where relevant.
+If the facts do not cover the question, say so instead of guessing.
+Answer in the same language as the question.
+
+---Topology Facts---
+{facts}
+
+---Question---
+{question}
+
+---Answer---
+"""
@@ -0,0 +1,269 @@
+"""
+Chọn LLM / embedding theo config.yml:
+
+    LLM_PROVIDER: gemini | fake
+    EMBEDDING_PROVIDER: gemini | fake
+
+"fake" chạy hoàn toàn offline và tất định (cùng prompt -> cùng output, cùng độ trễ), dùng cho
+benchmark, profiling, load test. FakeGraphRAGChatModel nhận dạng prompt để trả về đúng định dạng
+mà parser chờ: tuple extraction, JSON community report, map points, multi-map answers, router.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+
+import yaml
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from src.batching import count_tokens
+from src.prompt.query.router_search import ROUTER_KEYWORDS
+
+GEMINI_LLM_MODEL = "gemini-2.5-flash"
+GEMINI_EMBEDDING_MODEL = "models/text-embedding-004"
+
+INTERFACE_SECTIONS = {"ethernets": "INTERFACE", "bonds": "BOND", "vlans": "VLAN", "bridges": "BRIDGE"}
+NODE_HEADER = re.compile(r"#\s*NODE\s*\d+\s*:\s*([^(\n]+)")
+COMMUNITY_HEADER = re.compile(r"--- COMMUNITY ID: (\S+) ---")
+MEMBER_LINE = re.compile(r"^- \[([^\]]*)\] ([^:]+):", re.M)
+
+
+def stable_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def create_llm(cfg, provider=None):
+    provider = (provider or cfg.get("LLM_PROVIDER", "gemini")).lower()
+    if provider == "fake":
+        return FakeGraphRAGChatModel(
+            latency=float(cfg.get("FAKE_LLM_LATENCY", 0.5)),
+            jitter=float(cfg.get("FAKE_LLM_JITTER", 0.2)),
+            tokens_per_second=float(cfg.get("FAKE_LLM_TOKENS_PER_SECOND", 0)),
+            seed=int(cfg.get("FAKE_SEED", 0)),
+        )
+    if provider == "gemini":
+        if not cfg.get("GOOGLE_API_KEY"):
+            raise ValueError("Thiếu GOOGLE_API_KEY trong file config.yml")
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model=GEMINI_LLM_MODEL, google_api_key=cfg["GOOGLE_API_KEY"], temperature=0)
+    raise ValueError(f"LLM_PROVIDER không hợp lệ: {provider} (gemini | fake)")
+
+
+def create_embeddings(cfg, provider=None):
+    provider = (provider or cfg.get("EMBEDDING_PROVIDER", "gemini")).lower()
+    if provider == "fake":
+        return HashEmbeddings(size=int(cfg.get("FAKE_EMBEDDING_SIZE", 768)), seed=int(cfg.get("FAKE_SEED", 0)))
+    if provider == "gemini":
+        if not cfg.get("GOOGLE_API_KEY"):
+            raise ValueError("Thiếu GOOGLE_API_KEY trong file config.yml")
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+        return GoogleGenerativeAIEmbeddings(model=GEMINI_EMBEDDING_MODEL, google_api_key=cfg["GOOGLE_API_KEY"])
+    raise ValueError(f"EMBEDDING_PROVIDER không hợp lệ: {provider} (gemini | fake)")
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Feature hashing trên các từ (và cặp từ liền nhau), chuẩn hoá L2: cùng text -> cùng vector,
+    text có nhiều từ chung -> cosine cao, nên vector search / cache / router vẫn cho kết quả có nghĩa.
+    """
+
+    def __init__(self, size=768, seed=0):
+        self.size = size
+        self.seed = seed
+
+    def embed_query(self, text):
+        vector = [0.0] * self.size
+        words = re.findall(r"\w+", (text or "").lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = stable_hash(f"{self.seed}:{feature}")
+            vector[h % self.size] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        if not norm:
+            # Text rỗng: vector cố định khác 0 để cosine không chia cho 0
+            vector[0] = norm = 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+
+def fake_extraction(text):
+    # Tách từng document YAML, tên thiết bị lấy từ comment "# NODE n: <tên>"
+    records = []
+    for n, doc in enumerate(re.split(r"^---\s*$", text, flags=re.M)):
+        if not doc.strip():
+            continue
+        header = NODE_HEADER.search(doc)
+        device = re.sub(r"\W+", "_", header.group(1).strip()).upper() if header else f"DEVICE_{n + 1:02d}"
+        try:
+            network = (yaml.safe_load(doc) or {}).get("network") or {}
+        except (yaml.YAMLError, AttributeError):
+            network = {}
+        records.append(("entity", device, "DEVICE", f"Network device {device}."))
+        for section, iface_type in INTERFACE_SECTIONS.items():
+            for name, conf in (network.get(section) or {}).items():
+                conf = conf or {}
+                iface = f"{device}_{str(name).upper()}"
+                mtu = f" Configured with MTU {conf['mtu']}." if conf.get("mtu") else ""
+                records.append(("entity", iface, iface_type, f"{iface_type.title()} {name} on {device}.{mtu}"))
+                records.append(("relationship", device, iface, "HAS_INTERFACE", "10"))
+                for address in conf.get("addresses") or []:
+                    records.append(("entity", str(address), "IP_ADDRESS", f"IP address {address} on {iface}."))
+                    records.append(("relationship", iface, str(address), "HAS_IP", "8"))
+        for route in network.get("routes") or []:
+            if isinstance(route, dict) and route.get("to"):
+                records.append(("entity", str(route["to"]), "IP_ADDRESS", "Destination Network Subnet."))
+                records.append(("relationship", device, str(route["to"]), f"ROUTES_TO via {route.get('via')}", "6"))
+    return "\n".join("|".join(r) for r in records) + "\n<DONE>"
+
+
+def fake_community_reports(text):
+    reports = []
+    sections = COMMUNITY_HEADER.split(text)
+    # split với 1 group -> [trước, cid1, nội dung1, cid2, nội dung2, ...]
+    for cid, body in zip(sections[1::2], sections[2::2]):
+        members = MEMBER_LINE.findall(body)
+        devices = [m for t, m in members if t.strip().upper() == "DEVICE"] or [m for _, m in members]
+        head = devices[0].strip() if devices else f"Cluster {cid}"
+        rating = stable_hash(f"community:{cid}:{len(members)}") % 60 + 30
+        reports.append({
+            "id": cid,
+            "title": f"{head} cluster",
+            "summary": f"Community {cid} groups {len(members)} entities around {', '.join(d.strip() for d in devices[:3]) or head}.",
+            "rating": rating,
+            "rating_explanation": f"{len(devices)} devices, {len(members) - len(devices)} interfaces / addresses.",
+            "findings": [f"{m.strip()} ({t.strip() or 'Device'}) belongs to community {cid}." for t, m in members[:5]],
+        })
+    return json.dumps(reports, ensure_ascii=False)
+
+
+def fake_points(context, key):
+    # Lấy vài dòng có nội dung trong context làm point, điểm số tất định theo key
+    lines = [l.strip(" -*") for l in context.splitlines() if len(l.strip()) > 20]
+    if not lines:
+        return []
+    start = stable_hash(key) % len(lines)
+    picked = [lines[(start + i) % len(lines)] for i in range(min(3, len(lines)))]
+    return [{"description": p[:200], "score": 30 + stable_hash(f"{key}:{p}") % 71} for p in picked]
+
+
+def section_after(text, marker):
+    i = text.find(marker)
+    return text[i + len(marker):] if i >= 0 else text
+
+
+def fake_router(prompt):
+    match = re.search(r"(?:User Question|Question)\s*:\s*(.+)", prompt)
+    question = match.group(1).lower() if match else ""
+    global_hit = any(re.search(r"\b" + re.escape(k) + r"\b", question) for k in ROUTER_KEYWORDS["GLOBAL"])
+    destination = "GLOBAL" if question and global_hit else "LOCAL"
+    return json.dumps({"destination": destination})
+
+
+def fake_response(prompt):
+    """Output giả nhưng đúng định dạng cho từng loại prompt của pipeline."""
+    if "identify all entities and relationships" in prompt:
+        return fake_extraction(section_after(section_after(prompt, "-Real Data-"), "Text:").split("######")[0])
+    if "COMMUNITY ID:" in prompt and "generate a report" in prompt:
+        return fake_community_reports(section_after(prompt, "Input Data:"))
+    if '"answers"' in prompt and "question_id" in prompt:
+        questions = section_after(prompt, "User Questions:").split("Community Reports")[0]
+        context = section_after(prompt, "Community Reports (Context):").split("---Output Format---")[0]
+        qids = dict.fromkeys(re.findall(r"\bQ\d+\b", questions))
+        return json.dumps({"answers": [{"question_id": q, "points": fake_points(context, f"{q}:{questions}")}
+                                       for q in qids]}, ensure_ascii=False)
+    if '"points"' in prompt:
+        question = section_after(prompt, "User Question:").split("Community Reports")[0]
+        context = section_after(prompt, "Community Reports (Context):").split("---Output Format---")[0]
+        return json.dumps({"points": fake_points(context, question)}, ensure_ascii=False)
+    if '"destination"' in prompt:
+        return fake_router(prompt)
+    # Reduce / local answer / fast path polish / topology facts: câu trả lời văn bản
+    lines = [l.strip(" -*") for l in prompt.splitlines() if len(l.strip()) > 20]
+    picked = lines[-3:] if lines else ["No data."]
+    return "Based on the provided data:\n" + "\n".join(f"- {l[:200]}" for l in picked)
+
+
+class FakeGraphRAGChatModel(BaseChatModel):
+    """
+    Chat model giả, tất định: output theo fake_response(), độ trễ = latency ± jitter
+    (+ output_tokens / tokens_per_second) với jitter sinh từ hash của prompt.
+    """
+    latency: float = 0.5
+    jitter: float = 0.2
+    tokens_per_second: float = 0.0
+    seed: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-graphrag"
+
+    @property
+    def _identifying_params(self):
+        return {"latency": self.latency, "jitter": self.jitter, "tokens_per_second": self.tokens_per_second}
+
+    @staticmethod
+    def render(messages):
+        return "\n".join(str(m.content) for m in messages)
+
+    def plan(self, messages):
+        prompt = self.render(messages)
+        text = fake_response(prompt)
+        rng = random.Random(stable_hash(f"{self.seed}:{prompt}"))
+        usage = {"input_tokens": count_tokens(prompt), "output_tokens": count_tokens(text)}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        delay = max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+        if self.tokens_per_second > 0:
+            delay += usage["output_tokens"] / self.tokens_per_second
+        return text, usage, delay
+
+    @staticmethod
+    def chunks(text):
+        return re.findall(r"\S+\s*|\s+", text)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text, usage, delay = self.plan(messages)
+        time.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        text, usage, delay = self.plan(messages)
+        await asyncio.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Độ trễ chia đều: nửa trước token đầu, nửa còn lại rải cho các token
+        text, usage, delay = self.plan(messages)
+        parts = self.chunks(text)
+        time.sleep(delay / 2)
+        for i, part in enumerate(parts):
+            time.sleep(delay / 2 / max(len(parts), 1))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=part, usage_metadata=usage if i == len(parts) - 1 else None))
+            if run_manager:
+                run_manager.on_llm_new_token(part, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, usage, delay = self.plan(messages)
+        parts = self.chunks(text)
+        await asyncio.sleep(delay / 2)
+        for i, part in enumerate(parts):
+            await asyncio.sleep(delay / 2 / max(len(parts), 1))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=part, usage_metadata=usage if i == len(parts) - 1 else None))
+            if run_manager:
+                await run_manager.on_llm_new_token(part, chunk=chunk)
+            yield chunk
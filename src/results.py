@@ -0,0 +1,33 @@
+from dataclasses import asdict, dataclass, field
+
+
+@dataclass
+class ContextItem:
+    """1 mục context đưa vào LLM: anchor node, relationship, map point, topology fact..."""
+    kind: str
+    text: str
+    score: float = None
+    sources: list = field(default_factory=list)
+
+
+@dataclass
+class RetrievalResult:
+    """Kết quả đầy đủ của 1 lượt search: câu trả lời, context chính xác đã dùng, route, thời gian, token."""
+    question: str
+    strategy: str
+    answer: str
+    context: list = field(default_factory=list)
+    route: dict = None
+    cached: bool = False
+    latency: float = 0.0
+    stages: dict = field(default_factory=dict)
+    llm_calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    query_id: str = None
+
+    def context_texts(self):
+        return [c.text for c in self.context]
+
+    def to_dict(self):
+        return asdict(self)
@@ -1,68 +1,205 @@
-import json
-import random
+import asyncio
 import time
 from collections import defaultdict
 
-import tiktoken
+import numpy as np
+
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langchain_community.vectorstores import Neo4jVector
 import src.connection as connection
-
-from src.prompt.query.global_search_map_system_prompt import MAP_SYSTEM_PROMPT
+import src.routing as routing
+import src.fastpath as fastpath
+import src.metrics as metrics
+import src.tracing as tracing
+from src.analytics import afetch_topology_facts
+from src.cache import get_answer_cache
+from src.instrumentation import QueryRecord, TokenCallback, current_record, label, run_with, stage, tracked
+from src.profiling import profile_stream, profiled
+from src.results import ContextItem, RetrievalResult
+from src.batching import count_tokens, pack_by_token_budget, truncate_to_tokens
+from src.scoring import arank_relations, aget_graph_mirror
+from src.devices import DEVICE_TRAVERSAL_QUERY, group_device_rows, render_device_block
+from src.graph import community_embedding_text
+
+from src.prompt.query.global_search_map_system_prompt import MAP_SYSTEM_PROMPT, MULTI_MAP_SYSTEM_PROMPT
 from src.prompt.query.global_search_reduce_system_prompt import REDUCE_SYSTEM_PROMPT
 from src.prompt.query.local_search_system_prompt import LOCAL_SEARCH_SYSTEM_PROMPT
-from src.prompt.query.router_search import ROUTER_SYSTEM_PROMPT
+from src.prompt.query.fastpath_polish_prompt import FASTPATH_POLISH_PROMPT
+from src.prompt.query.topology_facts_prompt import (TOPOLOGY_FACTS_PROMPT, TOPOLOGY_KEYWORDS,
+                                                    REDUNDANCY_KEYWORDS, REDUNDANCY_KINDS)
 
 
-def count_tokens(text):
-    try:
-        encoding = tiktoken.get_encoding("cl100k_base") # Encoding chuẩn của GPT-4
-        return len(encoding.encode(text))
-    except:
-        # Fallback nếu chưa cài tiktoken: ước lượng 1 token ~ 4 ký tự
-        return len(text) // 4
+def render_community_report(c):
+    return f"\n---\nCommunity ID: {c['id']}\nTitle: {c['title']}\nSummary: {c['summary']}\n"
 
 
+def pack_community_reports(communities, question, token_budget, prompt=MAP_SYSTEM_PROMPT):
+    # Gom report vào từng lượt map theo token budget; report quá dài bị cắt phần summary
+    def trim(c, budget):
+        header = count_tokens(render_community_report({**c, "summary": ""}))
+        return {**c, "summary": truncate_to_tokens(c['summary'] or "", budget - header)}
 
-def global_search(question):
-    print("GLOBAL SEARCH MODE (Map-Reduce Strategy)")
-    t1 = time.time()
+    overhead = count_tokens(prompt) + count_tokens(question)
+    return pack_by_token_budget(communities, render_community_report, token_budget, trim=trim, overhead=overhead)
 
-# MAP
-    try:
-        communities = connection.graph.query("""
-            MATCH (c:Community) 
-            RETURN c.id as id, c.title as title, c.summary as summary, c.rating as rating
-        """)
-    except Exception as e:
-        return f"Lỗi truy vấn Neo4j: {e}"
 
-    if not communities:
-        return "Chưa có dữ liệu Community. Hãy chạy Ingestion trước."
+COMMUNITY_SEARCH_QUERY = """
+    CALL db.index.vector.queryNodes('community_index', $k, $embedding)
+    YIELD node AS c, score
+    RETURN c.id as id, c.title as title, c.summary as summary, c.rating as rating,
+           c.findings as findings, c.embedding as embedding
+"""
+
+COMMUNITIES_QUERY = """
+    MATCH (c:Community)
+    RETURN c.id as id, c.title as title, c.summary as summary, c.rating as rating,
+           c.findings as findings, c.embedding as embedding
+"""
+
+
+async def fetch_communities(question_vector=None, max_communities=None):
+    # Có max_communities: chỉ lấy Top-K report gần câu hỏi nhất qua community_index
+    if max_communities and question_vector is not None:
+        try:
+            return await connection.aquery(COMMUNITY_SEARCH_QUERY,
+                                           {"k": int(max_communities), "embedding": question_vector})
+        except Exception as e:
+            print(f"Lỗi community_index ({e}), quét toàn bộ communities.")
+
+    return await connection.aquery(COMMUNITIES_QUERY)
 
-    random.shuffle(communities)  # Xáo trộn ngẫu nhiên
 
-    CHUNK_SIZE = 5
-    chunks = [communities[i:i + CHUNK_SIZE] for i in range(0, len(communities), CHUNK_SIZE)]
-    print(f" Đã chia {len(communities)} communities thành {len(chunks)} chunks để xử lý.")
+async def rank_communities(question, communities, question_vector=None):
+    """
+    Sắp xếp community theo độ liên quan: cosine(question, report embedding) kết hợp rating.
+    Report chưa có embedding được embed tạm (batch) để xếp hạng; chỉ create_community_index ghi vào Neo4j.
+    """
+    weight = float(connection.cfg.get("GLOBAL_SIMILARITY_WEIGHT", 0.7))
+
+    missing = [c for c in communities if not c.get('embedding')]
+    if missing:
+        try:
+            vectors = await connection.embeddings.aembed_documents([community_embedding_text(c) for c in missing])
+            for c, v in zip(missing, vectors):
+                c['embedding'] = v
+        except Exception as e:
+            print(f"Lỗi embed community reports: {e}. Chỉ xếp hạng theo rating.")
+            weight = 0.0
+
+    q_vec = None
+    if weight > 0:
+        try:
+            if question_vector is None:
+                question_vector = await connection.embeddings.aembed_query(question)
+            q_vec = np.asarray(question_vector, dtype=float)
+        except Exception as e:
+            print(f"Lỗi embed câu hỏi: {e}. Chỉ xếp hạng theo rating.")
+            weight = 0.0
+
+    for c in communities:
+        try:
+            rating = min(max(float(c.get('rating') or 0) / 100.0, 0.0), 1.0)
+        except (TypeError, ValueError):
+            rating = 0.0
+
+        similarity = 0.0
+        if q_vec is not None and c.get('embedding'):
+            v = np.asarray(c['embedding'], dtype=float)
+            denom = np.linalg.norm(q_vec) * np.linalg.norm(v)
+            similarity = float(q_vec @ v / denom) if denom else 0.0
+
+        c['relevance'] = weight * similarity + (1 - weight) * rating
+
+    return sorted(communities, key=lambda c: c['relevance'], reverse=True)
+
+
+def status_event(message):
+    return {"type": "status", "message": message}
+
+
+def no_emit(event):
+    pass
+
+
+async def iter_steps(steps_factory, record=None):
+    """
+    Chạy coroutine retrieval `steps_factory(emit)` và yield từng event nó emit (status, route)
+    ngay khi có; event cuối cùng là {"type": "prepared", "prepared": ...}.
+    Có record thì thời gian / token của các bước được ghi vào record đó.
+    """
+    queue = asyncio.Queue()
+    steps = steps_factory(queue.put_nowait)
+    task = asyncio.ensure_future(run_with(record, steps) if record is not None else steps)
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            break
+        while not queue.empty():
+            yield queue.get_nowait()
+        yield {"type": "prepared", "prepared": task.result()}
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def generate_answer(prepared):
+    if "answer" in prepared:
+        return prepared["answer"]
+    with stage(prepared.get("stage", "generate")):
+        return await prepared["chain"].ainvoke(prepared["inputs"])
+
+
+async def stream_answer(prepared, config=None):
+    # Stream từng token của bước sinh câu trả lời cuối cùng
+    if "answer" in prepared:
+        yield {"type": "token", "content": prepared["answer"]}
+        return
+    async for chunk in prepared["chain"].astream(prepared["inputs"], config):
+        if chunk:
+            yield {"type": "token", "content": chunk}
+
+
+async def run_map_phase(question, chunks, emit=no_emit):
+    """
+    Map lần lượt từng chunk theo thứ tự liên quan giảm dần. Dừng sớm khi Top-N point
+    đã ổn định (không đổi qua `patience` lượt) và đều đạt ngưỡng điểm, hoặc hết call budget.
+    Emit status từng chunk, trả về (all_points, global_search_report).
+    """
+    top_n = int(connection.cfg.get("GLOBAL_MAP_TOP_N", 10))
+    threshold = float(connection.cfg.get("GLOBAL_MAP_SCORE_THRESHOLD", 70))
+    patience = int(connection.cfg.get("GLOBAL_MAP_PATIENCE", 2))
+    call_budget = connection.cfg.get("GLOBAL_MAP_CALL_BUDGET")
 
     map_chain = PromptTemplate.from_template(MAP_SYSTEM_PROMPT) | connection.llm | JsonOutputParser()
     all_points = []
     global_search_report = []
+    stable_rounds = 0
+    previous_top = None
+    calls = 0
 
     for i, chunk in enumerate(chunks):
-        chunk_context = ""
-        for c in chunk:
-            chunk_context += f"\n---\nCommunity ID: {c['id']}\nTitle: {c['title']}\nSummary: {c['summary']}\n"
+        if call_budget is not None and calls >= int(call_budget):
+            print(f"   -> Hết call budget ({call_budget}), dừng map ở chunk {i}/{len(chunks)}.")
+            break
+
+        chunk_context = "".join(render_community_report(c) for c in chunk)
+        emit(status_event(f"Map chunk {i + 1}/{len(chunks)} ({len(chunk)} communities)..."))
 
         try:
+            calls += 1
             # AI đọc chunk và trả về JSON chứa các points kèm score
-            res = map_chain.invoke({"question": question,
-                                    "context_data": chunk_context,
-                                    "response_type": "JSON list of points",
-                                    "max_length": "2000"
-                                    })
+            with stage("map"):
+                res = await map_chain.ainvoke({"question": question,
+                                               "context_data": chunk_context,
+                                               "response_type": "JSON list of points",
+                                               "max_length": "2000"
+                                               })
             global_search_report.append(res)
 
             if res.get('points'):
@@ -70,193 +207,685 @@ def global_search(question):
                     # Nội dung + Điểm số
                     all_points.append({
                         "description": p.get('description', ''),
-                        "score": p.get('score', 0)
+                        "score": p.get('score', 0),
+                        "communities": [c['id'] for c in chunk]
                     })
 
         except Exception as e:
             print(f"Lỗi xử lý Chunk {i}: {e}")
             continue
 
-    if not all_points:
-        return "Không tìm thấy thông tin phù hợp trong hệ thống."
+        # Kiểm tra điều kiện dừng sớm
+        top = sorted(all_points, key=point_score, reverse=True)[:top_n]
+        top_key = [p['description'] for p in top]
+        if len(top) == top_n and min(point_score(p) for p in top) >= threshold and top_key == previous_top:
+            stable_rounds += 1
+        else:
+            stable_rounds = 0
+        previous_top = top_key
+
+        if stable_rounds >= patience:
+            print(f"   -> Top-{top_n} ổn định, dừng map sớm sau {calls}/{len(chunks)} chunks.")
+            break
+
+    return all_points, global_search_report
+
+
+def topology_kinds(question):
+    q = question.lower()
+    kinds = [kind for kind, kws in TOPOLOGY_KEYWORDS.items() if any(kw in q for kw in kws)]
+    if any(kw in q for kw in REDUNDANCY_KEYWORDS):
+        kinds.extend(k for k in REDUNDANCY_KINDS if k not in kinds)
+    return kinds
+
+
+async def topology_search_steps(question, emit=no_emit):
+    """
+    Câu hỏi về SPOF / bridge / ECMP / MTU trả lời từ TopologyFact tính sẵn lúc index
+    thay vì map-reduce qua các bản tóm tắt. Trả về None nếu câu hỏi không thuộc loại này.
+    """
+    if not connection.cfg.get("TOPOLOGY_FACTS_ENABLED", True):
+        return None
+    kinds = topology_kinds(question)
+    if not kinds:
+        return None
+    try:
+        with stage("topology_facts"):
+            facts = await afetch_topology_facts(kinds + ["SUMMARY"])
+    except Exception as e:
+        print(f"Lỗi đọc topology facts: {e}")
+        return None
+    summary = next((f for f in facts if f['kind'] == "SUMMARY"), None)
+    if not summary or not summary.get('source_devices_with_config'):
+        # Chưa chạy analytics hoặc không có device nào có cấu hình -> để global search xử lý như cũ
+        return None
+
+    print(f"TOPOLOGY FACTS MODE ({', '.join(kinds)})...")
+    emit(status_event(f"Dùng {len(facts)} topology fact tính sẵn ({', '.join(kinds)})..."))
+
+    token_budget = int(connection.cfg.get("LOCAL_CONTEXT_TOKEN_BUDGET", 2000))
+    lines = []
+    context = []
+    used = 0
+    for f in facts:
+        line = f"- [{f['kind']}] {f['text']}"
+        n = count_tokens(line)
+        if used + n > token_budget:
+            continue
+        lines.append(line)
+        context.append(ContextItem("topology_fact", line, float(f['severity']), list(f['devices'] or [])))
+        used += n
+
+    chain = PromptTemplate.from_template(TOPOLOGY_FACTS_PROMPT) | connection.llm | StrOutputParser()
+    return {"chain": chain, "inputs": {"question": question, "facts": "\n".join(lines)}, "context": context}
+
+
+async def global_search_steps(question, emit=no_emit, max_communities=None):
+    """
+    Phần retrieval (map) của global search. Emit các status event,
+    trả về {"chain", "inputs"} cho bước reduce hoặc {"answer"} nếu kết thúc sớm.
+    """
+    prepared = await topology_search_steps(question, emit)
+    if prepared is not None:
+        return prepared
+
+    print("GLOBAL SEARCH MODE (Map-Reduce Strategy)")
+
+    if max_communities is None:
+        max_communities = connection.cfg.get("GLOBAL_MAX_COMMUNITIES")
+
+# MAP
+    emit(status_event("Đang tìm các community liên quan..."))
+    try:
+        with stage("embed"):
+            question_vector = await connection.embeddings.aembed_query(question)
+    except Exception as e:
+        print(f"Lỗi embed câu hỏi: {e}")
+        question_vector = None
+
+    try:
+        with stage("vector_search"):
+            communities = await fetch_communities(question_vector, max_communities)
+    except Exception as e:
+        return {"answer": f"Lỗi truy vấn Neo4j: {e}"}
+
+    if not communities:
+        return {"answer": "Chưa có dữ liệu Community. Hãy chạy Ingestion trước."}
 
-    with open("log/query/globalsearch.json", "w", encoding="utf-8") as f:
-        json.dump(global_search_report, f, ensure_ascii=False, indent=2)
+    # Community liên quan nhất được map trước
+    with stage("rank"):
+        communities = await rank_communities(question, communities, question_vector)
 
-    all_points.sort(key=lambda x: x['score'], reverse=True)
-    top_points = all_points[:50]
-    with open("log/query/top_points.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(top_points, ensure_ascii=False, indent=2))
+    token_budget = int(connection.cfg.get("MAP_TOKEN_BUDGET", 6000))
+    chunks = pack_community_reports(communities, question, token_budget)
+    print(f" Đã chia {len(communities)} communities thành {len(chunks)} chunks để xử lý (budget {token_budget} tokens).")
 
-    formatted_report = "\n".join([f"- [Score: {p['score']}] {p['description']}" for p in top_points])
-    with open("log/query/formatted_report_map.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(formatted_report, ensure_ascii=False, indent=2))
+    all_points, global_search_report = await run_map_phase(question, chunks, emit)
+
+    if not all_points:
+        return {"answer": "Không tìm thấy thông tin phù hợp trong hệ thống."}
+
+    tracing.trace("map", chunks=len(chunks), report=global_search_report)
+
+    with stage("select_points"):
+        top_points, formatted_report = await select_top_points(all_points)
+    tracing.trace("top_points", points=top_points, formatted_report=formatted_report)
 
     print(f"   -> Tổng hợp {len(top_points)}/{len(all_points)} thông tin quan trọng nhất (Top Scores).")
+    emit(status_event(f"Tổng hợp {len(top_points)} thông tin quan trọng nhất, đang viết câu trả lời..."))
 
 # REDUCE
-    reduce_chain = PromptTemplate.from_template(REDUCE_SYSTEM_PROMPT) | connection.llm | StrOutputParser()
-    final_answer = reduce_chain.invoke({
+    context = [ContextItem("point", format_point(p), point_score(p), list(p['communities'])) for p in top_points]
+    return {"chain": build_reduce_chain(), "inputs": reduce_inputs(question, formatted_report), "context": context,
+            "stage": "reduce"}
+
+
+def build_result(strategy, question, answer, prepared, record, t1, cached=False):
+    return RetrievalResult(
+        question=question,
+        strategy=strategy,
+        answer=answer,
+        context=prepared.get("context", []),
+        route=prepared.get("route"),
+        cached=cached,
+        latency=round(time.perf_counter() - t1, 4),
+        stages={k: round(v, 4) for k, v in record.stages.items()},
+        llm_calls=record.llm_calls,
+        input_tokens=record.input_tokens,
+        output_tokens=record.output_tokens,
+        query_id=record.trace_id
+    )
+
+
+async def search_with_cache(strategy, question, steps_factory, return_result=False):
+    """
+    Tra cache trước; chỉ lưu câu trả lời do LLM sinh ra (không cache thông báo lỗi).
+    return_result=True trả về RetrievalResult và bỏ qua tra cache (cache không giữ context).
+    """
+    cache = get_answer_cache()
+    question_vector = None
+    generation = None
+    t1 = time.perf_counter()
+    with tracked() as record, profiled(f"query_{strategy}"):
+        tracing.begin(record, question, strategy)
+        if cache is not None and not return_result:
+            with stage("cache_lookup"):
+                cached, question_vector, generation = await cache.alookup(strategy, question)
+            if cached is not None:
+                print(f"   -> Cache hit ({strategy})")
+                tracing.trace("result", cached=True, answer=cached)
+                return cached
+        elif cache is not None:
+            # Không tra cache nhưng vẫn lưu: chốt generation trước khi đọc graph
+            generation = await cache.acurrent_generation()
+
+        prepared = await steps_factory(no_emit)
+        answer = await generate_answer(prepared)
+        if cache is not None and "chain" in prepared:
+            await cache.astore(strategy, question, answer, generation, question_vector)
+        latency = time.perf_counter() - t1
+        metrics.observe("graphrag_search_seconds", latency, strategy=strategy)
+        tracing.trace("result", answer=answer, route=prepared.get("route"), stages=dict(record.stages),
+                      latency=latency)
+    if return_result:
+        return build_result(strategy, question, answer, prepared, record, t1)
+    return answer
+
+
+async def stream_with_cache(strategy, question, steps_factory):
+    """
+    Stream status / route / token; event cuối là {"type": "result", "result": RetrievalResult}.
+    Generator có thể được đọc từ nhiều task khác nhau (iter_sync) nên record được truyền
+    tường minh thay vì dựa vào contextvar.
+    """
+    cache = get_answer_cache()
+    question_vector = None
+    t1 = time.perf_counter()
+    record = current_record()
+    if cache is not None:
+        cached, question_vector, generation = await cache.alookup(strategy, question)
+        if cached is not None:
+            yield status_event("Trả lời từ cache.")
+            yield {"type": "token", "content": cached}
+            yield {"type": "result", "result": RetrievalResult(question, strategy, cached, cached=True,
+                                                               latency=round(time.perf_counter() - t1, 4))}
+            return
+
+    own_record = record is None
+    if own_record:
+        record = QueryRecord()
+    tracing.begin(record, question, strategy)
+
+    prepared = None
+    async for event in iter_steps(steps_factory, record):
+        if event["type"] == "prepared":
+            prepared = event["prepared"]
+        else:
+            yield event
+
+    parts = []
+    t_gen = time.perf_counter()
+    config = {"callbacks": [TokenCallback(record, count_metrics=False)]} if own_record else None
+    async for event in stream_answer(prepared, config):
+        parts.append(event["content"])
+        yield event
+    if "chain" in prepared:
+        # Tính cả thời gian client đọc token: đây là thời gian tới token cuối
+        elapsed = time.perf_counter() - t_gen
+        record.stages[prepared.get("stage", "generate")] += elapsed
+        metrics.observe("graphrag_stage_seconds", elapsed, stage=prepared.get("stage", "generate"))
+    answer = "".join(parts)
+    if cache is not None and "chain" in prepared:
+        await cache.astore(strategy, question, answer, generation, question_vector)
+    latency = time.perf_counter() - t1
+    metrics.observe("graphrag_search_seconds", latency, strategy=strategy)
+    tracing.trace("result", record=record, answer=answer, route=prepared.get("route"), stages=dict(record.stages),
+                  latency=latency)
+    yield {"type": "result", "result": build_result(strategy, question, answer, prepared, record, t1)}
+
+
+def global_strategy_key(max_communities):
+    return "global" if max_communities is None else f"global:{max_communities}"
+
+
+async def aglobal_search(question, max_communities=None, return_result=False):
+    return await search_with_cache(global_strategy_key(max_communities), question,
+                                   lambda emit: global_search_steps(question, emit, max_communities),
+                                   return_result)
+
+
+async def aglobal_search_stream(question, max_communities=None):
+    key = global_strategy_key(max_communities)
+    async for event in profile_stream(f"query_{key}", stream_with_cache(
+            key, question, lambda emit: global_search_steps(question, emit, max_communities))):
+        yield event
+
+
+def global_search(question, max_communities=None, return_result=False):
+    return connection.run_sync(aglobal_search(question, max_communities, return_result))
+
+
+def global_search_stream(question, max_communities=None):
+    yield from connection.iter_sync(aglobal_search_stream(question, max_communities))
+
+
+def point_score(p):
+    try:
+        return float(p.get('score') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def collapse_points(points, threshold=None):
+    """
+    Gộp các point gần trùng nghĩa (paraphrase từ các community chồng lấn).
+    Embed toàn bộ point trong 1 batch, gom cụm theo cosine >= threshold, mỗi cụm giữ
+    point điểm cao nhất làm đại diện, kèm số point đã gộp và các community nguồn.
+    """
+    if threshold is None:
+        threshold = float(connection.cfg.get("REDUCE_DEDUP_THRESHOLD", 0.9))
+    points = sorted(points, key=point_score, reverse=True)
+    if not points:
+        return []
+
+    try:
+        X = np.asarray(await connection.embeddings.aembed_documents([p['description'] for p in points]), dtype=float)
+        X /= np.clip(np.linalg.norm(X, axis=1, keepdims=True), 1e-12, None)
+        similar = (X @ X.T) >= threshold
+    except Exception as e:
+        # Fallback: chỉ gộp các point trùng text
+        print(f"Lỗi embed points ({e}), chỉ gộp point trùng khớp.")
+        keys = [" ".join(p['description'].lower().split()) for p in points]
+        similar = np.array([[a == b for b in keys] for a in keys])
+
+    assigned = np.full(len(points), -1)
+    collapsed = []
+    for i, p in enumerate(points):
+        if assigned[i] >= 0:
+            continue
+        members = [i] + [j for j in np.flatnonzero(similar[i]) if j != i and assigned[j] < 0]
+        assigned[members] = i
+
+        communities = []
+        for j in members:
+            for cid in points[j].get('communities', []):
+                if cid not in communities:
+                    communities.append(cid)
+
+        collapsed.append({
+            "description": p['description'],
+            "score": p['score'],
+            "support": len(members),
+            "communities": communities
+        })
+
+    return collapsed
+
+
+def format_point(p):
+    support = f", x{p['support']}" if p.get('support', 1) > 1 else ""
+    refs = p.get('communities') or []
+    ref_str = ""
+    if refs:
+        more = ", +more" if len(refs) > 5 else ""
+        ref_str = f" [Data: Reports ({', '.join(str(c) for c in refs[:5])}{more})]"
+    return f"- [Score: {p['score']}{support}] {p['description']}{ref_str}"
+
+
+async def select_top_points(all_points):
+    # Gộp point trùng nghĩa rồi chọn theo token budget thay vì cố định Top 50
+    token_budget = int(connection.cfg.get("REDUCE_TOKEN_BUDGET", 3000))
+    collapsed = await collapse_points(all_points)
+
+    top_points = []
+    lines = []
+    used = 0
+    for p in collapsed:
+        line = format_point(p)
+        n = count_tokens(line)
+        if top_points and used + n > token_budget:
+            break
+        top_points.append(p)
+        lines.append(line)
+        used += n
+
+    print(f"   -> Gộp {len(all_points)} points thành {len(collapsed)}, chọn {len(top_points)} ({used} tokens).")
+    return top_points, "\n".join(lines)
+
+
+def build_reduce_chain():
+    return PromptTemplate.from_template(REDUCE_SYSTEM_PROMPT) | connection.llm | StrOutputParser()
+
+
+def reduce_inputs(question, formatted_report):
+    return {
         "question": question,
         "report_data": formatted_report,
         "response_type": "General Text Analysis",
         "max_length": "4000"
-    })
-    t2 = time.time()
-    print(f"Thời gian global search: {t2-t1} (s)")
+    }
 
-    return final_answer
 
+async def aglobal_search_multi(questions, max_communities=None):
+    """
+    Global search cho nhiều câu hỏi cùng lúc: mỗi chunk community chỉ gửi LLM 1 lần
+    kèm toàn bộ câu hỏi, sau đó reduce riêng cho từng câu hỏi.
+    Trả về list câu trả lời theo đúng thứ tự `questions`. Không có return_result: lượt gọi map
+    và token dùng chung cho cả lô nên không tách được theo từng câu hỏi.
+    """
+    print(f"GLOBAL SEARCH MODE (Multi-question Map-Reduce, {len(questions)} câu hỏi)")
+    t1 = time.perf_counter()
 
-def local_search(question):
-    print("LOCAL SEARCH MODE (Top-K Nodes + Top-K Relations Strategy)...")
-    t1 = time.time()
+    if not questions:
+        return []
+    if max_communities is None:
+        max_communities = connection.cfg.get("GLOBAL_MAX_COMMUNITIES")
 
-    SEARCH_K = 5
-    TOP_RELATIONS = 10
-    HOP1_DECAY = 1.0
-    HOP2_DECAY = 0.5
+    qids = [f"Q{i + 1}" for i in range(len(questions))]
+    try:
+        question_vectors = await connection.embeddings.aembed_documents(list(questions))
+    except Exception as e:
+        print(f"Lỗi embed câu hỏi: {e}")
+        question_vectors = [None] * len(questions)
 
-    # 1. VECTOR SEARCH
+# MAP
     try:
-        vector_store = Neo4jVector.from_existing_index(
-            embedding=connection.embeddings,
-            url=connection.cfg["NEO4J_URI"],
-            username=connection.cfg["NEO4J_USERNAME"],
-            password=connection.cfg["NEO4J_PASSWORD"],
-            index_name="entity_index",
-            text_node_property="id"
+        if max_communities and question_vectors[0] is not None:
+            # Hợp các Top-K report của từng câu hỏi
+            by_id = {}
+            for qv in question_vectors:
+                for c in await fetch_communities(qv, max_communities):
+                    by_id.setdefault(c['id'], c)
+            communities = list(by_id.values())
+        else:
+            communities = await fetch_communities()
+    except Exception as e:
+        return [f"Lỗi truy vấn Neo4j: {e}"] * len(questions)
+
+    if not communities:
+        return ["Chưa có dữ liệu Community. Hãy chạy Ingestion trước."] * len(questions)
+
+    # Độ liên quan của community = max theo từng câu hỏi
+    relevance = defaultdict(float)
+    for q, qv in zip(questions, question_vectors):
+        for c in await rank_communities(q, communities, qv):
+            relevance[c['id']] = max(relevance[c['id']], c['relevance'])
+    communities.sort(key=lambda c: relevance[c['id']], reverse=True)
+
+    questions_text = "\n".join(f"{qid}: {q}" for qid, q in zip(qids, questions))
+    token_budget = int(connection.cfg.get("MAP_TOKEN_BUDGET", 6000))
+    chunks = pack_community_reports(communities, questions_text, token_budget, prompt=MULTI_MAP_SYSTEM_PROMPT)
+    call_budget = connection.cfg.get("GLOBAL_MAP_CALL_BUDGET")
+    if call_budget is not None:
+        chunks = chunks[:int(call_budget)]
+    print(f" Đã chia {len(communities)} communities thành {len(chunks)} chunks cho {len(questions)} câu hỏi.")
+
+    map_chain = PromptTemplate.from_template(MULTI_MAP_SYSTEM_PROMPT) | connection.llm | JsonOutputParser()
+    inputs = [{"questions": questions_text,
+               "context_data": "".join(render_community_report(c) for c in chunk)} for chunk in chunks]
+    results = await map_chain.abatch(
+        inputs,
+        config={"max_concurrency": int(connection.cfg.get("GLOBAL_MAP_MAX_CONCURRENCY", 4))},
+        return_exceptions=True
+    )
+
+    points_by_qid = {qid: [] for qid in qids}
+    for i, (chunk, res) in enumerate(zip(chunks, results)):
+        if isinstance(res, Exception) or not isinstance(res, dict):
+            print(f"Lỗi xử lý Chunk {i}: {res}")
+            continue
+
+        for answer in res.get('answers') or []:
+            qid = str(answer.get('question_id', '')).strip().upper()
+            if qid not in points_by_qid:
+                continue
+            for p in answer.get('points') or []:
+                points_by_qid[qid].append({
+                    "description": p.get('description', ''),
+                    "score": p.get('score', 0),
+                    "communities": [c['id'] for c in chunk]
+                })
+
+# REDUCE (riêng từng câu hỏi, chạy song song)
+    answers = [None] * len(questions)
+    pending = []
+    for i, qid in enumerate(qids):
+        if not points_by_qid[qid]:
+            answers[i] = "Không tìm thấy thông tin phù hợp trong hệ thống."
+            continue
+        _, formatted_report = await select_top_points(points_by_qid[qid])
+        pending.append((i, reduce_inputs(questions[i], formatted_report)))
+
+    if pending:
+        reduced = await build_reduce_chain().abatch(
+            [x for _, x in pending],
+            config={"max_concurrency": int(connection.cfg.get("GLOBAL_MAP_MAX_CONCURRENCY", 4))},
+            return_exceptions=True
         )
-        docs_with_score = vector_store.similarity_search_with_score(question, k=SEARCH_K)
-        with open("log/query/anchor_local.txt", "w", encoding="utf-8") as f:
-            for doc, score in docs_with_score:
-                f.write(f"SCORE: {score}\n")
-                f.write(doc.page_content + "\n")
-                f.write(str(doc.metadata) + "\n")
-                f.write("-" * 50 + "\n")
+        for (i, _), out in zip(pending, reduced):
+            answers[i] = f"Lỗi reduce: {out}" if isinstance(out, Exception) else out
+
+    metrics.observe("graphrag_search_seconds", time.perf_counter() - t1, strategy="global_multi")
+    return answers
 
+
+def global_search_multi(questions, max_communities=None):
+    return connection.run_sync(aglobal_search_multi(questions, max_communities))
+
+
+def render_relation(r, tgt_desc=None):
+    rel_desc_str = f" ({r['rel_desc']})" if r.get('rel_desc') else ""
+    tgt_desc_str = f" ({tgt_desc})" if tgt_desc else ""
+
+    # Format: [Type] Source --[RELATION (desc)]--> [Type] Target (desc)
+    return (
+        f"[{r['src_type']}] {r['src']} "
+        f"--[{r['rel']}{rel_desc_str}]--> "
+        f"[{r['tgt_type']}] {r['tgt']}{tgt_desc_str}"
+    )
+
+
+def build_local_context(anchors, relations, token_budget=None, max_desc_tokens=None):
+    """
+    Xếp anchor và relationship theo score rồi nhét dần vào token budget.
+    Mô tả của mỗi node chỉ xuất hiện 1 lần (lần đầu node được nhắc tới),
+    mô tả quá dài bị cắt theo max_desc_tokens. Trả về (context_parts, relations đã chọn, context items).
+    """
+    if token_budget is None:
+        token_budget = int(connection.cfg.get("LOCAL_CONTEXT_TOKEN_BUDGET", 2000))
+    if max_desc_tokens is None:
+        max_desc_tokens = int(connection.cfg.get("LOCAL_MAX_DESC_TOKENS", 200))
+
+    described = set()
+    used = count_tokens("PRIMARY ANCHOR NODES (Top 5 Matches)\nTOP 10 RELEVANT CONNECTIONS")
+
+    anchor_lines = []
+    items = []
+    for a in sorted(anchors, key=lambda x: x['score'], reverse=True):
+        if a['id'] in described:
+            continue
+        desc = truncate_to_tokens(a.get('desc') or 'No description', max_desc_tokens)
+        line = f"Node: {a['id']} (Type: {a.get('type')}). Info: {desc}"
+        n = count_tokens(line)
+        if used + n > token_budget:
+            continue
+        anchor_lines.append(line)
+        items.append(ContextItem("anchor", line, a['score'], [a['id']]))
+        described.add(a['id'])
+        used += n
+
+    selected = []
+    relation_lines = []
+    for r in sorted(relations, key=lambda x: x['score'], reverse=True):
+        tgt_desc = None
+        if r.get('tgt_desc') and r['tgt'] not in described:
+            tgt_desc = truncate_to_tokens(r['tgt_desc'], max_desc_tokens)
+
+        line = f"- {render_relation(r, tgt_desc)}"
+        n = count_tokens(line)
+        if used + n > token_budget and tgt_desc:
+            # Không đủ chỗ cho mô tả -> thử giữ riêng cạnh
+            tgt_desc = None
+            line = f"- {render_relation(r)}"
+            n = count_tokens(line)
+        if used + n > token_budget:
+            continue
+
+        if tgt_desc:
+            described.add(r['tgt'])
+        selected.append(r)
+        relation_lines.append(line)
+        items.append(ContextItem("relation", line, r['score'], [r['src'], r['tgt']]))
+        used += n
+
+    context_parts = [f"PRIMARY ANCHOR NODES (Top {len(anchor_lines)} Matches)"]
+    context_parts.extend(anchor_lines)
+    context_parts.append(f"\nTOP {len(relation_lines)} RELEVANT CONNECTIONS")
+    context_parts.extend(relation_lines)
+    return context_parts, selected, items
+
+
+async def fastpath_steps(question, emit=no_emit):
+    """
+    Câu hỏi có cấu trúc (IP / interface / route / neighbor) trả lời thẳng từ graph.
+    Trả về None nếu không khớp template -> caller chạy pipeline thường.
+    """
+    if not connection.cfg.get("FASTPATH_ENABLED", True) or not fastpath.is_candidate(question):
+        return None
+    try:
+        with stage("fastpath"):
+            result = fastpath.answer_structured(question, await aget_graph_mirror())
     except Exception as e:
-        return f"Lỗi Vector Index: {e}"
+        print(f"Lỗi fast path: {e}")
+        return None
+    if result is None:
+        return None
 
-    if not docs_with_score:
-        return "Không tìm thấy thiết bị nào liên quan."
+    print(f"FAST PATH: {result['intent']} ({result['entity']})")
+    emit(status_event(f"Fast path: {result['intent']} của {result['entity']}"))
 
-    print(f" -> Tìm thấy {len(docs_with_score)} Anchor Nodes.")
+    context = [ContextItem("fact", line, 1.0, [result["entity"]]) for line in result["facts"]]
+    if connection.cfg.get("FASTPATH_LLM_POLISH", False):
+        chain = PromptTemplate.from_template(FASTPATH_POLISH_PROMPT) | connection.llm | StrOutputParser()
+        return {"chain": chain, "inputs": {"question": question, "facts": result["answer"]}, "context": context}
+    return {"answer": result["answer"], "context": context}
 
-    # XỬ LÝ ANCHOR INFO & TRAVERSAL
-    anchor_infos = []
-    all_relationships = []
-    processed_rels = set()
 
-    for doc, score in docs_with_score:
-        dev_id = doc.page_content.strip()
-        if dev_id == "UNKNOWN": continue
+ENTITY_SEARCH_QUERY = """
+    CALL db.index.vector.queryNodes('entity_index', $k, $embedding)
+    YIELD node, score
+    RETURN node.id as id, node.type as type, node.desc as desc, score
+"""
 
-        # a. Lưu thông tin Anchor
-        node_desc = doc.metadata.get('desc', 'No description')
-        node_type = doc.metadata.get('type', 'Entity')
-        anchor_text = f"Node: {dev_id} (Type: {node_type}). Info: {node_desc}"
-        anchor_infos.append(anchor_text)
-
-        # b. Traversal Query (2 Hops)
-        # Quét Hop 1 và Hop 2 và Loại 'IN_COMMUNITY'
-        # UNION để gộp 2 truy vấn + bỏ lặp
-        traversal_query = """
-            // Hop 1
-            MATCH (src:Entity {id: $id})-[r1]-(n1:Entity)
-            WHERE type(r1) <> 'IN_COMMUNITY'
-            RETURN 
-                src.id as src, src.type as src_type,
-                type(r1) as rel, r1.desc as rel_desc,
-                n1.id as tgt, n1.type as tgt_type, n1.desc as tgt_desc,
-                1 as hops
-
-            UNION
-
-            // Hop 2
-            MATCH (src:Entity {id: $id})-[r1]-(n1:Entity)-[r2]-(n2:Entity)
-            WHERE type(r1) <> 'IN_COMMUNITY' AND type(r2) <> 'IN_COMMUNITY'
-            RETURN 
-                n1.id as src, n1.type as src_type,
-                type(r2) as rel, r2.desc as rel_desc,
-                n2.id as tgt, n2.type as tgt_type, n2.desc as tgt_desc,
-                2 as hops
-        """
-
-        paths = connection.graph.query(traversal_query, {"id": dev_id})
-        with open("log/query/query_traversal_local.txt", "a", encoding="utf-8") as f:
-            header = f"\n{'=' * 20} Traversal for: {dev_id} (Score: {score:.4f}) {'=' * 20}\n"
-            f.write(header)
-
-        for p in paths:
-            # (Sorted tuple để A-B và B-A là một)
-            rel_key = tuple(sorted([p['src'], p['tgt']])) + (p['rel'],)
-
-            if rel_key in processed_rels:
-                continue
-            processed_rels.add(rel_key)
 
-            # Tính điểm cho Relationship này
-            decay = HOP1_DECAY if p['hops'] == 1 else HOP2_DECAY
-            rel_score = score * decay
+async def local_search_steps(question, emit=no_emit):
+    """
+    Phần retrieval của local search (vector search + traversal + context).
+    Emit status event, trả về {"chain", "inputs"} hoặc {"answer"}.
+    """
+    prepared = await fastpath_steps(question, emit)
+    if prepared is not None:
+        return prepared
 
-            rel_desc_str = f" ({p['rel_desc']})" if p['rel_desc'] else ""
-            tgt_desc_str = f" ({p['tgt_desc']})" if p['tgt_desc'] else ""
+    print("LOCAL SEARCH MODE (Top-K Nodes + Top-K Relations Strategy)...")
 
-            # Format: [Type] Source --[RELATION (desc)]--> [Type] Target (desc)
-            semantic_text = (
-                f"[{p['src_type']}] {p['src']} "
-                f"--[{p['rel']}{rel_desc_str}]--> "
-                f"[{p['tgt_type']}] {p['tgt']}{tgt_desc_str}"
-            )
+    SEARCH_K = 5
 
-            all_relationships.append({
-                "text": semantic_text,
-                "score": rel_score,
-                "hops": p['hops']
-            })
+    # 1. VECTOR SEARCH (cùng truy vấn entity_index mà Neo4jVector dùng)
+    emit(status_event("Đang tìm các node liên quan (vector search)..."))
+    try:
+        with stage("embed"):
+            question_vector = await connection.embeddings.aembed_query(question)
+        with stage("vector_search"):
+            matches = await connection.aquery(ENTITY_SEARCH_QUERY, {"k": SEARCH_K, "embedding": question_vector})
+        tracing.trace("anchors", matches=matches)
 
-    # RANKING & PRUNING
-    all_relationships.sort(key=lambda x: x['score'], reverse=True)
+    except Exception as e:
+        return {"answer": f"Lỗi Vector Index: {e}"}
 
-    top_relations = all_relationships[:TOP_RELATIONS]
+    if not matches:
+        return {"answer": "Không tìm thấy thiết bị nào liên quan."}
 
-    print(f"   -> Thu thập {len(all_relationships)} kết nối. Lọc lấy Top {len(top_relations)}.")
+    print(f" -> Tìm thấy {len(matches)} Anchor Nodes.")
+    emit(status_event(f"Tìm thấy {len(matches)} anchor nodes, đang duyệt graph ({connection.cfg.get('LOCAL_HOP_DEPTH', 2)} hops)..."))
 
-    # CONTEXT CONSTRUCTION
-    context_parts = []
-    context_parts.append("PRIMARY ANCHOR NODES (Top 5 Matches)")
-    context_parts.extend(anchor_infos)
+    # XỬ LÝ ANCHOR INFO
+    anchors = []
+    anchor_scores = {}
 
-    context_parts.append(f"\nTOP {len(top_relations)} RELEVANT CONNECTIONS")
-    for rel in top_relations:
-        context_parts.append(f"- {rel['text']}")
+    for m in matches:
+        dev_id = str(m['id']).strip()
+        if dev_id == "UNKNOWN": continue
 
-    final_context_text = "\n".join(context_parts)
+        anchors.append({
+            "id": dev_id,
+            "type": m.get('type') or 'Entity',
+            "desc": m.get('desc') or 'No description',
+            "score": m['score']
+        })
+        anchor_scores[dev_id] = max(anchor_scores.get(dev_id, 0), m['score'])
 
+    # TRAVERSAL + SCORING: lan truyền điểm từ anchor trên graph mirror (k-hop decay hoặc PPR)
     try:
-        with open("log/query/final_context_local.json", "w", encoding="utf-8") as f:
-            json.dump({
-                "llm_context": context_parts
-            }, f, ensure_ascii=False, indent=2)
+        with stage("traversal"):
+            all_relationships = await arank_relations(anchor_scores)
     except Exception as e:
-        print(f"Lỗi ghi log context: {e}")
+        return {"answer": f"Lỗi duyệt graph: {e}"}
+
+    if tracing.active():
+        tracing.trace("traversal", anchors=list(anchor_scores),
+                      relations=[f"{r['score']:.4f} {render_relation(r)}" for r in all_relationships])
+
+    # RANKING & PRUNING + CONTEXT CONSTRUCTION (theo token budget)
+    with stage("context"):
+        context_parts, top_relations, context_items = build_local_context(anchors, all_relationships)
+
+    print(f"   -> Thu thập {len(all_relationships)} kết nối. Lọc lấy Top {len(top_relations)}.")
+
+    final_context_text = "\n".join(context_parts)
+    tracing.trace("context", llm_context=context_parts)
 
 # LLM GENERATION
     chain = PromptTemplate.from_template(LOCAL_SEARCH_SYSTEM_PROMPT) | connection.llm | StrOutputParser()
-    t2 = time.time()
-    print(f"Thời gian local search: {t2 - t1:.2f}s")
+    emit(status_event(f"Đã dựng context ({len(top_relations)} kết nối), đang viết câu trả lời..."))
 
-    return chain.invoke({
+    return {"chain": chain, "inputs": {
         "question": question,
         "context_data": final_context_text
-    })
+    }, "context": context_items}
+
 
+async def alocal_search(question, return_result=False):
+    return await search_with_cache("local", question, lambda emit: local_search_steps(question, emit), return_result)
 
-def local_search_semantic(question):
+
+async def alocal_search_stream(question):
+    async for event in profile_stream("query_local", stream_with_cache(
+            "local", question, lambda emit: local_search_steps(question, emit))):
+        yield event
+
+
+def local_search(question, return_result=False):
+    return connection.run_sync(alocal_search(question, return_result))
+
+
+def local_search_stream(question):
+    yield from connection.iter_sync(alocal_search_stream(question))
+
+
+def local_search_semantic(question, return_result=False):
+    """Local search đồng bộ, không cache. return_result=True trả về RetrievalResult (context từng device)."""
     print("LOCAL SEARCH MODE (Semantic + Cleaning Strategy)...")
-    t1 = time.time()
+    t1 = time.perf_counter()
+    with tracked() as record:
+        tracing.begin(record, question, "local_semantic")
+        answer, context = _local_search_semantic(question, record, t1)
+    if return_result:
+        return build_result("local_semantic", question, answer, {"context": context}, record, t1)
+    return answer
+
 
+def _local_search_semantic(question, record, t1):
     # Cấu hình
     SEARCH_K = 5
     GRAPH_LIMIT = 200
@@ -272,53 +901,18 @@ def local_search_semantic(question):
             text_node_property="id"
         )
         docs_with_score = vector_store.similarity_search_with_score(question, k=SEARCH_K)
-        with open("log/query/anchor_local.txt", "w", encoding="utf-8") as f:
-            for doc, score in docs_with_score:
-                f.write(f"SCORE: {score}\n")
-                f.write(doc.page_content + "\n")
-                f.write(str(doc.metadata) + "\n")
-                f.write("-" * 50 + "\n")
+        if tracing.active():
+            tracing.trace("anchors", record=record,
+                          matches=[{"id": doc.page_content, "score": score, **doc.metadata} for doc, score in docs_with_score])
 
     except Exception as e:
-        return f"Lỗi Vector Index: {e}"
+        return f"Lỗi Vector Index: {e}", []
 
-    if not docs_with_score: return "Không tìm thấy thiết bị nào liên quan."
+    if not docs_with_score: return "Không tìm thấy thiết bị nào liên quan.", []
 
     # 2. DATA FETCHING (2-HOPS)
-    traversal_query = """
-        MATCH (anchor:Entity {id: $id})-[r1]-(n1:Entity)
-        WHERE type(r1) <> 'IN_COMMUNITY'
-        RETURN 
-            anchor.id as src_id, anchor.type as src_type, anchor.desc as src_desc,
-            type(r1) as rel_type, r1.desc as rel_desc,
-            n1.id as tgt_id, n1.type as tgt_type, n1.desc as tgt_desc
-
-        UNION
-
-        MATCH (anchor:Entity {id: $id})-[r1]-(n1:Entity)-[r2]-(n2:Entity)
-        WHERE type(r1) <> 'IN_COMMUNITY' AND type(r2) <> 'IN_COMMUNITY'
-        RETURN 
-            n1.id as src_id, n1.type as src_type, n1.desc as src_desc,
-            type(r2) as rel_type, r2.desc as rel_desc,
-            n2.id as tgt_id, n2.type as tgt_type, n2.desc as tgt_desc
-        LIMIT $limit
-    """
-
-    # Cấu trúc dữ liệu (Sử dụng Set cho IP để tự khử trùng lặp)
-    devices_map = defaultdict(lambda: {
-        "desc": "",
-        "interfaces": defaultdict(lambda: {"ip": set(), "desc": ""}),
-        "routes": set()
-    })
-
-    # Map để trace ngược từ Interface về Device
-    interface_parent_map = {}
     node_scores = {}
 
-    def clean_text(text):
-        if not text: return ""
-        return text.replace(")**", "").strip()
-
     raw_rows = []
 
     # Fetch Data
@@ -329,138 +923,154 @@ def local_search_semantic(question):
         node_scores[dev_id] = max(node_scores.get(dev_id, 0), score)
 
         try:
-            results = connection.graph.query(traversal_query, {"id": dev_id, "limit": GRAPH_LIMIT})
-            with open("log/query/query_traversal_local.txt", "a", encoding="utf-8") as f:
-                header = f"\n{'=' * 20} Traversal for: {dev_id} (Score: {score:.4f}) {'=' * 20}\n"
-                f.write(header)
-
-                if results:
-                    log_content = json.dumps(results, ensure_ascii=False, indent=2)
-                    f.write(log_content)
-                else:
-                    f.write("-> [WARN] No neighbors found in Graph (Empty Result).\n")
-
-                f.write("\n" + "-" * 60 + "\n")
-
+            results = connection.graph.query(DEVICE_TRAVERSAL_QUERY, {"id": dev_id, "limit": GRAPH_LIMIT})
+            if tracing.active():
+                tracing.trace("traversal", record=record, anchor=dev_id, score=score, rows=results)
             raw_rows.extend(results)
             #print(f"CHECK: raw_rows: {len(raw_rows)}")
         except:
             continue
 
     # 3. GOM NHÓM & LÀM SẠCH
+    devices_map, _ = group_device_rows(raw_rows)
 
-    # PASS 1: Xây khung Device - Interface
-    for row in raw_rows:
-        src_id, src_type = row['src_id'], row['src_type']
-        tgt_id, tgt_type = row['tgt_id'], row['tgt_type']
-
-        # Logic: Chỉ map Interface vào Device nếu ID Interface chứa ID Device
-        # Hoặc chấp nhận map lỏng lẻo nhưng phải cẩn thận
-
-        if src_type == 'DEVICE' and tgt_type in ['INTERFACE', 'BOND', 'VLAN', 'BRIDGE']:
-            devices_map[src_id]['desc'] = clean_text(row['src_desc'])
-            devices_map[src_id]['interfaces'][tgt_id]['desc'] = clean_text(row['tgt_desc'])
-            interface_parent_map[tgt_id] = src_id  # Mapping Interface -> Device
-
-        elif tgt_type == 'DEVICE' and src_type in ['INTERFACE', 'BOND', 'VLAN', 'BRIDGE']:
-            devices_map[tgt_id]['desc'] = clean_text(row['tgt_desc'])
-            devices_map[tgt_id]['interfaces'][src_id]['desc'] = clean_text(row['src_desc'])
-            interface_parent_map[src_id] = tgt_id
-
-    # PASS 2: Gắn IP và Route
-    for row in raw_rows:
-        src_id, src_type = row['src_id'], row['src_type']
-        tgt_id, tgt_type = row['tgt_id'], row['tgt_type']
-        rel = row.get('rel_desc') if row.get('rel_desc') else row['rel_type']
-
-        # Gắn IP (Dùng Set để add, tự động loại trùng)
-        if src_type == 'IP_ADDRESS' and tgt_id in interface_parent_map:
-            devices_map[interface_parent_map[tgt_id]]['interfaces'][tgt_id]['ip'].add(clean_text(src_id))
-        elif tgt_type == 'IP_ADDRESS' and src_id in interface_parent_map:
-            devices_map[interface_parent_map[src_id]]['interfaces'][src_id]['ip'].add(clean_text(tgt_id))
-
-        # Gắn Routes
-        if src_type == 'DEVICE' and 'ROUTE' in rel.upper():
-            devices_map[src_id]['routes'].add(f"To {clean_text(tgt_id)} via {rel}")
-        elif tgt_type == 'DEVICE' and 'ROUTE' in rel.upper():
-            devices_map[tgt_id]['routes'].add(f"To {clean_text(src_id)} via {rel}")
-
-    # 4. RENDER TEXT
+    # 4. RENDER TEXT (mỗi device 1 block, thêm theo score cho tới khi hết token budget)
+    token_budget = int(connection.cfg.get("LOCAL_CONTEXT_TOKEN_BUDGET", 2000))
     context_lines = []
+    context = []
     sorted_devs = sorted(devices_map.keys(), key=lambda k: node_scores.get(k, 0), reverse=True)
 
 
     context_lines.append("=== DEVICE CONFIGURATIONS ===")
+    used = count_tokens(context_lines[0])
 
     for dev_id in sorted_devs:
         data = devices_map[dev_id]
         if not data['interfaces'] and not data['routes']: continue
 
-        context_lines.append(f"### DEVICE: {dev_id}")
+        text = "\n".join(render_device_block(dev_id, data))
 
-        short_desc = data['desc'].split("Configuration includes")[0].strip()
-        context_lines.append(f"  Role: {short_desc}")
+        n = count_tokens(text)
+        if used + n > token_budget:
+            # Cắt block cho vừa phần budget còn lại thay vì bỏ cả block (có thể là device khớp nhất)
+            text = truncate_to_tokens(text, token_budget - used)
+            if text:
+                context_lines.extend(text.split("\n"))
+                context.append(ContextItem("device", text, float(node_scores.get(dev_id, 0)), [dev_id]))
+            break
+        context_lines.extend(text.split("\n"))
+        context.append(ContextItem("device", text, float(node_scores.get(dev_id, 0)), [dev_id]))
+        used += n
 
-        if data['interfaces']:
-            context_lines.append(f"  INTERFACES:")
-            for iface in sorted(data['interfaces'].keys()):
-                iface_data = data['interfaces'][iface]
+    final_context_str = "\n".join(context_lines)
 
-                # Convert set IP back to list & sort
-                ips = sorted(list(iface_data['ip']))
-                ip_str = f" [IPs: {', '.join(ips)}]" if ips else ""
+    tracing.trace("context", record=record, llm_context=context_lines)
 
-                # Extract Attributes ngắn gọn
-                attrs = []
-                desc_lower = iface_data['desc'].lower()
-                if 'mtu' in desc_lower: attrs.append("MTU:9000")
-                if 'bond' in desc_lower: attrs.append("Type:Bond")
-                attr_str = f" ({', '.join(attrs)})" if attrs else ""
+    # LLM
+    chain = PromptTemplate.from_template(LOCAL_SEARCH_SYSTEM_PROMPT) | connection.llm | StrOutputParser()
+    metrics.observe("graphrag_stage_seconds", time.perf_counter() - t1, stage="local_semantic_retrieval")
 
-                context_lines.append(f"    - {iface}{ip_str}{attr_str}")
+    with stage("generate"):
+        answer = chain.invoke({
+            "question": question,
+            "context_data": final_context_str
+        })
+    return answer, context
 
-        if data['routes']:
-            context_lines.append(f"  ROUTING TABLE:")
-            for r in sorted(list(data['routes'])):
-                context_lines.append(f"    - {r}")
 
-        context_lines.append("")
 
-    final_context_str = "\n".join(context_lines)
+def discard_task(task):
+    # Huỷ task chạy trước; nếu task đã lỗi xong thì đọc exception để asyncio không log "never retrieved"
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
-    # Logging
-    try:
-        with open("log/query/final_context_local.json", "w", encoding="utf-8") as f:
-            json.dump({"llm_context": context_lines}, f, ensure_ascii=False, indent=2)
-    except:
-        pass
 
-    # LLM
-    chain = PromptTemplate.from_template(LOCAL_SEARCH_SYSTEM_PROMPT) | connection.llm | StrOutputParser()
-    t2 = time.time()
-    print(f"Thời gian: {t2 - t1:.2f}s")
+async def route_with_speculation(question):
+    """
+    Router cục bộ trước; nếu phải hỏi LLM router thì đồng thời chạy trước phần retrieval
+    của local search (vector search + traversal + context) trong 1 task. Trả về (decision, task|None).
+    """
+    t1 = time.time()
+    with stage("route"):
+        decision = await routing.aroute_local_first(question)
+        speculative = None
+        if decision["needs_llm"]:
+            speculative = asyncio.ensure_future(local_search_steps(question))
+            try:
+                await routing.aresolve_with_llm(question, decision)
+            except BaseException:
+                discard_task(speculative)
+                raise
+
+    decision["latency"] = time.time() - t1
+    routing.log_decision(question, decision)
+    print(f"   -> Router: {decision['source']} (confidence {decision['confidence']:.2f})")
+    print(f"   -> Decision: {decision['destination']} STRATEGY")
+
+    if decision["destination"] == "GLOBAL" and speculative is not None:
+        # Bỏ phần local đã chạy trước
+        discard_task(speculative)
+        speculative = None
+    return decision, speculative
+
+
+async def router_search_steps(question, emit=no_emit):
+    # Fast path trước router: câu hỏi có cấu trúc không cần chọn chiến lược
+    prepared = await fastpath_steps(question, emit)
+    if prepared is not None:
+        routing.stats["destination:FASTPATH"] += 1
+        label("route", "FASTPATH")
+        emit({"type": "route", "destination": "FASTPATH"})
+        return {**prepared, "route": {"destination": "FASTPATH"}}
+
+    prepared = await topology_search_steps(question, emit)
+    if prepared is not None:
+        routing.stats["destination:TOPOLOGY"] += 1
+        label("route", "TOPOLOGY")
+        emit({"type": "route", "destination": "TOPOLOGY"})
+        return {**prepared, "route": {"destination": "TOPOLOGY"}}
 
-    return chain.invoke({
-        "question": question,
-        "context_data": final_context_str
-    })
+    try:
+        decision, speculative = await route_with_speculation(question)
+        destination = decision["destination"]
+        route = {k: decision.get(k) for k in ("destination", "source", "confidence")}
+    except Exception as e:
+        print(f"Router Error: {e}. Fallback to Local Search.")
+        destination, speculative = "LOCAL", None
+        route = {"destination": "LOCAL", "source": "fallback", "confidence": None}
+
+    label("route", destination)
+    emit({"type": "route", "destination": destination})
+    if destination == "GLOBAL":
+        prepared = await global_search_steps(question, emit)
+    elif speculative is not None:
+        emit(status_event("Đang hoàn tất local retrieval (đã chạy song song với router)..."))
+        prepared = await speculative
+    else:
+        prepared = await local_search_steps(question, emit)
+    return {**prepared, "route": route}
+
+
+async def arouter_search(question, return_result=False):
+    try:
+        return await search_with_cache("router", question, lambda emit: router_search_steps(question, emit),
+                                       return_result)
 
+    except Exception as e:
+        print(f"Router Error: {e}. Fallback to Local Search.")
+        return await alocal_search(question, return_result)
 
 
-def router_search(question):
-    try:
-        router_chain = PromptTemplate.from_template(ROUTER_SYSTEM_PROMPT) | connection.llm | JsonOutputParser()
-        decision = router_chain.invoke({"question": question})
-        destination = decision.get("destination", "LOCAL").upper()
+async def arouter_search_stream(question):
+    yield status_event("Đang chọn chiến lược tìm kiếm...")
+    async for event in profile_stream("query_router", stream_with_cache(
+            "router", question, lambda emit: router_search_steps(question, emit))):
+        yield event
 
-        print(f"   -> Decision: {destination} STRATEGY")
 
+def router_search(question, return_result=False):
+    return connection.run_sync(arouter_search(question, return_result))
 
-        if destination == "GLOBAL":
-            return global_search(question)
-        else:
-            return local_search(question)
 
-    except Exception as e:
-        print(f"Router Error: {e}. Fallback to Local Search.")
-        return local_search(question)
+def router_search_stream(question):
+    yield from connection.iter_sync(arouter_search_stream(question))
@@ -0,0 +1,154 @@
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+
+import src.connection as connection
+from src.instrumentation import current_record
+from src.tracing import open_sink, sink_options
+from src.prompt.query.router_search import ROUTER_SYSTEM_PROMPT, ROUTER_KEYWORDS, ROUTER_EXAMPLES
+
+ROUTER_LOG_PATH = "log/query/router_decisions.jsonl"
+
+# Tín hiệu LOCAL mạnh: địa chỉ IP / tên interface cụ thể
+IP_PATTERN = re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?:/\d{1,2})?\b")
+INTERFACE_PATTERN = re.compile(r"\b(?:eth|eno|ens|enp|bond|vlan|br)\d[\w.]*\b", re.IGNORECASE)
+
+# Khớp nguyên từ ("ip of" không khớp trong "relationship of")
+KEYWORD_PATTERNS = {
+    label: [re.compile(r"\b" + re.escape(kw) + r"\b") for kw in keywords]
+    for label, keywords in ROUTER_KEYWORDS.items()
+}
+
+_centroids = {}
+_centroid_lock = threading.Lock()
+stats = Counter()
+
+
+def keyword_score(question):
+    # Trả về điểm trong [-1, 1]: dương nghiêng GLOBAL, âm nghiêng LOCAL
+    q = question.lower()
+    g = sum(1 for p in KEYWORD_PATTERNS["GLOBAL"] if p.search(q))
+    l = sum(1 for p in KEYWORD_PATTERNS["LOCAL"] if p.search(q))
+    l += 2 * len(IP_PATTERN.findall(question)) + 2 * len(INTERFACE_PATTERN.findall(question))
+    if g + l == 0:
+        return 0.0
+    return (g - l) / (g + l)
+
+
+def centroids_from_vectors(vectors):
+    labels = list(ROUTER_EXAMPLES)
+    vectors = np.asarray(vectors, dtype=float)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+    centroids = {}
+    start = 0
+    for label in labels:
+        n = len(ROUTER_EXAMPLES[label])
+        c = vectors[start:start + n].mean(axis=0)
+        centroids[label] = c / max(np.linalg.norm(c), 1e-12)
+        start += n
+    return centroids
+
+
+def example_texts():
+    return [q for label in ROUTER_EXAMPLES for q in ROUTER_EXAMPLES[label]]
+
+
+async def aget_centroids():
+    # Embed câu hỏi mẫu 1 lần cho mỗi embedding model, lấy trung bình theo nhãn
+    key = id(connection.embeddings)
+    if key not in _centroids:
+        vectors = await connection.embeddings.aembed_documents(example_texts())
+        with _centroid_lock:
+            _centroids.setdefault(key, centroids_from_vectors(vectors))
+    return _centroids[key]
+
+
+def centroid_score(question_vector, centroids):
+    # Nearest-centroid: chênh lệch cosine tới centroid GLOBAL và LOCAL, chuẩn hoá về [-1, 1]
+    scale = float(connection.cfg.get("ROUTER_EMBEDDING_SCALE", 0.1))
+    q = np.asarray(question_vector, dtype=float)
+    q /= max(np.linalg.norm(q), 1e-12)
+    diff = float(q @ centroids["GLOBAL"] - q @ centroids["LOCAL"])
+    return float(np.clip(diff / scale, -1.0, 1.0))
+
+
+async def aembedding_score(question, question_vector=None):
+    centroids = await aget_centroids()
+    if question_vector is None:
+        question_vector = await connection.embeddings.aembed_query(question)
+    return centroid_score(question_vector, centroids)
+
+
+def router_chain():
+    return PromptTemplate.from_template(ROUTER_SYSTEM_PROMPT) | connection.llm | JsonOutputParser()
+
+
+async def allm_route(question):
+    decision = await router_chain().ainvoke({"question": question})
+    return decision.get("destination", "LOCAL").upper()
+
+
+def combine_scores(kw, emb):
+    combined = kw if emb is None else 0.5 * kw + 0.5 * emb
+    return {
+        "destination": "GLOBAL" if combined > 0 else "LOCAL",
+        "confidence": abs(combined),
+        "keyword_score": kw,
+        "embedding_score": emb,
+    }
+
+
+async def alocal_route(question, question_vector=None):
+    try:
+        emb = await aembedding_score(question, question_vector)
+    except Exception as e:
+        print(f"Router embedding lỗi ({e}), chỉ dùng keyword.")
+        emb = None
+    return combine_scores(keyword_score(question), emb)
+
+
+def mark_needs_llm(decision):
+    # needs_llm=True nếu độ tin cậy dưới ROUTER_CONFIDENCE_THRESHOLD
+    threshold = float(connection.cfg.get("ROUTER_CONFIDENCE_THRESHOLD", 0.3))
+    decision["source"] = "local"
+    decision["needs_llm"] = decision["confidence"] < threshold
+    return decision
+
+
+async def aroute_local_first(question, question_vector=None):
+    """
+    Chọn GLOBAL/LOCAL bằng keyword + nearest-centroid (không tốn LLM); needs_llm=True thì
+    caller gọi aresolve_with_llm (độ tin cậy dưới ROUTER_CONFIDENCE_THRESHOLD).
+    """
+    return mark_needs_llm(await alocal_route(question, question_vector))
+
+
+async def aresolve_with_llm(question, decision):
+    try:
+        decision["destination"] = await allm_route(question)
+        decision["source"] = "llm"
+    except Exception as e:
+        print(f"Router Error: {e}. Dùng quyết định cục bộ.")
+        decision["source"] = "local_fallback"
+    return decision
+
+
+def log_decision(question, decision):
+    stats["total"] += 1
+    stats[f"source:{decision['source']}"] += 1
+    stats[f"destination:{decision['destination']}"] += 1
+
+    # Ghi qua thread nền của trace sink, không chặn request
+    record = current_record()
+    open_sink("router", ROUTER_LOG_PATH, **sink_options()).write(
+        {"question": question, **decision, "query_id": record.trace_id if record is not None else None})
+
+
+def get_stats():
+    total = stats["total"] or 1
+    return {**stats, "llm_rate": stats["source:llm"] / total}
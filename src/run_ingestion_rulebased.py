@@ -4,6 +4,9 @@ import re
 import os
 import unicodedata
 import src.connection as connection
+from src.graph import bump_graph_generation
+from src.instrumentation import stage
+from src.profiling import profiled
 
 
 OUTPUT_JSON = "log/graph_output_test.json"
@@ -206,6 +209,58 @@ def walk(key, value, parent_id, root_device_id):
                     add_relation(root_device_id, via_id, "NEXT_HOP")  # Nối từ Root Device
 
 
+ENTITY_BATCH_MERGE_QUERY = """
+    UNWIND $data AS row
+    MERGE (e:Entity {id: row.name})
+    SET e.type = row.type,
+        e.desc = row.desc,
+        e.infor = row.infor
+"""
+
+RELATION_BATCH_MERGE_QUERY = """
+    UNWIND $data AS row
+    MATCH (a:Entity {id: row.source})
+    MATCH (b:Entity {id: row.target})
+    MERGE (a)-[r:CONNECTED_TO]->(b)
+    SET r.rel_type = row.rel_type,
+        r.strength = row.strength,
+        r.desc = row.rel_type
+"""
+
+
+MARK_DIRTY_QUERY = """
+    UNWIND $ids AS id
+    MATCH (e:Entity {id: id})
+    SET e.dirty = true
+    WITH e
+    WHERE e.id IN $stale
+    REMOVE e.embedding
+"""
+
+
+def diff_entities(existing, existing_edges, new_entities, new_edges, new_ids):
+    """
+    So dữ liệu mới với graph hiện có. Trả về (changed, stale, removed_ids, removed_edges):
+    changed = node cần phân cụm lại (nội dung hoặc cạnh đổi), stale = node có text đổi
+    -> xoá embedding để create_indices embed lại.
+    """
+    removed_ids = set(existing) - new_ids
+    removed_edges = existing_edges - new_edges
+    stale = {
+        e['name'] for e in new_entities
+        if e['name'] in existing and existing[e['name']] != (e['type'], e['desc'], e['infor'])
+    }
+    changed = {
+        e['name'] for e in new_entities
+        if existing.get(e['name']) != (e['type'], e['desc'], e['infor'])
+    }
+    for s, t in existing_edges ^ new_edges:
+        changed.update((s, t))
+    changed -= removed_ids
+    return changed, stale, removed_ids, removed_edges
+
+
+@profiled("run_ingestion_test")
 def run_ingestion_test(yaml_content):
     print("[Ingestion Refined] Starting (Based on Reference Code)...")
 
@@ -253,37 +308,62 @@ def run_ingestion_test(yaml_content):
         print(f"   -> Log saved: {OUTPUT_JSON}")
 
         # 4. Write to Neo4j (Phần này phải giữ lại để hệ thống chạy được)
+        # Không xoá toàn bộ DB nữa: chỉ ghi phần khác biệt và đánh dấu dirty
+        # để phân cụm incremental (giữ nguyên communityId cũ).
         print("   -> Writing to Neo4j...")
-        connection.graph.query("MATCH (n) DETACH DELETE n")
+        existing = {
+            r['id']: (r['type'], r['desc'], r['infor']) for r in connection.graph.query(
+                "MATCH (e:Entity) RETURN e.id as id, e.type as type, e.desc as desc, e.infor as infor")
+        }
+        existing_edges = {
+            (r['source'], r['target']) for r in connection.graph.query(
+                "MATCH (a:Entity)-[:CONNECTED_TO]->(b:Entity) RETURN a.id as source, b.id as target")
+        }
+        new_edges = {(r['source'], r['target']) for r in relationships}
+        changed, stale, removed_ids, removed_edges = diff_entities(
+            existing, existing_edges, entities, new_edges, node_ids)
+        print(f"   -> Diff: {len(changed)} node thay đổi, {len(removed_ids)} node bị xoá.")
+
+        if removed_edges:
+            with stage("neo4j_write"):
+                connection.graph.query("""
+                    UNWIND $data AS row
+                    MATCH (a:Entity {id: row[0]})-[r:CONNECTED_TO]->(b:Entity {id: row[1]})
+                    DELETE r
+                """, {"data": [list(e) for e in removed_edges]})
+
+        if removed_ids:
+            with stage("neo4j_write"):
+                connection.graph.query("""
+                    UNWIND $ids AS id
+                    MATCH (e:Entity {id: id})
+                    DETACH DELETE e
+                """, {"ids": list(removed_ids)})
 
         if entities:
-            connection.graph.query("""
-                UNWIND $data AS row
-                MERGE (e:Entity {id: row.name})
-                SET e.type = row.type, 
-                    e.desc = row.desc,
-                    e.infor = row.infor
-            """, {"data": entities})
+            with stage("neo4j_write"):
+                connection.graph.query(ENTITY_BATCH_MERGE_QUERY, {"data": entities})
 
         if relationships:
             # Batch write edges
             batch_size = 1000
             for i in range(0, len(relationships), batch_size):
                 batch = relationships[i:i + batch_size]
-                connection.graph.query("""
-                    UNWIND $data AS row
-                    MATCH (a:Entity {id: row.source})
-                    MATCH (b:Entity {id: row.target})
-                    MERGE (a)-[r:CONNECTED_TO]->(b)
-                    SET r.rel_type = row.rel_type,
-                        r.strength = row.strength,
-                        r.desc = row.rel_type
-                """, {"data": batch})
+                with stage("neo4j_write"):
+                    connection.graph.query(RELATION_BATCH_MERGE_QUERY, {"data": batch})
+
+        if changed:
+            with stage("neo4j_write"):
+                # Node đổi nội dung mất embedding cũ -> create_indices embed lại theo text mới
+                connection.graph.query(MARK_DIRTY_QUERY, {"ids": list(changed), "stale": list(stale)})
 
+        bump_graph_generation()
         print("   -> Ingestion Complete!")
+        return sorted(changed)
 
     except Exception as e:
         print(f"Critical Error: {e}")
         import traceback
         traceback.print_exc()
+        raise
 
@@ -0,0 +1,319 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+import src.connection as connection
+from src.graph import get_graph_generation, aget_graph_generation
+
+
+class GraphMirror:
+    """
+    Bản sao in-memory của graph Entity (bỏ cạnh IN_COMMUNITY) dạng mảng cạnh/CSR
+    để tính điểm lan truyền từ anchor bằng phép nhân ma trận thưa thay vì query nhiều hop.
+    """
+
+    def __init__(self, nodes, edges, generation=None):
+        self.generation = generation
+        self.ids = [n['id'] for n in nodes]
+        self.index = {nid: i for i, nid in enumerate(self.ids)}
+        self.types = [n.get('type') for n in nodes]
+        self.descs = [n.get('desc') for n in nodes]
+
+        edges = [e for e in edges if e['source'] in self.index and e['target'] in self.index]
+        self.edges = edges
+        self.src = np.fromiter((self.index[e['source']] for e in edges), dtype=np.int64, count=len(edges))
+        self.dst = np.fromiter((self.index[e['target']] for e in edges), dtype=np.int64, count=len(edges))
+
+        # Cạnh vô hướng: mỗi cạnh xuất hiện 2 chiều khi lan truyền
+        self.rows = np.concatenate([self.src, self.dst])
+        self.cols = np.concatenate([self.dst, self.src])
+        self.degree = np.bincount(self.rows, minlength=len(self.ids)).astype(float)
+
+        # CSR thuần numpy: neighbor của node i = cols[order[ptr[i]:ptr[i+1]]]
+        self.order = np.argsort(self.rows, kind="stable")
+        self.ptr = np.searchsorted(self.rows[self.order], np.arange(len(self.ids) + 1))
+
+        self.transition = None
+        if sp is not None and len(self.ids):
+            # P[i, j] = 1/deg(j) nếu i-j kề nhau (ma trận chuyển cột-chuẩn hoá cho PPR)
+            weights = 1.0 / np.maximum(self.degree[self.cols], 1.0)
+            self.transition = sp.csr_matrix((weights, (self.rows, self.cols)), shape=(len(self.ids), len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def neighbors(self, i):
+        # Trả về (mảng node kề, mảng chỉ số cạnh trong self.edges)
+        positions = self.order[self.ptr[i]:self.ptr[i + 1]]
+        return self.cols[positions], positions % max(len(self.edges), 1)
+
+    def edge_row(self, a, b, e):
+        edge = self.edges[e]
+        return {
+            "src_id": self.ids[a], "src_type": self.types[a], "src_desc": self.descs[a],
+            "rel_type": edge.get('rel'), "rel_desc": edge.get('rel_desc'),
+            "tgt_id": self.ids[b], "tgt_type": self.types[b], "tgt_desc": self.descs[b]
+        }
+
+    def rows_around(self, node_id, depth=2):
+        """Các cạnh trong vòng depth hop quanh node (cùng dạng dòng với DEVICE_TRAVERSAL_QUERY)."""
+        start = self.index.get(node_id)
+        if start is None:
+            return []
+        rows = []
+        seen_edges = set()
+        visited = {start}
+        frontier = [start]
+        for _ in range(depth):
+            next_frontier = []
+            for a in frontier:
+                nbrs, edge_ids = self.neighbors(a)
+                for b, e in zip(nbrs.tolist(), edge_ids.tolist()):
+                    if e in seen_edges:
+                        continue
+                    seen_edges.add(e)
+                    rows.append(self.edge_row(a, b, e))
+                    if b not in visited:
+                        visited.add(b)
+                        next_frontier.append(b)
+            frontier = next_frontier
+        return rows
+
+    def seed_vector(self, anchor_scores):
+        seeds = np.zeros(len(self.ids))
+        for nid, score in anchor_scores.items():
+            i = self.index.get(nid)
+            if i is not None:
+                seeds[i] = max(seeds[i], score)
+        return seeds
+
+    def spread_max(self, x):
+        # out[i] = max_{j kề i} x[j]
+        out = np.zeros_like(x)
+        if len(self.rows):
+            np.maximum.at(out, self.rows, x[self.cols])
+        return out
+
+    def spread_walk(self, x):
+        # out = P @ x
+        if self.transition is not None:
+            return self.transition @ x
+        out = np.zeros_like(x)
+        if len(self.rows):
+            np.add.at(out, self.rows, x[self.cols] / np.maximum(self.degree[self.cols], 1.0))
+        return out
+
+
+def khop_scores(mirror, seeds, depth=2, decay=0.5):
+    """
+    Điểm node = max_anchor(score * decay^khoảng_cách), lan tới depth-1 hop
+    (cạnh ở hop h nằm giữa node cách anchor h-1 và h hop).
+    """
+    scores = seeds.copy()
+    frontier = seeds.copy()
+    for _ in range(max(depth - 1, 0)):
+        frontier = mirror.spread_max(frontier) * decay
+        if not frontier.any():
+            break
+        scores = np.maximum(scores, frontier)
+    return scores
+
+
+def ppr_scores(mirror, seeds, alpha=0.15, iterations=20, tol=1e-6):
+    # Personalized PageRank: p = alpha * s + (1 - alpha) * P @ p
+    total = seeds.sum()
+    if total <= 0:
+        return np.zeros_like(seeds)
+    s = seeds / total
+    p = s.copy()
+    for _ in range(iterations):
+        nxt = alpha * s + (1 - alpha) * mirror.spread_walk(p)
+        done = np.abs(nxt - p).sum() < tol
+        p = nxt
+        if done:
+            break
+    # Đưa về cùng thang với score của anchor tốt nhất
+    return p / max(p.max(), 1e-12) * seeds.max()
+
+
+def top_edges(mirror, node_scores, k=None):
+    """
+    Điểm cạnh = max điểm 2 đầu mút; trả về top-K cạnh (dict giống dòng Cypher cũ),
+    chiều src -> tgt hướng từ phía gần anchor ra ngoài.
+    """
+    if not len(mirror.edges):
+        return []
+    s_src = node_scores[mirror.src]
+    s_dst = node_scores[mirror.dst]
+    edge_scores = np.maximum(s_src, s_dst)
+
+    candidates = np.flatnonzero(edge_scores > 0)
+    if k is not None and len(candidates) > k:
+        part = np.argpartition(-edge_scores[candidates], k - 1)[:k]
+        candidates = candidates[part]
+    candidates = candidates[np.argsort(-edge_scores[candidates], kind="stable")]
+
+    results = []
+    for e in candidates:
+        a, b = int(mirror.src[e]), int(mirror.dst[e])
+        if s_dst[e] > s_src[e]:
+            a, b = b, a
+        edge = mirror.edges[e]
+        results.append({
+            "src": mirror.ids[a], "src_type": mirror.types[a],
+            "rel": edge.get('rel'), "rel_desc": edge.get('rel_desc'),
+            "tgt": mirror.ids[b], "tgt_type": mirror.types[b], "tgt_desc": mirror.descs[b],
+            "score": float(edge_scores[e])
+        })
+    return results
+
+
+def score_relations(mirror, anchor_scores, method=None, depth=None, k=None):
+    """Anchor {id: score} -> top-K relationship đã chấm điểm (khop hoặc ppr)."""
+    method = method or connection.cfg.get("LOCAL_SCORING_METHOD", "khop")
+    depth = int(depth or connection.cfg.get("LOCAL_HOP_DEPTH", 2))
+    if k is None:
+        k = int(connection.cfg.get("LOCAL_TOP_EDGES", 200))
+
+    seeds = mirror.seed_vector(anchor_scores)
+    if method == "ppr":
+        node_scores = ppr_scores(
+            mirror, seeds,
+            alpha=float(connection.cfg.get("LOCAL_PPR_ALPHA", 0.15)),
+            iterations=int(connection.cfg.get("LOCAL_PPR_ITERATIONS", 20))
+        )
+        # Chỉ giữ vùng trong depth hop quanh anchor để PPR không kéo cạnh ở xa vào
+        node_scores = np.where(khop_scores(mirror, seeds, depth=depth) > 0, node_scores, 0.0)
+    else:
+        node_scores = khop_scores(mirror, seeds, depth=depth, decay=float(connection.cfg.get("LOCAL_HOP_DECAY", 0.5)))
+    return top_edges(mirror, node_scores, k=k)
+
+
+NODES_QUERY = """
+    MATCH (n:Entity)
+    RETURN n.id as id, n.type as type, n.desc as desc
+"""
+
+EDGES_QUERY = """
+    MATCH (s:Entity)-[r]->(t:Entity)
+    WHERE type(r) <> 'IN_COMMUNITY'
+    RETURN s.id as source, t.id as target, type(r) as rel, r.desc as rel_desc
+"""
+
+SUBGRAPH_QUERY = """
+    MATCH (a:Entity) WHERE a.id IN $ids
+    MATCH (a)-[:CONNECTED_TO*0..%d]-(n:Entity)
+    WITH collect(DISTINCT n) as nodes
+    UNWIND nodes as s
+    OPTIONAL MATCH (s)-[r]->(t:Entity)
+    WHERE type(r) <> 'IN_COMMUNITY' AND t IN nodes
+    RETURN s.id as id, s.type as type, s.desc as desc,
+           collect({source: s.id, target: t.id, rel: type(r), rel_desc: r.desc}) as edges
+"""
+
+
+OUTER_EDGES_QUERY = """
+    MATCH (s:Entity)-[r]-(t:Entity)
+    WHERE s.id IN $ids AND NOT t.id IN $ids AND type(r) <> 'IN_COMMUNITY'
+    RETURN DISTINCT t.id as id, t.type as type, t.desc as desc,
+           startNode(r).id as source, endNode(r).id as target, type(r) as rel, r.desc as rel_desc
+"""
+
+
+def load_mirror(generation=None):
+    nodes = connection.graph.query(NODES_QUERY)
+    edges = connection.graph.query(EDGES_QUERY)
+    return GraphMirror(nodes, edges, generation)
+
+
+async def aload_mirror(generation=None):
+    nodes = await connection.aquery(NODES_QUERY)
+    edges = await connection.aquery(EDGES_QUERY)
+    return GraphMirror(nodes, edges, generation)
+
+
+def subgraph_from_rows(rows, outer):
+    edges = [e for r in rows for e in r['edges'] if e.get('target') is not None]
+    nodes = list(rows) + list({o['id']: o for o in outer}.values())
+    edges += [{"source": o['source'], "target": o['target'], "rel": o['rel'], "rel_desc": o['rel_desc']} for o in outer]
+    return GraphMirror(nodes, edges)
+
+
+async def aload_subgraph(anchor_ids, depth):
+    # Chỉ tải vùng depth-1 hop quanh anchor (đủ để chấm điểm cạnh tới hop depth)
+    rows = await connection.aquery(SUBGRAPH_QUERY % max(int(depth) - 1, 0), {"ids": list(anchor_ids)})
+    # Thêm đầu mút ngoài cùng của các cạnh hop cuối
+    outer = await connection.aquery(OUTER_EDGES_QUERY, {"ids": [r['id'] for r in rows]})
+    return subgraph_from_rows(rows, outer)
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+# Event loop -> {generation: task đang tải mirror}: mỗi generation chỉ tải 1 lần, các request khác chờ chung
+_mirror_loads = weakref.WeakKeyDictionary()
+
+
+def install_mirror(mirror, t1):
+    global _mirror
+    with _mirror_lock:
+        # Chỉ thay bằng mirror mới hơn: request tải chậm với generation cũ không được đè mirror mới
+        if _mirror is None or mirror.generation > _mirror.generation:
+            _mirror = mirror
+            print(f"   -> Nạp graph mirror: {len(mirror)} nodes, {len(mirror.edges)} edges ({time.time() - t1:.2f}s)")
+        return _mirror
+
+
+def get_graph_mirror():
+    # Mirror dùng chung cho cả process, tải lại khi graph generation đổi
+    generation = get_graph_generation()
+    with _mirror_lock:
+        if _mirror is not None and _mirror.generation == generation:
+            return _mirror
+        t1 = time.time()
+        mirror = load_mirror(generation)
+    return install_mirror(mirror, t1)
+
+
+async def aload_and_install_mirror(generation):
+    t1 = time.time()
+    return install_mirror(await aload_mirror(generation), t1)
+
+
+async def aget_graph_mirror():
+    generation = await aget_graph_generation()
+    current = _mirror
+    if current is not None and current.generation == generation:
+        return current
+
+    loads = _mirror_loads.setdefault(asyncio.get_running_loop(), {})
+    task = loads.get(generation)
+    if task is None:
+        task = loads[generation] = asyncio.ensure_future(aload_and_install_mirror(generation))
+
+        def done(t):
+            loads.pop(generation, None)
+            # Mọi request chờ đều đã huỷ thì vẫn đọc exception để asyncio không log "never retrieved"
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(done)
+    # shield: 1 request bị huỷ không huỷ lượt tải mà các request khác đang chờ
+    return await asyncio.shield(task)
+
+
+async def arank_relations(anchor_scores, method=None, depth=None, k=None):
+    """Chọn nguồn graph theo LOCAL_SCORING_SOURCE (mirror | subgraph) rồi chấm điểm."""
+    depth = int(depth or connection.cfg.get("LOCAL_HOP_DEPTH", 2))
+    if connection.cfg.get("LOCAL_SCORING_SOURCE", "mirror") == "subgraph":
+        mirror = await aload_subgraph(anchor_scores.keys(), depth)
+    else:
+        mirror = await aget_graph_mirror()
+    return score_relations(mirror, anchor_scores, method=method, depth=depth, k=k)
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+from langchain_core.runnables import RunnableLambda
+
+import src.connection as connection
+import src.metrics as metrics
+import src.routing as routing
+from src.cache import normalize_question, get_answer_cache
+from src.graph import run_ingestion
+from src.pipeline import run_indexing_pipeline
+from src.run_ingestion_rulebased import run_ingestion_test
+from src.retrieval import (aglobal_search, alocal_search, arouter_search,
+                           aglobal_search_stream, alocal_search_stream, arouter_search_stream)
+
+# mode -> (hàm trả lời, hàm stream)
+SEARCHES = {
+    "router": (arouter_search, arouter_search_stream),
+    "global": (aglobal_search, aglobal_search_stream),
+    "local": (alocal_search, alocal_search_stream),
+}
+INGESTERS = {"llm": run_ingestion, "rulebased": run_ingestion_test}
+JOB_LOG_LINES = 1000  # số dòng log giữ lại cho mỗi job
+
+# LLM đã bọc bounded_llm: create_app gọi nhiều lần (test, load test, reload) không bọc chồng
+_bounded_llm = None
+
+
+def bounded_llm(llm, limit):
+    """
+    Bọc LLM để giới hạn số lượt gọi đồng thời, giữ nguyên streaming.
+    Sync và async (mọi event loop) dùng chung 1 semaphore nên tổng số lượt gọi không vượt limit;
+    phía async chờ slot bằng cách thử lại không chặn để không giữ event loop.
+    """
+    slots = threading.BoundedSemaphore(limit)
+
+    def call(messages, config):
+        with slots:
+            yield from llm.stream(messages, config)
+
+    async def acall(messages, config):
+        delay = 0.005
+        while not slots.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            async for chunk in llm.astream(messages, config):
+                yield chunk
+        finally:
+            slots.release()
+
+    return RunnableLambda(call, afunc=acall, name=f"bounded_{type(llm).__name__}")
+
+
+class Broadcast:
+    """Chạy 1 async generator, phát lại toàn bộ event cho mọi subscriber (kể cả subscriber đến muộn)."""
+
+    def __init__(self, agen):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.cond = asyncio.Condition()
+        self.task = asyncio.ensure_future(self.pump(agen))
+
+    async def pump(self, agen):
+        try:
+            async for event in agen:
+                async with self.cond:
+                    self.events.append(event)
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: i < len(self.events) or self.done)
+                batch = self.events[i:]
+                finished = self.done and i + len(batch) >= len(self.events)
+            for event in batch:
+                yield event
+            i += len(batch)
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """
+    Gộp request giống hệt nhau đang chạy (singleflight): mỗi key chỉ tính 1 lần,
+    các request đến sau chờ chung kết quả. Công việc chạy trong task riêng nên
+    client đầu tiên ngắt kết nối cũng không huỷ kết quả của các client khác.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.streams = {}
+        self.stats = Counter()
+
+    async def do(self, key, factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+            self.stats["executed"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def stream(self, key, agen_factory):
+        broadcast = self.streams.get(key)
+        if broadcast is None:
+            broadcast = Broadcast(agen_factory())
+            self.streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self.streams.pop(key, None))
+            self.stats["stream_executed"] += 1
+        else:
+            self.stats["stream_coalesced"] += 1
+        return broadcast.subscribe()
+
+
+class JobRunner:
+    """Chạy pipeline indexing trong thread nền, mỗi lúc 1 job. Chỉ giữ max_jobs job gần nhất."""
+
+    def __init__(self, max_jobs=50):
+        self.jobs = {}
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.running = None
+
+    def evict(self):
+        # Bỏ các job đã xong cũ nhất (dict giữ thứ tự tạo)
+        finished = [job_id for job_id, job in self.jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job_id]
+
+    def start(self, source, ingest_fn, incremental=False, force=False):
+        with self.lock:
+            if self.running is not None:
+                return None
+            job_id = uuid.uuid4().hex[:12]
+            job = {"id": job_id, "status": "running", "logs": [], "error": None,
+                   "started_at": time.time(), "finished_at": None}
+            self.jobs[job_id] = job
+            self.running = job_id
+            self.evict()
+
+        def log(msg):
+            job["logs"].append(str(msg))
+            if len(job["logs"]) > JOB_LOG_LINES:
+                del job["logs"][0]
+
+        def run():
+            try:
+                run_indexing_pipeline(source, ingest_fn=ingest_fn, incremental=incremental, force=force, log=log)
+                job["status"] = "done"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                job["finished_at"] = time.time()
+                with self.lock:
+                    self.running = None
+
+        threading.Thread(target=run, name=f"ingest-{job_id}", daemon=True).start()
+        return job_id
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text="Body phải là JSON.")
+
+
+async def handle_search(request):
+    mode = request.match_info["mode"]
+    if mode not in SEARCHES:
+        raise web.HTTPNotFound(text=f"Không có chế độ tìm kiếm '{mode}'.")
+    body = await read_json(request)
+    question = str(body.get("question") or "").strip()
+    if not question:
+        raise web.HTTPBadRequest(text="Thiếu 'question'.")
+
+    max_communities = body.get("max_communities") if mode == "global" else None
+    if max_communities is not None:
+        try:
+            max_communities = int(max_communities)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="'max_communities' phải là số nguyên.")
+        if max_communities <= 0:
+            raise web.HTTPBadRequest(text="'max_communities' phải lớn hơn 0.")
+    args = (question, max_communities) if max_communities is not None else (question,)
+    key = (mode, normalize_question(question), max_communities)
+    answer_fn, stream_fn = SEARCHES[mode]
+    flight = request.app["singleflight"]
+
+    if not body.get("stream"):
+        t1 = time.time()
+        answer = await flight.do(key, lambda: answer_fn(*args))
+        return web.json_response({"mode": mode, "answer": answer, "latency": round(time.time() - t1, 3)})
+
+    # Stream NDJSON: mỗi dòng là 1 event (status / route / token)
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson; charset=utf-8"})
+    await response.prepare(request)
+    try:
+        async for event in flight.stream(key, lambda: stream_fn(*args)):
+            if event["type"] == "result":
+                event = {"type": "result", "result": event["result"].to_dict()}
+            await response.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+    except Exception as e:
+        await response.write((json.dumps({"type": "error", "message": str(e)}, ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def handle_ingest(request):
+    body = await read_json(request)
+    # Chỉ nhận nội dung YAML gửi kèm: không đọc file theo đường dẫn do client chỉ định
+    source = body.get("yaml")
+    if not source or not isinstance(source, str):
+        raise web.HTTPBadRequest(text="Cần 'yaml' (nội dung cấu hình dạng chuỗi).")
+
+    ingest_fn = INGESTERS.get(body.get("ingester", "llm"))
+    if ingest_fn is None:
+        raise web.HTTPBadRequest(text=f"'ingester' phải là một trong {list(INGESTERS)}.")
+
+    job_id = request.app["jobs"].start(source, ingest_fn, incremental=bool(body.get("incremental")),
+                                       force=bool(body.get("force")))
+    if job_id is None:
+        raise web.HTTPConflict(text="Đang có job indexing khác chạy.")
+    return web.json_response({"job_id": job_id}, status=202)
+
+
+async def handle_job(request):
+    job = request.app["jobs"].jobs.get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(text="Không tìm thấy job.")
+    return web.json_response(job)
+
+
+async def handle_stats(request):
+    cache = get_answer_cache()
+    return web.json_response({
+        "singleflight": dict(request.app["singleflight"].stats),
+        "in_flight": len(request.app["singleflight"].calls) + len(request.app["singleflight"].streams),
+        "router": routing.get_stats(),
+        "cache": cache.metrics() if cache is not None else None,
+        "metrics": metrics.registry.summary(),
+    })
+
+
+async def handle_metrics(request):
+    # Prometheus text exposition
+    return web.Response(text=metrics.registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def handle_health(request):
+    return web.json_response({"status": "ok", "llm": connection.llm is not None, "neo4j": connection.graph is not None})
+
+
+def create_app(init=True, read_only=False):
+    """
+    Dựng aiohttp app. init=False khi caller đã tự cấu hình connection (VD: load test với LLM giả);
+    read_only=True bỏ route /ingest để app không ghi gì vào Neo4j.
+    """
+    global _bounded_llm
+    if init:
+        connection.init_connections()
+    if connection.llm is not None and connection.llm is not _bounded_llm:
+        limit = int(connection.cfg.get("SERVER_LLM_MAX_CONCURRENCY", 8))
+        connection.llm = _bounded_llm = bounded_llm(connection.llm, limit)
+
+    app = web.Application()
+    app["singleflight"] = SingleFlight()
+    app["jobs"] = JobRunner(max_jobs=int(connection.cfg.get("SERVER_MAX_JOBS", 50)))
+    app.router.add_post("/search/{mode}", handle_search)
+    if not read_only:
+        app.router.add_post("/ingest", handle_ingest)
+        app.router.add_get("/jobs/{job_id}", handle_job)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GraphRAG HTTP query service")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    args = parser.parse_args()
+
+    app = create_app()
+    host = args.host or connection.cfg.get("SERVER_HOST", "127.0.0.1")
+    port = args.port or int(connection.cfg.get("SERVER_PORT", 8080))
+    web.run_app(app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Load test cho src/server.py.
+
+Mặc định dựng server ngay trong process với LLM / embedding giả của src/providers.py
+(Neo4j vẫn là thật; độ trễ LLM giả theo FAKE_LLM_LATENCY / FAKE_LLM_JITTER), nên đo được
+overhead của pipeline + singleflight mà không tốn quota Gemini. Server trong process chỉ đọc
+(không có /ingest, đường truy vấn không ghi gì) nên embedding giả không lọt vào DB thật.
+Answer cache tắt mặc định để latency đo pipeline retrieval chứ không phải cache hit (--cache để bật):
+
+    python -m src.test.load_test --concurrency 32 --requests 200 --mode router
+
+Chạy với server có sẵn:
+
+    python -m src.test.load_test --url http://localhost:8080
+"""
+import argparse
+import asyncio
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+
+import src.connection as connection
+from src.instrumentation import instrument_llm
+from src.providers import create_embeddings, create_llm
+from src.server import create_app
+
+DEFAULT_QUESTIONS = [
+    "Địa chỉ IP của SPINE_ROUTER_01 là gì?",
+    "Có bao nhiêu thiết bị trong mạng?",
+    "Những thiết bị nào là điểm lỗi đơn (SPOF)?",
+    "Interface nào của LEAF_SWITCH_01 dùng MTU 9000?",
+    "Tóm tắt kiến trúc mạng hiện tại.",
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_local_server(cache=False):
+    connection.init_connections()
+    connection.cfg["ANSWER_CACHE_ENABLED"] = cache
+    connection.llm = instrument_llm(create_llm(connection.cfg, provider="fake"))
+    connection.embeddings = create_embeddings(connection.cfg, provider="fake")
+
+    runner = web.AppRunner(create_app(init=False, read_only=True))
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def one_request(session, url, mode, question, stream):
+    t1 = time.perf_counter()
+    async with session.post(f"{url}/search/{mode}", json={"question": question, "stream": stream}) as resp:
+        if stream:
+            first_token = None
+            async for _ in resp.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - t1
+        else:
+            await resp.read()
+            first_token = None
+        return resp.status, time.perf_counter() - t1, first_token
+
+
+async def run_load(url, mode, questions, total, concurrency, stream):
+    slots = asyncio.Semaphore(concurrency)
+    results = []
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+        async def worker(i):
+            async with slots:
+                try:
+                    results.append(await one_request(session, url, mode, questions[i % len(questions)], stream))
+                except Exception as e:
+                    print(f"Lỗi request {i}: {e}")
+                    results.append((None, 0.0, None))
+
+        t1 = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(total)))
+        elapsed = time.perf_counter() - t1
+
+        async with session.get(f"{url}/stats") as resp:
+            server_stats = await resp.json()
+    return results, elapsed, server_stats
+
+
+def report(results, elapsed, server_stats):
+    latencies = [r[1] for r in results if r[0] == 200]
+    first = [r[2] for r in results if r[0] == 200 and r[2] is not None]
+    errors = sum(1 for r in results if r[0] != 200)
+
+    print(f"\n===== LOAD TEST: {len(results)} request trong {elapsed:.2f}s ({len(results) / elapsed:.1f} req/s) =====")
+    print(f"Lỗi: {errors}")
+    for name, values in (("latency", latencies), ("first event", first)):
+        if values:
+            print(f"{name}: p50={percentile(values, 50):.3f}s p95={percentile(values, 95):.3f}s "
+                  f"p99={percentile(values, 99):.3f}s max={max(values):.3f}s")
+    print(f"Singleflight: {server_stats.get('singleflight')}")
+    print(f"Router: {server_stats.get('router')}")
+    cache = server_stats.get('cache')
+    print(f"Cache: {cache}")
+    if cache and cache.get("hit_exact", 0) + cache.get("hit_semantic", 0):
+        print("Lưu ý: có cache hit, latency ở trên lẫn cả câu trả lời từ cache (chạy server với cache tắt để đo pipeline).")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test cho GraphRAG HTTP service")
+    parser.add_argument("--url", default=None, help="Server có sẵn; bỏ trống = dựng server trong process với LLM giả")
+    parser.add_argument("--mode", default="router", choices=["router", "global", "local"])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--questions", default=None, help="File câu hỏi, mỗi dòng 1 câu")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--cache", action="store_true", help="Bật answer cache cho server trong process (mặc định tắt)")
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    runner = None
+    url = args.url
+    if url is None:
+        runner, url = await start_local_server(cache=args.cache)
+    try:
+        results, elapsed, server_stats = await run_load(url, args.mode, questions, args.requests,
+                                                        args.concurrency, args.stream)
+        report(results, elapsed, server_stats)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,6 +3,7 @@ from langchain_core.output_parsers import JsonOutputParser
 from langchain_community.vectorstores import Neo4jVector
 import json
 import src.connection as connection
+from src.graph import bump_graph_generation
 from src.prompt.index.community_report_new import BATCH_COMMUNITY_REPORT_PROMPT
 from src.prompt.index.extract_graph import GRAPH_EXTRACTION_PROMPT
 from src.prompt.index.extract_graph_code_repo import GRAPH_EXTRACTION_REPO_PROMPT
@@ -45,7 +46,7 @@ def run_ingestion_for_repo_struct(repo_structure_data, import_analysis_data):  #
 
     except Exception as e:
         print(f"Extraction Failed: {e}")
-        return
+        raise
 
     entities = []
     relationships = []
@@ -124,5 +125,7 @@ def run_ingestion_for_repo_struct(repo_structure_data, import_analysis_data):  #
             }
         )
 
+    bump_graph_generation()
+
     t2 = time.time()
     print(f"Hoàn thành! Tổng thời gian: {round(t2 - t1, 2)} (s)")
\ No newline at end of file
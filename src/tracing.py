@@ -0,0 +1,153 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+import src.connection as connection
+from src.instrumentation import current_record
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+class TraceSink:
+    """
+    Ghi JSONL (tuỳ chọn gzip) bằng 1 thread nền: request chỉ đẩy record vào queue.
+    Queue đầy thì bỏ record (đếm vào dropped) thay vì chặn request. File vượt max_bytes
+    được xoay vòng thành path.1 ... path.N như RotatingFileHandler.
+    """
+
+    def __init__(self, path, compress=False, max_bytes=50 * 1024 * 1024, backups=5, queue_size=10000):
+        self.path = path + ".gz" if compress and not path.endswith(".gz") else path
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, name=f"trace-writer:{os.path.basename(self.path)}", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self.compress:
+            return gzip.open(self.path, "at", encoding="utf-8")
+        return open(self.path, "a", encoding="utf-8")
+
+    def rotate(self, f):
+        f.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            if self.backups > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        finally:
+            # Xoay vòng lỗi thì vẫn mở lại file (ghi tiếp vào file cũ, thử xoay lại ở batch sau)
+            f = self.open()
+        return f
+
+    def run(self):
+        f = self.open()
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if f.closed:
+                    f = self.open()
+                for record in batch:
+                    if record is None:
+                        stop = True
+                        continue
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                    self.written += 1
+                f.flush()
+                if self.max_bytes and os.path.getsize(self.path) >= self.max_bytes:
+                    f = self.rotate(f)
+            except Exception as e:
+                print(f"Lỗi ghi trace {self.path}: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+        f.close()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self, timeout=5):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+def open_sink(name, path, **options):
+    # 1 sink (1 thread ghi) cho mỗi tên, tạo lười
+    with _sinks_lock:
+        if name not in _sinks:
+            _sinks[name] = TraceSink(path, **options)
+        return _sinks[name]
+
+
+def sink_options():
+    return {
+        "compress": bool(connection.cfg.get("TRACE_GZIP", False)),
+        "max_bytes": int(connection.cfg.get("TRACE_MAX_BYTES", 50 * 1024 * 1024)),
+        "backups": int(connection.cfg.get("TRACE_BACKUPS", 5)),
+    }
+
+
+def get_query_sink():
+    # None nếu tắt trace
+    if not connection.cfg.get("TRACE_ENABLED", True):
+        return None
+    return open_sink("query", connection.cfg.get("TRACE_PATH", "log/query/trace.jsonl"), **sink_options())
+
+
+def begin(record, question, strategy):
+    """Gán query id cho record nếu câu hỏi được lấy mẫu (TRACE_SAMPLE_RATE); trả về id hoặc None."""
+    record.trace_id = None
+    sink = get_query_sink()
+    if sink is None or random.random() >= float(connection.cfg.get("TRACE_SAMPLE_RATE", 1.0)):
+        return None
+    record.trace_id = uuid.uuid4().hex[:16]
+    sink.write({"ts": time.time(), "query_id": record.trace_id, "event": "query",
+                "question": question, "strategy": strategy})
+    return record.trace_id
+
+
+def active():
+    # Dùng để bỏ qua việc dựng payload lớn khi câu hỏi không được trace
+    record = current_record()
+    return record is not None and record.trace_id is not None
+
+
+def trace(event, record=None, **data):
+    if record is None:
+        record = current_record()
+    if record is None or record.trace_id is None:
+        return
+    _sinks["query"].write({"ts": time.time(), "query_id": record.trace_id, "event": event, **data})
+
+
+@atexit.register
+def close_sinks():
+    for sink in list(_sinks.values()):
+        sink.close()
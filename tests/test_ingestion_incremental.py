@@ -0,0 +1,71 @@
+import src.connection as connection
+import src.run_ingestion_rulebased as rulebased
+from src.run_ingestion_rulebased import MARK_DIRTY_QUERY, diff_entities, run_ingestion_test
+
+YAML = """# DEVICE: ROUTER_A
+network:
+  version: 2
+  ethernets:
+    eth0:
+      addresses: [10.0.0.1/24]
+      mtu: 1500
+"""
+
+
+class FakeGraph:
+    """Neo4jGraph giả: trả về node / cạnh có sẵn và ghi lại các truy vấn đã gửi."""
+
+    def __init__(self, nodes=None, edges=None):
+        self.nodes = nodes or {}
+        self.edges = edges or set()
+        self.calls = []
+
+    def query(self, cypher, params=None):
+        self.calls.append((cypher, params or {}))
+        if "RETURN e.id as id, e.type as type" in cypher:
+            return [{"id": i, "type": t, "desc": d, "infor": f} for i, (t, d, f) in self.nodes.items()]
+        if "RETURN a.id as source, b.id as target" in cypher:
+            return [{"source": s, "target": t} for s, t in self.edges]
+        if "GraphMeta" in cypher:
+            return [{"generation": 1}]
+        return []
+
+
+def ingest(monkeypatch, tmp_path, graph):
+    monkeypatch.setattr(connection, "graph", graph)
+    monkeypatch.chdir(tmp_path)  # log JSON ghi vào thư mục tạm
+    return run_ingestion_test(YAML)
+
+
+def test_diff_marks_text_changes_stale():
+    existing = {"A": ("DEVICE", "old", "{}"), "B": ("DEVICE", "same", "{}")}
+    entities = [{"name": "A", "type": "DEVICE", "desc": "new", "infor": "{}"},
+                {"name": "B", "type": "DEVICE", "desc": "same", "infor": "{}"},
+                {"name": "C", "type": "DEVICE", "desc": "added", "infor": "{}"}]
+    changed, stale, removed_ids, removed_edges = diff_entities(
+        existing, {("A", "B")}, entities, {("B", "C")}, {"A", "B", "C"})
+    assert stale == {"A"}
+    assert changed == {"A", "B", "C"}
+    assert not removed_ids
+    assert removed_edges == {("A", "B")}
+
+
+def test_changed_entity_is_reembedded(monkeypatch, tmp_path):
+    first = FakeGraph()
+    ingest(monkeypatch, tmp_path, first)
+    ids = [e["name"] for e in rulebased.entities]
+    assert "ROUTER_A" in ids
+
+    # Lần 2: graph đã có đúng các node này, riêng ROUTER_A mang desc cũ
+    nodes = {e["name"]: (e["type"], e["desc"], e["infor"]) for e in rulebased.entities}
+    nodes["ROUTER_A"] = ("DEVICE", "outdated description", nodes["ROUTER_A"][2])
+    edges = {(r["source"], r["target"]) for r in rulebased.relationships}
+    second = FakeGraph(nodes, edges)
+    changed = ingest(monkeypatch, tmp_path, second)
+
+    assert changed == ["ROUTER_A"]
+    marks = [params for cypher, params in second.calls if cypher == MARK_DIRTY_QUERY]
+    assert len(marks) == 1
+    # Embedding cũ bị xoá -> create_indices (chỉ embed node chưa có embedding) embed lại
+    assert marks[0]["stale"] == ["ROUTER_A"]
+    assert "REMOVE e.embedding" in MARK_DIRTY_QUERY